@@ -0,0 +1,186 @@
+import random
+from collections import Counter, deque
+
+
+class FenwickTree:
+    """树状数组：O(log n) 单点更新、前缀和以及按前缀和查找下标"""
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = [0.0] * (self.size + 1)
+        self.weights = [0.0] * self.size
+        for i, weight in enumerate(weights):
+            self.weights[i] = weight
+            j = i + 1
+            self.tree[j] += weight
+            parent = j + (j & -j)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[j]
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        if not delta:
+            return
+        self.weights[index] = weight
+        j = index + 1
+        while j <= self.size:
+            self.tree[j] += delta
+            j += j & -j
+
+    def total(self):
+        result = 0.0
+        j = self.size
+        while j > 0:
+            result += self.tree[j]
+            j -= j & -j
+        return result
+
+    def find(self, value):
+        """返回使前缀和超过 value 的最小下标"""
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = index + step
+            if nxt <= self.size and self.tree[nxt] <= value:
+                index = nxt
+                value -= self.tree[nxt]
+            step >>= 1
+        return min(index, self.size - 1)
+
+
+class WeightedClipSampler:
+    """按使用次数加权随机选择片段
+
+    与原 select_file 语义一致：
+    - 每个文件最多使用 max_usage 次，某个文件夹内全部用满后该文件夹计数清零；
+    - 尽量避开最近 recent_window 次（跨文件夹）选中的文件，全部都在其中时不再回避；
+    - 权重为 1 / (1 + 使用次数)。
+    每个文件夹一棵树状数组，单次选择为 O(recent_window · log n)。
+    传入 seed 可复现整批的选择结果。
+    """
+
+    def __init__(self, files_by_folder, max_usage=3, recent_window=10, seed=None):
+        self.max_usage = max_usage
+        self.rng = random.Random(seed)
+        self.recently_used = deque(maxlen=recent_window)
+        self._recent_counts = Counter()
+        self.files = {}
+        self.positions = {}
+        self.usage = {}
+        self.trees = {}
+        self.available_count = {}
+        for folder, files in files_by_folder.items():
+            self.files[folder] = list(files)
+            self.positions[folder] = {path: i for i, path in enumerate(files)}
+            self._reset_folder(folder)
+
+    def _weight(self, usage):
+        return 1.0 / (1 + usage) if usage < self.max_usage else 0.0
+
+    def _reset_folder(self, folder):
+        files = self.files[folder]
+        self.usage[folder] = [0] * len(files)
+        self.trees[folder] = FenwickTree([self._weight(0)] * len(files))
+        self.available_count[folder] = len(files) if self.max_usage > 0 else 0
+
+    def usage_of(self, folder, path):
+        return self.usage[folder][self.positions[folder][path]]
+
+    def _remember(self, path):
+        if len(self.recently_used) == self.recently_used.maxlen:
+            oldest = self.recently_used[0]
+            self._recent_counts[oldest] -= 1
+            if not self._recent_counts[oldest]:
+                del self._recent_counts[oldest]
+        self.recently_used.append(path)
+        self._recent_counts[path] += 1
+
+    def select(self, folder, accept=None):
+        """从文件夹中选择一个文件，没有文件时返回 None
+
+        accept(path) 返回假的文件本次不予选择，也不计入使用次数和最近使用记录；全部被拒绝时返回 None。
+        """
+        files = self.files.get(folder)
+        if not files:
+            return None
+        if self.available_count[folder] == 0:
+            self._reset_folder(folder)
+        index = self._choose(folder, accept)
+        if index is None and self.available_count[folder] < len(files):
+            # 可以接受的文件都已用满：与全部用满时一样清零计数后再选
+            self._reset_folder(folder)
+            index = self._choose(folder, accept)
+        if index is None:
+            return None
+
+        usage = self.usage[folder]
+        usage[index] += 1
+        self.trees[folder].set(index, self._weight(usage[index]))
+        if usage[index] == self.max_usage:
+            self.available_count[folder] -= 1
+        selected = files[index]
+        self._remember(selected)
+        return selected
+
+    def _choose(self, folder, accept):
+        """按权重抽取一个可以接受的文件下标，不修改使用次数；没有时返回 None"""
+        files = self.files[folder]
+        tree = self.trees[folder]
+        usage = self.usage[folder]
+        positions = self.positions[folder]
+
+        # 暂时把最近使用过的文件权重置零；若因此没有可选文件则不回避
+        hidden = [positions[path] for path in self._recent_counts if path in positions]
+        hidden = [i for i in hidden if tree.weights[i] > 0]
+        if len(hidden) == self.available_count[folder]:
+            hidden = []
+        for i in hidden:
+            tree.set(i, 0.0)
+
+        rejected = []
+        index = None
+        while True:
+            if len(hidden) + len(rejected) == self.available_count[folder]:
+                if not hidden:
+                    break
+                # 其余文件都被拒绝，不再回避最近使用过的文件
+                for i in hidden:
+                    tree.set(i, self._weight(usage[i]))
+                hidden = []
+                continue
+            index = tree.find(self.rng.random() * tree.total())
+            # 浮点误差可能落到权重为 0 的位置，就近寻找可选文件
+            while tree.weights[index] <= 0 and index > 0:
+                index -= 1
+            while tree.weights[index] <= 0:
+                index += 1
+            if accept is None or accept(files[index]):
+                break
+            tree.set(index, 0.0)
+            rejected.append(index)
+            index = None
+
+        for i in hidden + rejected:
+            tree.set(i, self._weight(usage[i]))
+        return index
+
+    def unselect(self, folder, path):
+        """撤销最近一次对 path 的选择（选中后最终没有使用），恢复使用次数和最近使用记录
+
+        选择时被挤出最近使用记录的更早条目无法恢复。
+        """
+        index = self.positions[folder][path]
+        usage = self.usage[folder]
+        if not usage[index]:
+            return
+        if usage[index] == self.max_usage:
+            self.available_count[folder] += 1
+        usage[index] -= 1
+        self.trees[folder].set(index, self._weight(usage[index]))
+        for i in range(len(self.recently_used) - 1, -1, -1):
+            if self.recently_used[i] == path:
+                del self.recently_used[i]
+                self._recent_counts[path] -= 1
+                if not self._recent_counts[path]:
+                    del self._recent_counts[path]
+                break
@@ -0,0 +1,198 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from json_manifest import JsonManifest
+from media_probe import MediaIndex
+from merge_engine import MergeJob
+from segment_encode import probe_keyframes
+
+# 片段元数据默认保存在目标文件夹中
+CLIP_METADATA_FILE_NAME = ".clip_metadata.json"
+CLIP_METADATA_VERSION = 1
+# 只给出一个目标时长 T 时，接受 [T × (1 - 容差), T]
+DEFAULT_WINDOW_TOLERANCE = 0.1
+# 在关键帧处截短片段时至少保留的时长（秒）
+MIN_TRIMMED_SECONDS = 1.0
+# 时长不足下限时，最多再轮流从各文件夹补充的轮数
+MAX_EXTRA_ROUNDS = 20
+
+
+def parse_duration_window(text):
+    """解析目标时长："60-90" 为区间，"75" 为 [67.5, 75]，空字符串返回 None"""
+    text = text.strip()
+    if not text:
+        return None
+    low, sep, high = text.partition("-")
+    if sep:
+        window = (float(low), float(high))
+    else:
+        high = float(text)
+        window = (high * (1 - DEFAULT_WINDOW_TOLERANCE), high)
+    if window[0] <= 0 or window[0] > window[1]:
+        raise ValueError(f"无效的目标时长：{text}")
+    return window
+
+
+class ClipMetadataStore(JsonManifest):
+    """片段元数据：时长、分辨率（来自 MediaIndex）和关键帧位置
+
+    build() 并行探测一批片段；关键帧以片段路径为键，文件大小和修改时间未变时直接复用。
+    path 为 None 时只在内存中缓存。
+    """
+
+    VERSION = CLIP_METADATA_VERSION
+
+    def __init__(self, path=None, media_index=None):
+        self.media_index = media_index if media_index is not None else MediaIndex()
+        self.clips = {}
+        super().__init__(path)
+
+    def save(self):
+        """保存关键帧清单，同时保存媒体信息索引"""
+        self.media_index.save()
+        super().save()
+
+    def keyframes(self, path):
+        """片段的关键帧时间点，必要时调用 ffprobe"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        entry = self.current(path, st)
+        if entry:
+            return entry["keyframes"]
+        keyframes = probe_keyframes(path)
+        self.store(path, st, keyframes=keyframes)
+        return keyframes
+
+    def build(self, paths, keyframes=True, max_workers=8):
+        """并行探测全部片段，返回可用片段数；无法读取或时长未知的片段不会出现在 clips 中"""
+        paths = list(paths)
+        infos = self.media_index.probe_all(paths, max_workers)
+        clips = {}
+        for path, info in infos.items():
+            if not info or not info.get("duration"):
+                continue
+            video = info.get("video") or {}
+            clips[path] = {
+                "duration": info["duration"],
+                "width": video.get("width"),
+                "height": video.get("height"),
+                "keyframes": None,
+            }
+        if keyframes and clips:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for path, points in zip(clips, executor.map(self.keyframes, list(clips))):
+                    clips[path]["keyframes"] = points
+        self.clips = clips
+        return len(clips)
+
+    def get(self, path):
+        return self.clips.get(path)
+
+
+class CompilationPlanner:
+    """在拼接前一次性规划全部合成，使每个合成的时长落在目标区间内
+
+    每个合成先按文件夹顺序各取一个片段（与逐次选择时的结构相同），时长不足下限时再轮流从各文件夹补充，
+    超过上限时把最后一个片段截短到上限以内的关键帧处（拼接列表中的 outpoint）。
+    片段选择仍由 sampler（WeightedClipSampler）按使用次数和最近使用规则进行；没有元数据的片段不会被选入。
+    window 为 None 时不限制时长。
+    给出 normalizer（ClipNormalizer）时，拼接前会被转换的片段不在关键帧处截短：
+    转换后的文件关键帧位置不同，按源文件关键帧得到的截短点无法无损切割。
+    """
+
+    def __init__(self, folders, sampler, metadata, window=None, normalizer=None):
+        self.folders = list(folders)
+        self.sampler = sampler
+        self.metadata = metadata
+        self.window = window
+        self.normalizer = normalizer
+
+    def _pick(self, folder):
+        """从文件夹中选择一个有元数据的片段，找不到时返回 None；没有元数据的片段不计入使用次数"""
+        return self.sampler.select(folder, lambda path: self.metadata.get(path) is not None)
+
+    def _trim_last(self, files, folders, outpoints, total, high):
+        """把最后一个片段截短到 high 以内，返回新的总时长；无法截短时去掉该片段或保持不变"""
+        clip = self.metadata.get(files[-1])
+        rest = total - clip["duration"]
+        room = high - rest
+        keyframes = clip["keyframes"] or ()
+        if self.normalizer is not None and self.normalizer.needs_conversion(files[-1]):
+            keyframes = ()
+        cuts = [point for point in keyframes if MIN_TRIMMED_SECONDS <= point <= room]
+        if cuts:
+            outpoints[-1] = max(cuts)
+            return rest + outpoints[-1]
+        if len(files) > 1 and self.window and rest >= self.window[0]:
+            # 去掉的片段没有进入合成，撤销它的使用次数
+            self.sampler.unselect(folders.pop(), files.pop())
+            outpoints.pop()
+            return rest
+        return total
+
+    def plan_one(self, index, output_path):
+        files = []
+        folders = []
+        outpoints = []
+        total = 0.0
+
+        def add(folder):
+            nonlocal total
+            path = self._pick(folder)
+            if path is not None:
+                files.append(path)
+                folders.append(folder)
+                outpoints.append(None)
+                total += self.metadata.get(path)["duration"]
+
+        for folder in self.folders:
+            add(folder)
+        if self.window and files:
+            low, high = self.window
+            for _ in range(MAX_EXTRA_ROUNDS):
+                if total >= low:
+                    break
+                for folder in self.folders:
+                    if total >= low:
+                        break
+                    add(folder)
+            if total > high:
+                total = self._trim_last(files, folders, outpoints, total, high)
+        job = MergeJob(index, files, output_path, outpoints)
+        job.duration = total
+        return job
+
+    def plan(self, n, output_path_for, should_stop=lambda: False):
+        """按顺序规划 n 个合成，返回 [MergeJob]；output_path_for(i) 给出第 i 个合成的输出路径"""
+        jobs = []
+        for i in range(n):
+            if should_stop():
+                break
+            jobs.append(self.plan_one(i, output_path_for(i)))
+        return jobs
+
+    def validate(self, jobs):
+        """检查规划结果，返回要输出到日志的说明"""
+        messages = []
+        empty = [job for job in jobs if not job.video_files]
+        if empty:
+            messages.append(f"{len(empty)} 个合成没有可用片段，将被跳过")
+        planned = [job for job in jobs if job.video_files]
+        if not planned:
+            return messages
+        durations = [job.duration for job in planned]
+        messages.append(f"已规划 {len(planned)} 个合成，时长 {min(durations):.1f}–{max(durations):.1f} 秒，"
+                        f"平均 {sum(durations) / len(durations):.1f} 秒")
+        trimmed = sum(1 for job in planned if any(point is not None for point in job.outpoints))
+        if trimmed:
+            messages.append(f"{trimmed} 个合成的最后一个片段在关键帧处截短")
+        if self.window:
+            low, high = self.window
+            outside = [job for job in planned if not low <= job.duration <= high]
+            if outside:
+                names = "、".join(os.path.basename(job.output_path) for job in outside[:5])
+                messages.append(f"{len(outside)} 个合成的时长不在 {low:.0f}–{high:.0f} 秒内：{names}"
+                                + ("等" if len(outside) > 5 else ""))
+        return messages
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import threading
+from collections import Counter
+
+from encode_journal import partial_path
+from ffmpeg_runner import run_ffmpeg_streaming
+from json_manifest import JsonManifest, is_current
+from media_probe import MediaIndex
+
+# 预处理后的中间文件默认保存在目标文件夹的隐藏目录中
+NORMALIZED_DIR_NAME = ".normalized"
+NORMALIZE_INDEX_FILE_NAME = "index.json"
+NORMALIZE_INDEX_VERSION = 1
+
+# 能够生成的目标编码及其中间文件参数（中间文件只转一次，质量优先）
+VIDEO_ENCODERS = {
+    "h264": ["-c:v", "libx264", "-preset", "fast", "-crf", "18"],
+    "hevc": ["-c:v", "libx265", "-preset", "fast", "-crf", "20"],
+}
+AUDIO_ENCODERS = {
+    "aac": ["-c:a", "aac", "-b:a", "192k"],
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "192k"],
+    "opus": ["-c:a", "libopus", "-b:a", "192k"],
+}
+CHANNEL_LAYOUTS = {1: "mono", 2: "stereo", 6: "5.1", 8: "7.1"}
+
+
+def concat_key(info):
+    """concat demuxer 无损拼接所要求一致的参数；没有视频流时返回 None"""
+    video = info.get("video") if info else None
+    if not video:
+        return None
+    audio = info.get("audio") or {}
+    fps = video.get("fps")
+    return [
+        video.get("codec"), video.get("width"), video.get("height"),
+        round(fps, 3) if fps else None, video.get("pix_fmt"), video.get("time_base"),
+        audio.get("codec"), audio.get("sample_rate"), audio.get("channels"),
+    ]
+
+
+def can_produce(key):
+    """能否把其他片段转换为该规格"""
+    return key[0] in VIDEO_ENCODERS and (key[6] is None or key[6] in AUDIO_ENCODERS) \
+        and all(value is not None for value in key[1:5])
+
+
+def choose_canonical(keys):
+    """选择数量最多的规格作为统一规格，使需要转换的片段最少
+
+    只有一种规格时直接采用；否则只在能够生成的规格中选择。
+    """
+    counts = Counter(tuple(key) for key in keys if key is not None)
+    if not counts:
+        return None
+    if len(counts) == 1:
+        return list(next(iter(counts)))
+    for key, _ in counts.most_common():
+        if can_produce(key):
+            return list(key)
+    return None
+
+
+class ClipNormalizer(JsonManifest):
+    """拼接前的兼容性预处理
+
+    先探测全部片段并按拼接参数分组，取数量最多且能够生成的一组作为统一规格；
+    与之不一致的片段转换一次，结果连同源文件身份记录在清单中，之后的合成直接复用，
+    全部拼接都保持 -c copy。
+    """
+
+    VERSION = NORMALIZE_INDEX_VERSION
+
+    def __init__(self, folder, media_index=None):
+        self.folder = folder
+        self.media_index = media_index if media_index is not None else MediaIndex()
+        self.canonical = None
+        self.frame_rate = None
+        self._path_locks = {}
+        super().__init__(os.path.join(folder, NORMALIZE_INDEX_FILE_NAME))
+
+    def save(self):
+        """保存转换清单，同时保存媒体信息索引"""
+        super().save()
+        self.media_index.save()
+
+    def prepare(self, paths):
+        """探测全部片段并确定统一规格，返回 (规格种类数, 需要转换的片段数, 无法读取的片段数)"""
+        infos = self.media_index.probe_all(paths)
+        keys = {path: concat_key(info) for path, info in infos.items()}
+        self.canonical = choose_canonical(keys.values())
+        # 保留统一规格的原始帧率写法（如 30000/1001），避免换算成小数后产生误差
+        self.frame_rate = next((infos[path]["video"].get("frame_rate") for path, key in keys.items()
+                                if key is not None and key == self.canonical), None)
+        groups = len({tuple(key) for key in keys.values() if key is not None})
+        unreadable = sum(1 for key in keys.values() if key is None)
+        if self.canonical is None:
+            mismatched = 0
+        else:
+            mismatched = sum(1 for key in keys.values() if key is not None and key != self.canonical)
+        return groups, mismatched, unreadable
+
+    def _output_path(self, source):
+        digest = hashlib.sha1(json.dumps([source, self.canonical]).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:20] + ".mp4")
+
+    def build_command(self, source, info, output_path):
+        """把片段转换为统一规格：缩放加黑边、统一帧率、像素格式、时间基和音频参数"""
+        codec, width, height, _, pix_fmt, time_base, audio_codec, sample_rate, channels = self.canonical
+        frame_rate = self.frame_rate or str(self.canonical[3])
+        vf = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+              f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={frame_rate},format={pix_fmt}")
+        command = ["ffmpeg", "-i", source]
+        if audio_codec is not None and info.get("audio") is None:
+            # 统一规格带音轨而片段没有时补静音，保证拼接后音画同步
+            layout = CHANNEL_LAYOUTS.get(channels, "stereo")
+            command += ["-f", "lavfi", "-i", f"anullsrc=r={sample_rate}:cl={layout}",
+                        "-map", "0:v:0", "-map", "1:a:0", "-shortest"]
+        else:
+            command += ["-map", "0:v:0"] + (["-map", "0:a:0"] if audio_codec is not None else [])
+        command += ["-vf", vf, *VIDEO_ENCODERS[codec]]
+        if time_base and "/" in time_base:
+            command += ["-video_track_timescale", time_base.partition("/")[2]]
+        if audio_codec is not None:
+            command += [*AUDIO_ENCODERS[audio_codec], "-ar", str(sample_rate), "-ac", str(channels)]
+        else:
+            command += ["-an"]
+        return command + ["-movflags", "faststart", "-loglevel", "error", "-y", output_path]
+
+    def needs_conversion(self, source):
+        """该片段拼接时是否会被替换为转换后的文件"""
+        key = concat_key(self.media_index.get(source))
+        return key is not None and self.canonical is not None and key != self.canonical
+
+    def resolve(self, source, on_start=None):
+        """返回可以直接参与拼接的文件路径；无法读取时返回 None
+
+        需要转换时同一片段只会转换一次，其他线程等待并复用结果。
+        """
+        info = self.media_index.get(source)
+        key = concat_key(info)
+        if key is None:
+            return None
+        if self.canonical is None or key == self.canonical:
+            return source
+
+        with self._lock:
+            path_lock = self._path_locks.setdefault(source, threading.Lock())
+        with path_lock:
+            st = os.stat(source)
+            with self._lock:
+                entry = self.entries.get(source)
+            if is_current(entry, st) and entry["target"] == self.canonical and os.path.exists(entry["path"]):
+                return entry["path"]
+
+            output_path = self._output_path(source)
+            tmp_path = partial_path(output_path)
+            os.makedirs(self.folder, exist_ok=True)
+            try:
+                run_ffmpeg_streaming(self.build_command(source, info, tmp_path), on_start=on_start)
+                os.replace(tmp_path, output_path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            if entry and entry["path"] != output_path:
+                try:
+                    os.remove(entry["path"])
+                except OSError:
+                    pass
+            self.store(source, st, target=self.canonical, path=output_path)
+            return output_path
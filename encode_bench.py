@@ -0,0 +1,283 @@
+"""编码与拼接吞吐量基准测试
+
+用法:
+    python encode_bench.py run [--work-dir bench_media] [--output result.json]
+                               [--resolutions 1920x1080,1280x720] [--durations 10,60]
+                               [--concurrency 1,2,4] [--presets veryfast,medium] [--render-mode cpu]
+    python encode_bench.py compare 基线.json 本次.json [--tolerance 0.05]
+
+用 ffmpeg 的 lavfi 源（testsrc2 + sine）生成测试片段，生成结果按参数缓存在工作目录中，
+相同参数的多次运行使用完全相同的输入。每个测试用例在独立的子进程中运行，
+以便分别统计子进程的 CPU 时间和峰值内存。结果为 JSON，可用 compare 与基线比较。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from encode_engine import BatchEncoder, EncodeJob, EncodeSettings
+from encode_profiles import EncodingProfile
+from encode_scheduler import cpu_count
+from ffmpeg_runner import run_ffmpeg_streaming
+from merge_engine import MergeEngine, MergeJob
+
+BENCH_VERSION = 1
+DEFAULT_WORK_DIR = "bench_media"
+CLIP_FPS = 25
+
+
+def parse_list(value, convert=str):
+    return [convert(item) for item in value.split(",") if item.strip()]
+
+
+def clip_path(work_dir, width, height, duration):
+    return os.path.join(work_dir, "clips", f"testsrc_{width}x{height}_{duration}s.mp4")
+
+
+def generate_clip(path, width, height, duration, fps=CLIP_FPS):
+    """用 testsrc2 和 sine 生成带音轨的测试片段，已存在时直接复用"""
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.mp4"
+    run_ffmpeg_streaming([
+        "ffmpeg",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=1000:sample_rate=44100:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-g", str(fps * 2),
+        "-c:a", "aac", "-b:a", "128k", "-shortest",
+        "-loglevel", "error", "-y", tmp_path
+    ])
+    os.replace(tmp_path, path)
+    return path
+
+
+def ffmpeg_version():
+    try:
+        result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, check=False)
+    except OSError:
+        return None
+    return result.stdout.splitlines()[0] if result.stdout else None
+
+
+def host_info():
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": cpu_count(),
+        "python": platform.python_version(),
+        "ffmpeg": ffmpeg_version(),
+    }
+
+
+def children_usage():
+    """子进程累计的 CPU 时间（秒）和峰值常驻内存（字节）；不支持的平台返回 None"""
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    peak = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, peak
+
+
+def run_encode_case(case, work_dir):
+    """用 BatchEncoder 编码 case["files"] 个相同片段"""
+    out_dir = os.path.join(work_dir, "out", case["id"])
+    shutil.rmtree(out_dir, ignore_errors=True)
+    source = clip_path(work_dir, case["width"], case["height"], case["duration"])
+    jobs = [EncodeJob(source, os.path.join(out_dir, f"{i:03d}.mp4")) for i in range(case["files"])]
+    settings = EncodeSettings(render_mode=case["render_mode"], thread_count=case["concurrency"],
+                              segment_threshold=case.get("segment_threshold", 0))
+    profile = EncodingProfile("bench", preset=case["preset"], bitrate=settings.bitrate,
+                              maxrate=settings.maxrate, bufsize=settings.bufsize)
+    engine = BatchEncoder(settings, fast_path=False, profiles=[profile])
+    summary = engine.run(jobs)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    frames = case["files"] * case["duration"] * profile.fps
+    return summary["done"], summary["failed"], frames
+
+
+def run_merge_case(case, work_dir):
+    """用 MergeEngine 执行 case["files"] 次拼接，每次拼接 case["clips"] 个片段"""
+    out_dir = os.path.join(work_dir, "out", case["id"])
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    source = clip_path(work_dir, case["width"], case["height"], case["duration"])
+    jobs = [MergeJob(i, [source] * case["clips"], os.path.join(out_dir, f"{i:03d}.mp4"))
+            for i in range(case["files"])]
+    summary = MergeEngine(case["concurrency"]).run(iter(jobs), total=len(jobs))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    frames = case["files"] * case["clips"] * case["duration"] * CLIP_FPS
+    return summary["done"], summary["failed"], frames
+
+
+def run_case(case, work_dir):
+    """在当前进程中执行一个用例并返回测量结果"""
+    cpu_before, _ = children_usage()
+    start = time.perf_counter()
+    runner = run_encode_case if case["workload"] == "encode" else run_merge_case
+    done, failed, frames = runner(case, work_dir)
+    wall = time.perf_counter() - start
+    cpu_after, peak_rss = children_usage()
+    cpu_time = cpu_after - cpu_before if cpu_after is not None else None
+    return {
+        "case": case,
+        "wall_seconds": round(wall, 3),
+        "done": done,
+        "failed": failed,
+        "fps": round(frames / wall, 2) if wall else None,
+        "files_per_second": round(done / wall, 4) if wall else None,
+        "cpu_seconds": round(cpu_time, 3) if cpu_time is not None else None,
+        # 1.0 表示全部 CPU 核心满载
+        "cpu_utilisation": round(cpu_time / (wall * cpu_count()), 3) if cpu_time is not None and wall else None,
+        "peak_rss_bytes": peak_rss,
+    }
+
+
+def run_case_isolated(case, work_dir):
+    """在子进程中执行用例，使 CPU 时间和峰值内存只包含该用例"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "_case", work_dir, json.dumps(case)],
+        capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"用例 {case['id']} 执行失败：{result.stderr.strip()}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def build_cases(args):
+    cases = []
+    for width, height in args.resolutions:
+        for duration in args.durations:
+            media = {"width": width, "height": height, "duration": duration}
+            for concurrency in args.concurrency:
+                for preset in args.presets:
+                    case_id = f"encode_{width}x{height}_{duration}s_c{concurrency}_{preset}_{args.render_mode}"
+                    cases.append(dict(media, id=case_id, workload="encode", concurrency=concurrency,
+                                      preset=preset, render_mode=args.render_mode, files=args.files))
+                cases.append(dict(media, id=f"merge_{width}x{height}_{duration}s_c{concurrency}",
+                                  workload="merge", concurrency=concurrency, clips=args.merge_clips,
+                                  files=args.files))
+    return cases
+
+
+def run_command(args):
+    work_dir = os.path.abspath(args.work_dir)
+    for width, height in args.resolutions:
+        for duration in args.durations:
+            print(f"准备测试片段 {width}x{height} {duration}s", file=sys.stderr, flush=True)
+            generate_clip(clip_path(work_dir, width, height, duration), width, height, duration)
+
+    results = []
+    for case in build_cases(args):
+        if args.only and args.only not in case["workload"]:
+            continue
+        for repeat in range(args.repeat):
+            result = run_case_isolated(case, work_dir)
+            result["repeat"] = repeat
+            results.append(result)
+            print(f"{case['id']}: {result['wall_seconds']:.2f}s，{result['fps']} fps，"
+                  f"{result['files_per_second']} 个/秒", file=sys.stderr, flush=True)
+
+    report = {
+        "version": BENCH_VERSION,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": host_info(),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+def best_by_case(report):
+    """同一用例多次重复时取最快的一次"""
+    best = {}
+    for result in report["results"]:
+        case_id = result["case"]["id"]
+        if case_id not in best or result["wall_seconds"] < best[case_id]["wall_seconds"]:
+            best[case_id] = result
+    return best
+
+
+def compare_command(args):
+    """逐个用例比较耗时，比基线慢超过 tolerance 时返回 1"""
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = best_by_case(json.load(f))
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = best_by_case(json.load(f))
+    regressions = 0
+    for case_id in sorted(set(baseline) & set(current)):
+        before = baseline[case_id]["wall_seconds"]
+        after = current[case_id]["wall_seconds"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + args.tolerance:
+            flag = "  变慢"
+            regressions += 1
+        elif ratio < 1 - args.tolerance:
+            flag = "  变快"
+        print(f"{case_id}: {before:.2f}s -> {after:.2f}s ({ratio:.2f}x){flag}")
+    return 1 if regressions else 0
+
+
+def parse_resolution(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="编码与拼接吞吐量基准测试")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="运行基准测试")
+    run.add_argument("--work-dir", default=DEFAULT_WORK_DIR, help="测试片段和临时输出目录")
+    run.add_argument("--output", help="结果 JSON 路径，默认输出到标准输出")
+    run.add_argument("--resolutions", default="1920x1080,1280x720",
+                     type=lambda v: parse_list(v, parse_resolution), help="源片段分辨率列表")
+    run.add_argument("--durations", default="10,60", type=lambda v: parse_list(v, int), help="源片段时长（秒）列表")
+    run.add_argument("--concurrency", default="1,2,4", type=lambda v: parse_list(v, int), help="并发数列表")
+    run.add_argument("--presets", default="veryfast,medium", type=parse_list, help="x264 预设列表")
+    run.add_argument("--render-mode", default="cpu", choices=["cpu", "gpu", "mixed"])
+    run.add_argument("--files", type=int, default=4, help="每个用例处理的文件数")
+    run.add_argument("--merge-clips", type=int, default=5, help="每次拼接的片段数")
+    run.add_argument("--repeat", type=int, default=1, help="每个用例重复次数")
+    run.add_argument("--only", choices=["encode", "merge"], help="只运行一类用例")
+
+    compare = commands.add_parser("compare", help="与基线结果比较")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--tolerance", type=float, default=0.05, help="允许的相对波动")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "_case":
+        print(json.dumps(run_case(json.loads(argv[2]), argv[1])))
+        return 0
+    args = parse_args(argv)
+    try:
+        return {"run": run_command, "compare": compare_command}[args.command](args)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import hashlib
+
+from json_manifest import JsonManifest, is_current, stat_identity
+
+# 缓存清单默认保存在输出文件夹中，随输出一起迁移
+CACHE_FILE_NAME = ".encode_cache.json"
+CACHE_VERSION = 2
+# 部分内容哈希只读取文件头尾各 1MB
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def partial_hash(path, chunk_size=HASH_CHUNK_SIZE):
+    """计算文件头尾片段加文件大小的哈希，避免读取整个大文件"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size * 2:
+            f.seek(-chunk_size, os.SEEK_END)
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def params_fingerprint(params):
+    """编码参数（不含输入输出路径）的指纹"""
+    return hashlib.sha1(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class EncodeCache(JsonManifest):
+    """持久化的编码结果清单
+
+    以源文件路径为键，记录源文件身份（大小、修改时间、可选的部分内容哈希）、
+    编码参数指纹以及每个输出文件的大小和修改时间。只有源文件和参数都未变化、
+    且全部输出文件仍与记录一致时才视为命中。
+    """
+
+    VERSION = CACHE_VERSION
+
+    def __init__(self, path, content_hash=False):
+        self.content_hash = content_hash
+        super().__init__(path)
+
+    def _source_identity(self, input_path, entry=None):
+        """返回源文件身份；大小和修改时间未变时复用已记录的哈希"""
+        st = os.stat(input_path)
+        identity = stat_identity(st)
+        if self.content_hash:
+            if is_current(entry, st) and entry.get("hash"):
+                identity["hash"] = entry["hash"]
+            else:
+                identity["hash"] = partial_hash(input_path)
+        return identity
+
+    def is_fresh(self, input_path, output_paths, params):
+        """判断该任务是否可以跳过"""
+        with self._lock:
+            entry = self.entries.get(input_path)
+        if not entry or [output[0] for output in entry.get("outputs", [])] != list(output_paths):
+            return False
+        if entry.get("params") != params_fingerprint(params):
+            return False
+        try:
+            identity = self._source_identity(input_path, entry)
+            for output_path, size, mtime in entry["outputs"]:
+                out_st = os.stat(output_path)
+                if out_st.st_size == 0 or out_st.st_size != size or out_st.st_mtime_ns != mtime:
+                    return False
+        except OSError:
+            return False
+        if identity["size"] != entry.get("size"):
+            return False
+        if identity["mtime"] != entry.get("mtime"):
+            # 只改了修改时间（如复制、touch），内容哈希一致时仍然命中
+            if not self.content_hash or identity["hash"] != entry.get("hash"):
+                return False
+            with self._lock:
+                entry["mtime"] = identity["mtime"]
+                self.dirty = True
+        return True
+
+    def record(self, input_path, output_paths, params):
+        """编码成功后记录结果"""
+        try:
+            identity = self._source_identity(input_path)
+            outputs = []
+            for output_path in output_paths:
+                out_st = os.stat(output_path)
+                outputs.append([output_path, out_st.st_size, out_st.st_mtime_ns])
+        except OSError:
+            return
+        entry = dict(identity)
+        entry.update({
+            "outputs": outputs,
+            "params": params_fingerprint(params),
+            "time": time.time(),
+        })
+        with self._lock:
+            self.entries[input_path] = entry
+            self.dirty = True
+
+    def forget(self, input_path):
+        with self._lock:
+            if self.entries.pop(input_path, None) is not None:
+                self.dirty = True
+
+    def evict_stale(self, max_age_days=None):
+        """清除源文件或输出文件已不存在、或超过保留天数的条目，返回清除数量"""
+        now = time.time()
+        with self._lock:
+            items = list(self.entries.items())
+        stale = []
+        for input_path, entry in items:
+            if max_age_days is not None and now - entry.get("time", 0) > max_age_days * 86400:
+                stale.append(input_path)
+            elif not os.path.exists(input_path) or not all(
+                    os.path.exists(output[0]) for output in entry.get("outputs", [])):
+                stale.append(input_path)
+        with self._lock:
+            for input_path in stale:
+                self.entries.pop(input_path, None)
+            if stale:
+                self.dirty = True
+        return len(stale)
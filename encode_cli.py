@@ -0,0 +1,333 @@
+"""命令行批量编码入口（无需图形界面）
+
+用法:
+    python encode_cli.py job.json
+    python encode_cli.py --source 源目录 --output 输出目录 --render-mode mixed
+
+任务描述文件为 JSON（安装 PyYAML 后也支持 YAML），示例:
+    {
+        "source_folder": "/data/in",
+        "output_folder": "/data/out",
+        "settings": {"bitrate": "3M", "maxrate": "5M", "bufsize": "5M",
+                     "audio_bitrate": "128k", "render_mode": "cpu", "thread_count": 0}
+    }
+可选 "files" 字段直接给出待编码文件列表，此时不再扫描源目录。
+可选 "cache" 字段配置编码缓存，如 {"path": "...", "content_hash": true, "max_age_days": 30}，
+设为 false 则关闭缓存；默认缓存清单保存在输出文件夹的 .encode_cache.json。
+可选 "renditions" 字段列出要输出的编码规格名（内置 vertical_1080p / vertical_720p / vertical_540p），
+"profiles" 字段以 {名称: {"width": ..., "height": ..., "crf": ...}} 定义或覆盖规格；
+多个规格时每个源文件只解码一次，分别输出到输出文件夹下以规格名命名的子文件夹。
+可选 "fast_path": false 关闭快速路径（源文件已符合目标时直接封装或只重编码音频）。
+可选 "hw_decode": false 关闭显卡模式下的硬件解码（默认在能力允许时全程在显卡上解码、缩放和编码）。
+可选 "journal" 字段指定任务日志路径（false 关闭），"resume": true 时只调度上次未完成的任务。
+可选 "file_index" 字段指定文件索引路径（false 关闭，默认为当前目录的 file_index.sqlite3），
+再次扫描时只重新列出有变化的目录；"stream": true 时边扫描边编码，不必等整个目录树遍历完。
+可选 "metrics" 字段记录各阶段耗时，如 {"jsonl": "metrics.jsonl", "prometheus": "metrics.prom", "port": 9464}：
+jsonl 逐条追加 JSON Lines，prometheus 为批次结束时写出的文本文件，port 在该端口提供 /metrics。
+可选 "staging" 字段配置输出暂存，如 {"scratch": "/local/tmp", "copy_workers": 2, "min_free_gb": 2}：
+先在本地暂存目录中编码，再由后台复制线程移动到输出文件夹；开始每个任务前按码率 × 时长估算输出大小，
+磁盘剩余空间不足 min_free_gb（配置 scratch 时默认 2，否则默认 0）或复制跟不上时暂停调度。
+未配置 scratch 时直接写入输出文件夹，只做空间检查。
+settings 中的 "quality_target"（如 93）开启目标质量模式：按片源采样搜索满足目标的最低码率，
+"quality_metric" 为 vmaf（默认，没有 libvmaf 时改用 ssim）/ ssim / psnr；
+搜索结果保存在输出文件夹的 .quality_cache.json，源文件未变化时直接复用。
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+import threading
+
+from encode_cache import CACHE_FILE_NAME, EncodeCache
+from encode_journal import JOURNAL_FILE_NAME, EncodeJournal
+from encode_profiles import resolve_profiles
+from media_probe import MEDIA_INDEX_FILE_NAME, MediaIndex
+from encode_engine import BatchEncoder, EncodeSettings, build_jobs, iter_video_files, scan_video_files
+from file_index import FILE_INDEX_FILE, FileIndex, iter_batches
+from pipeline_metrics import PipelineMetrics
+from output_staging import DEFAULT_COPY_WORKERS, OutputStager
+from quality_search import QUALITY_CACHE_FILE_NAME, QualityCache
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def load_job_spec(path):
+    """读取 JSON / YAML 任务描述"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise RuntimeError("读取 YAML 任务描述需要安装 PyYAML")
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="视频批量编码（命令行）")
+    parser.add_argument("spec", nargs="?", help="JSON/YAML 任务描述文件")
+    parser.add_argument("--source", help="源文件夹")
+    parser.add_argument("--output", help="输出文件夹")
+    parser.add_argument("--bitrate", help="视频比特率，如 3M")
+    parser.add_argument("--maxrate", help="最大比特率")
+    parser.add_argument("--bufsize", help="缓冲区大小")
+    parser.add_argument("--audio-bitrate", dest="audio_bitrate", help="音频比特率，如 128k")
+    parser.add_argument("--render-mode", dest="render_mode", choices=["cpu", "gpu", "mixed"],
+                        help="渲染方式，mixed 同时使用 NVENC 和 CPU")
+    parser.add_argument("--threads", dest="thread_count", type=int, help="并发编码数，0 为按机器资源自动决定")
+    parser.add_argument("--ffmpeg-threads", dest="ffmpeg_threads", type=int,
+                        help="每个 ffmpeg 进程的 -threads，0 为自动")
+    parser.add_argument("--nvenc-sessions", dest="nvenc_sessions", type=int, help="NVENC 并发会话数")
+    parser.add_argument("--segment-threshold", dest="segment_threshold", type=float,
+                        help="时长不少于该秒数的视频分段并行编码，0 为关闭")
+    parser.add_argument("--quality-target", dest="quality_target", type=float,
+                        help="目标质量分数（如 VMAF 93），按片源搜索满足目标的最低码率，0 为关闭")
+    parser.add_argument("--quality-metric", dest="quality_metric", choices=["vmaf", "ssim", "psnr"],
+                        help="目标质量使用的指标，默认 vmaf")
+    parser.add_argument("--cache", dest="cache_path", help="编码缓存清单路径")
+    parser.add_argument("--no-cache", action="store_true", help="不使用编码缓存，全部重新编码")
+    parser.add_argument("--content-hash", action="store_true", default=None,
+                        help="缓存额外比对源文件头尾内容哈希")
+    parser.add_argument("--cache-max-age", type=float, help="清除超过指定天数的缓存条目")
+    parser.add_argument("--profile", dest="renditions", action="append",
+                        help="输出的编码规格名，可重复指定以一次解码输出多个规格")
+    parser.add_argument("--no-fast-path", action="store_true", help="总是完整重编码，不走直接封装快速路径")
+    parser.add_argument("--no-hw-decode", action="store_true", help="显卡模式下仍在 CPU 上解码和缩放")
+    parser.add_argument("--journal", dest="journal_path", help="任务日志路径")
+    parser.add_argument("--resume", action="store_true", help="续传：跳过任务日志中已完成的文件")
+    parser.add_argument("--file-index", dest="file_index_path", help="文件索引路径")
+    parser.add_argument("--no-file-index", action="store_true", help="不使用文件索引，每次完整扫描")
+    parser.add_argument("--stream", action="store_true", help="边扫描边编码")
+    parser.add_argument("--metrics-jsonl", dest="metrics_jsonl", help="阶段耗时记录（JSON Lines）路径")
+    parser.add_argument("--metrics-prom", dest="metrics_prometheus", help="Prometheus 文本格式指标文件路径")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="在该端口提供 /metrics")
+    parser.add_argument("--scratch", dest="staging_scratch", help="本地暂存目录，编码完成后再复制到输出文件夹")
+    parser.add_argument("--copy-workers", dest="staging_copy_workers", type=int, help="后台复制线程数")
+    parser.add_argument("--min-free-gb", dest="staging_min_free_gb", type=float,
+                        help="各磁盘至少保留的可用空间（GB），不足时暂停调度；默认配置暂存目录时为 2，否则为 0")
+    return parser.parse_args(argv)
+
+
+def build_spec(args):
+    """合并任务描述文件与命令行参数，命令行优先"""
+    spec = load_job_spec(args.spec) if args.spec else {}
+    spec.setdefault("settings", {})
+    if args.source:
+        spec["source_folder"] = args.source
+    if args.output:
+        spec["output_folder"] = args.output
+    for key in EncodeSettings.FIELDS:
+        value = getattr(args, key, None)
+        if value is not None:
+            spec["settings"][key] = value
+
+    cache = spec.get("cache", {})
+    if args.no_cache:
+        cache = False
+    elif cache is not False:
+        cache = dict(cache) if isinstance(cache, dict) else {}
+        if args.cache_path:
+            cache["path"] = args.cache_path
+        if args.content_hash is not None:
+            cache["content_hash"] = args.content_hash
+        if args.cache_max_age is not None:
+            cache["max_age_days"] = args.cache_max_age
+    spec["cache"] = cache
+
+    if args.journal_path:
+        spec["journal"] = args.journal_path
+    if args.resume:
+        spec["resume"] = True
+    if args.no_fast_path:
+        spec["fast_path"] = False
+    if args.no_hw_decode:
+        spec["hw_decode"] = False
+    if args.renditions:
+        spec["renditions"] = args.renditions
+    if args.no_file_index:
+        spec["file_index"] = False
+    elif args.file_index_path:
+        spec["file_index"] = args.file_index_path
+    if args.stream:
+        spec["stream"] = True
+    metrics = dict(spec.get("metrics") or {})
+    for key in ("jsonl", "prometheus", "port"):
+        value = getattr(args, f"metrics_{key}", None)
+        if value is not None:
+            metrics[key] = value
+    spec["metrics"] = metrics
+    staging = dict(spec.get("staging") or {})
+    for key in ("scratch", "copy_workers", "min_free_gb"):
+        value = getattr(args, f"staging_{key}", None)
+        if value is not None:
+            staging[key] = value
+    spec["staging"] = staging
+    return spec
+
+
+def open_cache(spec, output_folder):
+    """按任务描述打开编码缓存，未启用时返回 None"""
+    options = spec.get("cache")
+    if options is False:
+        return None
+    path = options.get("path") or os.path.join(output_folder, CACHE_FILE_NAME)
+    cache = EncodeCache(path, content_hash=bool(options.get("content_hash")))
+    evicted = cache.evict_stale(options.get("max_age_days"))
+    if evicted:
+        print(f"清除 {evicted} 条过期缓存", flush=True)
+    return cache
+
+
+def open_journal(spec, output_folder):
+    """按任务描述打开任务日志，未启用时返回 None"""
+    path = spec.get("journal", True)
+    if path is False:
+        return None
+    if path is True:
+        path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    return EncodeJournal(path)
+
+
+def open_file_index(spec):
+    """按任务描述打开文件索引，未启用时返回 None"""
+    path = spec.get("file_index", True)
+    if path is False:
+        return None
+    return FileIndex(FILE_INDEX_FILE if path is True else path)
+
+
+def open_metrics(spec):
+    """按任务描述创建阶段统计，未配置任何输出时返回 None"""
+    options = spec.get("metrics") or {}
+    if not any(options.get(key) for key in ("jsonl", "prometheus", "port")):
+        return None
+    metrics = PipelineMetrics(options.get("jsonl"), options.get("prometheus"))
+    if options.get("port"):
+        metrics.serve(int(options["port"]))
+    return metrics
+
+
+def open_stager(spec, metrics=None):
+    """按任务描述创建输出暂存"""
+    options = spec.get("staging") or {}
+    min_free = options.get("min_free_gb")
+    return OutputStager(options.get("scratch"), options.get("copy_workers") or DEFAULT_COPY_WORKERS,
+                        None if min_free is None else int(min_free * 1024 ** 3), metrics=metrics)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def make_event_printer(throughput_interval=5.0):
+    """返回把引擎事件输出到终端的回调，吞吐量信息至多每 throughput_interval 秒输出一次"""
+    last_report = [0.0]
+    # 事件来自多个工作线程，加锁避免输出行相互穿插
+    lock = threading.Lock()
+
+    def print_event(event):
+        with lock:
+            _print_event(event)
+
+    def _print_event(event):
+        timestamp = event["time"].strftime("[%H:%M:%S]")
+        if event["type"] == "log":
+            print(f"{timestamp} {event['message']}", flush=True)
+        elif event["type"] == "progress":
+            print(f"{timestamp} 进度: {event['done']}/{event['total']}", flush=True)
+        elif event["type"] == "job_progress":
+            now = time.monotonic()
+            if now - last_report[0] < throughput_interval:
+                return
+            last_report[0] = now
+            batch = event["batch"]
+            eta = format_seconds(batch["eta"]) if batch["eta"] is not None else "未知"
+            print(f"{timestamp} 吞吐: {batch['fps']:.1f} fps，速度 {batch['speed'] or 0:.2f}x，"
+                  f"预计剩余 {eta}", flush=True)
+
+    return print_event
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        spec = build_spec(args)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"读取任务描述失败: {e}", file=sys.stderr)
+        return 2
+
+    source_folder = spec.get("source_folder")
+    output_folder = spec.get("output_folder")
+    if not source_folder or not output_folder:
+        print("错误: 必须指定源文件夹和输出文件夹", file=sys.stderr)
+        return 2
+
+    settings = EncodeSettings.from_dict(spec["settings"])
+    try:
+        profiles = resolve_profiles(spec["renditions"], spec.get("profiles")) if spec.get("renditions") else None
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+    file_index = open_file_index(spec)
+    metrics = open_metrics(spec)
+    stream = bool(spec.get("stream")) and not spec.get("files")
+    if not stream:
+        scan_start = time.perf_counter()
+        video_files = spec.get("files") or scan_video_files(source_folder, file_index)
+        if metrics is not None and not spec.get("files"):
+            metrics.record("scan", time.perf_counter() - scan_start, job=source_folder, files=len(video_files))
+        if file_index is not None:
+            file_index.close()
+            file_index = None
+        print(f"找到 {len(video_files)} 个视频文件", flush=True)
+        if not video_files:
+            if metrics is not None:
+                metrics.close()
+            return 0
+
+    journal = open_journal(spec, output_folder)
+    stager = open_stager(spec, metrics)
+    if stager.reclaimed:
+        print(f"清理 {stager.reclaimed} 个上次中断遗留的暂存目录", flush=True)
+    media_index = MediaIndex(os.path.join(output_folder, MEDIA_INDEX_FILE_NAME))
+    engine = BatchEncoder(settings, on_event=make_event_printer(), cache=open_cache(spec, output_folder),
+                          journal=journal, resume=bool(spec.get("resume")),
+                          media_index=media_index, fast_path=spec.get("fast_path", True),
+                          hw_decode=spec.get("hw_decode", True),
+                          profiles=profiles, metrics=metrics, stager=stager,
+                          quality_cache=QualityCache(os.path.join(output_folder, QUALITY_CACHE_FILE_NAME)))
+    # Ctrl+C 只请求取消，由引擎结束 FFmpeg 进程组并等待其退出
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: engine.cancel())
+    try:
+        if stream:
+            batches = iter_batches(iter_video_files(source_folder, file_index),
+                                   should_stop=lambda: engine.cancel_task)
+            summary = engine.run_stream(
+                build_jobs(batch, source_folder, output_folder, engine.profiles) for batch in batches
+            )
+        else:
+            summary = engine.run(build_jobs(video_files, source_folder, output_folder, engine.profiles))
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+        stager.close()
+        if journal is not None:
+            journal.close()
+        if file_index is not None:
+            file_index.close()
+        if metrics is not None:
+            metrics.close()
+    if summary["cancelled"]:
+        print("任务已取消", file=sys.stderr)
+        return 130
+
+    print(f"完成 {summary['done']}/{summary['total']}，跳过 {summary['skipped']}，"
+          f"失败 {summary['failed']}", flush=True)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
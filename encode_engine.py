@@ -0,0 +1,845 @@
+import os
+import time
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from media_probe import STRATEGY_AUDIO, STRATEGY_COPY, STRATEGY_ENCODE, MediaIndex, parse_bitrate
+from encode_profiles import EncodingProfile, hardware_pipeline
+from ffmpeg_runner import FFmpegError, ThroughputTracker, run_ffmpeg_streaming, terminate_processes
+from encode_scheduler import DEFAULT_NVENC_SESSIONS, ResourceScheduler, order_longest_first
+from ffmpeg_capabilities import get_capabilities
+from pipeline_metrics import file_size
+from quality_search import QualityCache, QualitySearch
+from output_staging import OutputStager, estimate_output_size
+from segment_encode import SegmentedJob, SegmentTask, plan_segments, probe_keyframes
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.webm')
+# 编码过程中每完成该数量的任务或距上次保存超过该秒数时保存一次缓存，进程被强制结束时已完成的任务不会丢失
+CACHE_CHECKPOINT_JOBS = 5
+CACHE_CHECKPOINT_SECONDS = 10
+
+
+def is_video_file(name):
+    """是否为待编码的视频文件（忽略编码中的临时文件）"""
+    return name.lower().endswith(VIDEO_EXTENSIONS) and not name.endswith(".partial.mp4")
+
+
+def iter_video_files(source_folder, file_index=None):
+    """递归扫描文件夹，边遍历边产出视频文件；给出 file_index 时只重新列出有变化的目录"""
+    walk = file_index.walk if file_index is not None else os.walk
+    for root, _, files in walk(source_folder):
+        for file in files:
+            if is_video_file(file):
+                yield os.path.join(root, file)
+
+
+def scan_video_files(source_folder, file_index=None):
+    """递归扫描文件夹中的视频文件"""
+    return list(iter_video_files(source_folder, file_index))
+
+
+class EncodeSettings:
+    """编码参数（与界面上的输入框一一对应）
+
+    render_mode 为 cpu / gpu / mixed；thread_count 为 0 时按机器资源自动决定并发数，
+    ffmpeg_threads 为 0 时由调度器决定每个 ffmpeg 进程的 -threads。
+    时长不少于 segment_threshold 秒的视频分段并行编码，为 0 时关闭分段。
+    quality_target 不为 0 时按片源搜索满足该质量（quality_metric 为 vmaf / ssim / psnr）的最低码率，
+    bitrate 等设置只作为上限。
+    """
+
+    FIELDS = ("bitrate", "maxrate", "bufsize", "audio_bitrate", "render_mode", "thread_count",
+              "ffmpeg_threads", "nvenc_sessions", "segment_threshold", "quality_target", "quality_metric")
+
+    def __init__(self, bitrate="3M", maxrate="5M", bufsize="5M", audio_bitrate="128k",
+                 render_mode="cpu", thread_count=0, ffmpeg_threads=0,
+                 nvenc_sessions=DEFAULT_NVENC_SESSIONS, segment_threshold=600,
+                 quality_target=0, quality_metric="vmaf"):
+        self.bitrate = bitrate
+        self.maxrate = maxrate
+        self.bufsize = bufsize
+        self.audio_bitrate = audio_bitrate
+        self.render_mode = render_mode
+        self.thread_count = max(0, int(thread_count))
+        self.ffmpeg_threads = max(0, int(ffmpeg_threads))
+        self.nvenc_sessions = max(1, int(nvenc_sessions))
+        self.segment_threshold = max(0, float(segment_threshold))
+        self.quality_target = max(0, float(quality_target or 0))
+        self.quality_metric = quality_metric
+
+    @classmethod
+    def from_dict(cls, data):
+        """从任务描述字典创建设置，忽略未知字段"""
+        return cls(**{key: data[key] for key in cls.FIELDS if key in data})
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+
+class EncodeJob:
+    """单个源文件的编码任务
+
+    renditions 为 [(编码规格, 输出路径), ...]，一次解码同时输出全部规格；
+    规格为 None 时使用引擎的默认规格。output_path 为第一个输出。
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    CANCELLED = "cancelled"
+
+    def __init__(self, input_path, output_path, renditions=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.renditions = renditions or [(None, output_path)]
+        self.status = self.QUEUED
+        self.error = None
+        self.duration = None
+        self.media = None
+        self.strategy = STRATEGY_ENCODE
+        # 由调度器在分配槽位时决定：device 为 "cpu" 或 "gpu"
+        self.device = None
+        self.threads = None
+        # 目标质量模式下按片源调整后的规格，{规格序号: 编码规格}
+        self.tuned_profiles = {}
+        # 分配到 GPU 槽位时使用的全 GPU 流水线，为 None 时软件解码和缩放
+        self.hardware = None
+        # 开始前在输出磁盘上预留的空间
+        self.reservation = None
+
+    @property
+    def output_paths(self):
+        return [path for _, path in self.renditions]
+
+    def __repr__(self):
+        return f"EncodeJob({self.input_path!r} -> {self.output_path!r}, {self.status})"
+
+
+def build_jobs(video_files, source_folder, output_folder, profiles=None):
+    """按源目录结构把视频文件映射为输出路径
+
+    有多个编码规格时，每个规格输出到输出文件夹下以规格名命名的子文件夹。
+    """
+    jobs = []
+    for video_file in video_files:
+        relative_path = os.path.splitext(os.path.relpath(video_file, source_folder))[0] + ".mp4"
+        if profiles and len(profiles) > 1:
+            renditions = [(profile, os.path.join(output_folder, profile.name, relative_path))
+                          for profile in profiles]
+        else:
+            renditions = [(profiles[0] if profiles else None, os.path.join(output_folder, relative_path))]
+        jobs.append(EncodeJob(video_file, renditions[0][1], renditions))
+    return jobs
+
+
+class BatchEncoder:
+    """批量编码引擎
+
+    不依赖任何界面组件。进度通过 on_event 回调以字典形式发布，
+    回调在工作线程中被调用，界面端需要自行切回主线程。
+    给出 metrics（PipelineMetrics）时记录各阶段耗时，批次结束时输出汇总。
+    GPU 槽位上的任务在能力允许时全程在显卡上解码、缩放和编码，hw_decode=False 时关闭。
+    stager（OutputStager）决定输出先写到哪里、如何移动到输出文件夹，并在开始任务前检查磁盘空间。
+    publish_check(job) 在输出移动到位前调用，返回假时放弃输出并把任务视为已取消（多机编码时确认租约仍然有效）。
+    """
+
+    def __init__(self, settings, on_event=None, cache=None, journal=None, resume=False,
+                 media_index=None, fast_path=True, profiles=None, metrics=None, quality_cache=None,
+                 capabilities=None, hw_decode=True, stager=None, publish_check=None):
+        self.settings = settings
+        self.profiles = profiles or [EncodingProfile.from_settings(settings)]
+        self.on_event = on_event
+        self.cache = cache
+        self.journal = journal
+        self.resume = resume
+        self.media_index = media_index if media_index is not None else MediaIndex()
+        self.fast_path = fast_path
+        self.hw_decode = hw_decode
+        self.metrics = metrics
+        self.stager = stager if stager is not None else OutputStager(metrics=metrics)
+        self.quality_cache = quality_cache if quality_cache is not None else QualityCache()
+        # 为 None 时在需要时使用进程内共享的检测结果
+        self.capabilities = capabilities
+        self.publish_check = publish_check
+        self.cancel_task = False
+        self.tracker = ThroughputTracker()
+        self._lock = threading.Lock()
+        # {FFmpeg 进程: 所属任务}
+        self._processes = {}
+        self._cancelled_jobs = set()
+        self._unsaved_records = 0
+        self._cache_saved_at = time.monotonic()
+        # run() 期间的进度回调，任务到达最终状态时调用
+        self._advance = None
+
+    def emit(self, event_type, **data):
+        """发布一个进度事件"""
+        if self.on_event is None:
+            return
+        data["type"] = event_type
+        data.setdefault("time", datetime.datetime.now())
+        self.on_event(data)
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    def cancel(self):
+        """取消批次：不再发放新任务，并在后台结束所有正在运行的 FFmpeg 进程
+
+        立即返回；run() 会在运行中的进程退出（至多等待宽限期）后返回。
+        """
+        self.cancel_task = True
+        with self._lock:
+            processes = list(self._processes)
+        if processes:
+            threading.Thread(target=terminate_processes, args=(processes,), daemon=True).start()
+
+    def cancel_job(self, job):
+        """只取消一个任务（如多机编码时租约已丢失）：结束其 FFmpeg 进程，尚未开始时不再调度"""
+        with self._lock:
+            self._cancelled_jobs.add(job)
+            processes = [process for process, owner in self._processes.items() if owner is job]
+        if processes:
+            threading.Thread(target=terminate_processes, args=(processes,), daemon=True).start()
+
+    def _stopped(self, job):
+        """整个批次或该任务已被取消"""
+        return self.cancel_task or job in self._cancelled_jobs
+
+    def _register_process(self, process, job=None):
+        with self._lock:
+            self._processes[process] = job
+        # 进程启动与取消请求之间的竞争：启动后发现已取消则立即结束
+        if self.cancel_task or (job is not None and job in self._cancelled_jobs):
+            threading.Thread(target=terminate_processes, args=([process],), daemon=True).start()
+
+    def _unregister_processes(self, processes):
+        with self._lock:
+            for process in processes:
+                self._processes.pop(process, None)
+
+    def job_renditions(self, job):
+        """任务的 [(编码规格, 输出路径)]，未指定规格时使用默认规格，目标质量模式下使用调整后的规格"""
+        return [(job.tuned_profiles.get(i) or profile or self.profiles[0], path)
+                for i, (profile, path) in enumerate(job.renditions)]
+
+    def build_command(self, job, output_paths=None):
+        """生成单个任务的 FFmpeg 命令
+
+        output_paths 默认为任务的正式输出路径；多个规格时用 split 滤镜一次解码、多路输出。
+        """
+        settings = self.settings
+        outputs = [(profile, path) for (profile, _), path in
+                   zip(self.job_renditions(job), output_paths or job.output_paths)]
+        profile, output_path = outputs[0]
+        if job.strategy == STRATEGY_COPY:
+            return [
+                "ffmpeg", "-i", job.input_path,
+                "-c", "copy", "-sn", "-dn",
+                "-movflags", "faststart",
+                "-loglevel", "error",
+                "-y", output_path
+            ]
+        if job.strategy == STRATEGY_AUDIO:
+            return [
+                "ffmpeg", "-i", job.input_path,
+                "-c:v", "copy",
+                *profile.audio_args(), "-sn", "-dn",
+                "-movflags", "faststart",
+                "-loglevel", "error",
+                "-y", output_path
+            ]
+
+        device = job.device or ("gpu" if settings.render_mode == "gpu" else "cpu")
+        hardware = job.hardware if device == "gpu" else None
+        input_args = ["ffmpeg", *(hardware.input_args() if hardware else ()), "-i", job.input_path]
+
+        def scale_filter(profile):
+            return hardware.scale_filter(profile) if hardware else profile.scale_filter()
+
+        if len(outputs) == 1:
+            return [
+                *input_args,
+                "-vf", scale_filter(profile), "-r", str(profile.fps),
+                *profile.video_args(device, job.threads),
+                *profile.audio_args(),
+                "-movflags", "faststart",
+                "-loglevel", "error",
+                "-y", output_path
+            ]
+
+        labels = "".join(f"[s{i}]" for i in range(len(outputs)))
+        graph = f"[0:v]split={len(outputs)}{labels};" + ";".join(
+            f"[s{i}]{scale_filter(profile)}[v{i}]" for i, (profile, _) in enumerate(outputs))
+        command = [*input_args, "-filter_complex", graph, "-loglevel", "error", "-y"]
+        for i, (profile, path) in enumerate(outputs):
+            command += [
+                "-map", f"[v{i}]", "-map", "0:a?", "-r", str(profile.fps),
+                *profile.video_args(device, job.threads),
+                *profile.audio_args(),
+                "-movflags", "faststart",
+                path
+            ]
+        return command
+
+    def command_params(self, job):
+        """去掉输入输出路径后的命令参数，用作缓存键的一部分
+
+        不包含调度器按槽位决定的设备和线程数，也不包含快速路径策略和硬件解码
+        （两者完全由源文件和设置决定），混合模式下以渲染方式区分。
+        """
+        placeholders = {job.input_path: "{input}"}
+        for i, path in enumerate(job.output_paths):
+            placeholders[path] = f"{{output{i}}}" if i else "{output}"
+        command = self.build_command(EncodeJob(job.input_path, job.output_path, job.renditions))
+        # -y 只影响是否覆盖任务私有的临时文件，与输出内容无关
+        params = [placeholders.get(arg, arg) for arg in command if arg != "-y"]
+        if self.settings.render_mode == "mixed":
+            params.append("render_mode=mixed")
+        if self.settings.quality_target:
+            params.append(f"quality={self.settings.quality_metric}:{self.settings.quality_target}")
+        return params
+
+    def run_ffmpeg(self, command, job=None, unit=None, stage="encode", source=None, outputs=(), owner=None):
+        """运行FFmpeg命令，并把流式进度发布为 job_progress 事件
+
+        unit 为进度统计单位（分段编码时为分段），默认即任务本身。
+        stage / source / outputs 用于阶段统计：阶段名、输入文件和输出文件。
+        owner 为进程所属的任务（默认为 job），cancel_job() 据此结束进程。
+        """
+        unit = unit or job
+        owner = owner or job
+        duration = unit.duration if unit is not None else None
+        last_speed = [None]
+
+        def on_progress(progress):
+            last_speed[0] = progress.get("speed") or last_speed[0]
+            if job is None:
+                return
+            self.tracker.update(unit, progress)
+            self.emit("job_progress", job=job, batch=self.tracker.snapshot(), **progress)
+
+        processes = []
+
+        def on_start(process):
+            processes.append(process)
+            self._register_process(process, owner)
+
+        start = time.perf_counter()
+        exit_code = 0
+        stopped = (lambda: self._stopped(owner)) if owner is not None else (lambda: self.cancel_task)
+        try:
+            run_ffmpeg_streaming(command, on_progress=on_progress, duration=duration, on_start=on_start)
+            self.log("FFmpeg 命令执行成功")
+        except FFmpegError as e:
+            exit_code = e.returncode
+            if not stopped():
+                self.log(f"FFmpeg 错误：{e.stderr.strip()}")
+            raise
+        except Exception:
+            exit_code = None
+            raise
+        finally:
+            self._unregister_processes(processes)
+            if unit is not None:
+                self.tracker.finish(unit, duration)
+            if self.metrics is not None:
+                status = "ok" if exit_code == 0 else ("cancelled" if stopped() else "error")
+                bytes_out = sum(file_size(path) or 0 for path in outputs) if exit_code == 0 else None
+                self.metrics.record(
+                    stage, time.perf_counter() - start,
+                    job=source or (job.input_path if job is not None else None),
+                    bytes_in=file_size(source or job.input_path) if stage == "encode" and job else None,
+                    bytes_out=bytes_out, status=status, exit_code=exit_code, speed=last_speed[0],
+                    device=job.device if job is not None else None, media_seconds=duration,
+                    strategy=job.strategy if job is not None and stage == "encode" else None
+                )
+
+    def _mark(self, job, state):
+        job.status = state
+        if self.journal is not None:
+            self.journal.mark(job, state, job.error)
+
+    def _begin(self, job):
+        """创建输出目录并把任务标记为运行中，返回各输出的临时路径"""
+        tmp_paths = []
+        for output_path in job.output_paths:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tmp_paths.append(self.stager.staged_path(output_path))
+        self._mark(job, EncodeJob.RUNNING)
+        self.emit("job_started", job=job)
+        return tmp_paths
+
+    def _job_done(self, job, tmp_paths):
+        """把临时文件移动为正式输出（暂存时由后台复制），到位后再记录结果"""
+        def on_published(error):
+            if error is not None:
+                if not self._stopped(job):
+                    self.log(f"移动输出文件失败: {error}")
+                self._job_failed(job, error, tmp_paths)
+                return
+            self._mark(job, EncodeJob.DONE)
+            if self.cache is not None:
+                self.cache.record(job.input_path, job.output_paths, self.command_params(job))
+                self._checkpoint_cache()
+            self.log(f"成功编码: {job.input_path}")
+            self.emit("job_done", job=job)
+            self._job_finished()
+
+        def check():
+            if self._stopped(job):
+                return False
+            try:
+                if self.publish_check(job):
+                    return True
+            except Exception as e:
+                self.log(f"无法确认是否可以写入输出，放弃结果: {job.input_path}（{e}）")
+            self.cancel_job(job)
+            return False
+
+        self.stager.commit(job.reservation, list(zip(tmp_paths, job.output_paths)), on_published,
+                           check if self.publish_check is not None else None)
+
+    def _checkpoint_cache(self):
+        """按完成数量或时间间隔保存缓存"""
+        with self._lock:
+            self._unsaved_records += 1
+            now = time.monotonic()
+            if self._unsaved_records < CACHE_CHECKPOINT_JOBS and \
+                    now - self._cache_saved_at < CACHE_CHECKPOINT_SECONDS:
+                return
+            self._unsaved_records = 0
+            self._cache_saved_at = now
+        try:
+            self.cache.save()
+        except OSError as e:
+            self.log(f"保存编码缓存失败: {e}")
+
+    def _job_finished(self):
+        """输出到位、失败或取消后推进进度；暂存时输出在后台复制完成后才算完成"""
+        if self._advance is not None:
+            self._advance()
+
+    def _job_failed(self, job, error, tmp_paths):
+        """清理临时文件；取消导致的失败在日志中回到排队状态，续传时重新编码"""
+        for tmp_path in tmp_paths:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self.stager.release(job.reservation)
+        if self._stopped(job):
+            job.status = EncodeJob.CANCELLED
+            if self.journal is not None:
+                self.journal.mark(job, EncodeJob.QUEUED)
+            self.emit("job_cancelled", job=job)
+            self._job_finished()
+            return
+        job.error = str(error)
+        self._mark(job, EncodeJob.FAILED)
+        if self.cache is not None:
+            self.cache.forget(job.input_path)
+        self.log(f"编码失败: {job.input_path}")
+        self.emit("job_failed", job=job)
+        self._job_finished()
+
+    def encode(self, job):
+        """编码单个视频
+
+        先写入临时文件，成功后再原子地改名为正式输出，中断时不会留下半成品。
+        """
+        tmp_paths = []
+        try:
+            tmp_paths = self._begin(job)
+            try:
+                self.run_ffmpeg(self.build_command(job, tmp_paths), job, outputs=tmp_paths)
+            except FFmpegError:
+                if not self._hardware_fallback(job):
+                    raise
+                self.run_ffmpeg(self.build_command(job, tmp_paths), job, outputs=tmp_paths)
+            self._job_done(job, tmp_paths)
+        except Exception as e:
+            self._job_failed(job, e, tmp_paths)
+            raise
+
+    def encode_segment(self, task):
+        """编码长视频的一个分段；最后一个分段结束时负责拼接，返回整个任务是否已结束"""
+        parent = task.parent
+        job = parent.job
+        parent.start(lambda: self._begin(job))
+        ok = False
+        try:
+            if not parent.failed and not self._stopped(job):
+                profile = self.job_renditions(job)[0][0]
+                hardware = job.hardware if job.device == "gpu" else None
+                try:
+                    self.run_ffmpeg(task.build_command(profile, job.device, job.threads, hardware=hardware),
+                                    job, task, stage="encode_segment", outputs=[task.path])
+                except FFmpegError:
+                    if hardware is None or not self._hardware_fallback(job):
+                        raise
+                    self.run_ffmpeg(task.build_command(profile, job.device, job.threads), job, task,
+                                    stage="encode_segment", outputs=[task.path])
+                ok = True
+        except Exception as e:
+            parent.error = parent.error or e
+        if not parent.task_finished(ok):
+            return False
+
+        try:
+            if parent.failed:
+                raise parent.error or RuntimeError("分段编码已中止")
+            self.log(f"拼接分段: {job.input_path}")
+            profile = self.job_renditions(job)[0][0]
+            self.run_ffmpeg(parent.build_concat_command(profile, parent.tmp_paths[0]),
+                            stage="concat", source=job.input_path, outputs=parent.tmp_paths[:1], owner=job)
+            self._job_done(job, parent.tmp_paths)
+        except Exception as e:
+            self._job_failed(job, e, parent.tmp_paths)
+        finally:
+            parent.cleanup()
+        return True
+
+    def _hardware_fallback(self, job):
+        """全 GPU 流水线失败时改用软件解码和缩放重试，返回是否需要重试"""
+        if job.hardware is None or job.device != "gpu" or self._stopped(job):
+            return False
+        job.hardware = None
+        self.log(f"硬件解码失败，改用软件解码重试: {job.input_path}")
+        return True
+
+    def plan_hardware(self, jobs, scheduler):
+        """为可能分配到 GPU 槽位的任务逐个判断能否全程在显卡上解码、缩放和编码"""
+        if not self.hw_decode or not scheduler.gpu_slots:
+            return
+        capabilities = self.capabilities or get_capabilities()
+        reasons = {}
+        count = 0
+        for job in jobs:
+            if job.strategy != STRATEGY_ENCODE:
+                continue
+            profiles = [profile for profile, _ in self.job_renditions(job)]
+            job.hardware, reason = hardware_pipeline(capabilities, job.media, profiles)
+            if job.hardware is not None:
+                count += 1
+            else:
+                reasons[reason] = reasons.get(reason, 0) + 1
+        if count:
+            self.log(f"硬件解码：{count} 个视频在显卡上解码和缩放")
+        for reason, number in reasons.items():
+            self.log(f"硬件解码：{number} 个视频改用软件解码（{reason}）")
+
+    def _plan_segmented(self, jobs, scheduler):
+        """挑出适合分段并行编码的长视频，返回 {任务: SegmentedJob}"""
+        threshold = self.settings.segment_threshold
+        kind = scheduler.pinned_kind()
+        workers = scheduler.cpu_slots if kind == "cpu" else scheduler.gpu_slots
+        if not threshold or workers < 2:
+            return {}
+        candidates = [
+            job for job in jobs
+            if job.strategy == STRATEGY_ENCODE and len(job.renditions) == 1
+            and job.duration and job.duration >= threshold
+        ]
+        if not candidates:
+            return {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(8, len(candidates))) as executor:
+            keyframes = list(executor.map(lambda job: probe_keyframes(job.input_path), candidates))
+        if self.metrics is not None:
+            self.metrics.record("keyframes", time.perf_counter() - start, files=len(candidates))
+        segmented = {}
+        for job, points in zip(candidates, keyframes):
+            profile = self.job_renditions(job)[0][0]
+            segments = plan_segments(job.duration, points, workers, float(profile.fps))
+            if len(segments) > 1:
+                segmented[job] = SegmentedJob(job, segments, self.stager.segment_folder(job.output_path))
+        if segmented:
+            count = sum(len(parent.tasks) for parent in segmented.values())
+            self.log(f"分段编码：{len(segmented)} 个长视频拆分为 {count} 段")
+        return segmented
+
+    def skip_finished(self, jobs):
+        """标记缓存命中或（续传模式下）日志中已完成的任务为已跳过，返回仍需编码的任务"""
+        finished = set()
+        if self.journal is not None:
+            if self.resume:
+                finished = self.journal.finished(jobs)
+            self.journal.enqueue([job for job in jobs if job.input_path not in finished])
+        if self.cache is None and not finished:
+            return list(jobs)
+        pending = []
+        for job in jobs:
+            if job.input_path in finished or (self.cache is not None and self.cache.is_fresh(
+                    job.input_path, job.output_paths, self.command_params(job))):
+                job.status = EncodeJob.SKIPPED
+                if self.journal is not None and job.input_path not in finished:
+                    self.journal.mark(job, EncodeJob.DONE)
+                self.emit("job_skipped", job=job)
+            else:
+                pending.append(job)
+        skipped = len(jobs) - len(pending)
+        if skipped:
+            self.log(f"跳过 {skipped} 个未变化的文件")
+        return pending
+
+    def run(self, jobs):
+        """并发执行全部任务，返回统计结果；取消标志只在创建引擎时清除，run() 之前的取消同样有效"""
+        jobs = list(jobs)
+        return self._run([jobs], len(jobs))
+
+    def run_stream(self, job_batches):
+        """执行持续产出的任务批次（如边扫描边编码），返回累计统计结果
+
+        各批次送入同一个线程池：后一批在前一批编码的同时探测和排队，槽位不会在批次之间空下来。
+        总数随批次增加，不估计剩余时间。
+        """
+        return self._run(job_batches, None)
+
+    def _run(self, job_batches, total):
+        """total 为 None 时表示任务持续产出，进度中的总数随之增加"""
+        all_jobs = []
+        counts = {"done": 0, "total": total or 0}
+        counts_lock = threading.Lock()
+
+        def advance(done=1, added=0):
+            with counts_lock:
+                counts["done"] += done
+                counts["total"] += added
+                current = dict(counts)
+            self.emit("progress", **current)
+
+        self.emit("batch_started", total=counts["total"])
+        if self.journal is not None:
+            # 只在开始时恢复一次，之后的批次到达时前面的任务可能仍在运行
+            recovered = self.journal.recover()
+            if recovered:
+                self.log(f"恢复 {recovered} 个上次中断的任务")
+        segmented = {}
+        self._advance = advance
+        try:
+            scheduler = self.create_scheduler()
+            self.log(f"调度：{scheduler.describe()}")
+            if self.stager.staging:
+                self.log(f"输出暂存：{self.stager.describe()}")
+            self.tracker = ThroughputTracker()
+            with ThreadPoolExecutor(max_workers=scheduler.max_workers) as executor:
+                for jobs in job_batches:
+                    if self.cancel_task:
+                        break
+                    jobs = list(jobs)
+                    all_jobs.extend(jobs)
+                    pending = self.skip_finished(jobs)
+                    skipped = len(jobs) - len(pending)
+                    if skipped or total is None:
+                        advance(skipped, len(jobs) if total is None else 0)
+                    if not self._dispatch(pending, scheduler, executor, segmented, total is not None):
+                        break
+
+            # 取消时未能全部调度的分段任务，清理中间文件并恢复为排队状态
+            for parent in segmented.values():
+                if parent.started and not parent.closed:
+                    self._job_failed(parent.job, RuntimeError("分段编码未完成"), parent.tmp_paths)
+                    parent.cleanup()
+            # 等待后台复制完成后任务状态才是最终结果
+            self.stager.drain()
+            for job in all_jobs:
+                self.stager.release(job.reservation)
+        finally:
+            self._advance = None
+            if self.cache is not None:
+                self.cache.save()
+
+        for job in all_jobs:
+            if job.status == EncodeJob.QUEUED:
+                job.status = EncodeJob.CANCELLED
+
+        summary = {
+            "total": len(all_jobs),
+            "done": sum(1 for job in all_jobs if job.status == EncodeJob.DONE),
+            "failed": sum(1 for job in all_jobs if job.status == EncodeJob.FAILED),
+            "skipped": sum(1 for job in all_jobs if job.status == EncodeJob.SKIPPED),
+            "cancelled": self.cancel_task,
+        }
+        if self.metrics is not None:
+            self.metrics.flush()
+            if self.metrics.stages:
+                self.log(f"阶段耗时：{self.metrics.describe()}")
+            summary["metrics"] = self.metrics.summary()
+        self.emit("batch_finished", **summary)
+        return summary
+
+    def prepare(self, jobs):
+        """并行探测源文件，填充时长并选择编码策略"""
+        start = time.perf_counter()
+        infos = self.media_index.probe_all([job.input_path for job in jobs])
+        if self.metrics is not None:
+            self.metrics.record("probe", time.perf_counter() - start, files=len(jobs))
+        for job in jobs:
+            job.media = infos.get(job.input_path)
+            if job.media is not None:
+                job.duration = job.media.get("duration")
+                # 多规格输出总要解码，快速路径只适用于单一规格
+                if self.fast_path and len(job.renditions) == 1:
+                    profile = self.job_renditions(job)[0][0]
+                    job.strategy = profile.target().choose_strategy(job.media)
+        copied = sum(1 for job in jobs if job.strategy == STRATEGY_COPY)
+        audio_only = sum(1 for job in jobs if job.strategy == STRATEGY_AUDIO)
+        if copied or audio_only:
+            self.log(f"快速路径：{copied} 个直接封装，{audio_only} 个只重编码音频")
+        self.media_index.save()
+
+    def _run_quality_command(self, command):
+        """运行码率搜索的 FFmpeg 命令，进程登记后可以被取消"""
+        processes = []
+
+        def on_start(process):
+            processes.append(process)
+            self._register_process(process)
+
+        try:
+            return run_ffmpeg_streaming(command, on_start=on_start)
+        finally:
+            self._unregister_processes(processes)
+
+    def select_quality(self, jobs, scheduler):
+        """目标质量模式：为每个需要编码的任务按片源搜索满足目标的最低码率"""
+        settings = self.settings
+        if not settings.quality_target:
+            return
+        candidates = [job for job in jobs if job.strategy == STRATEGY_ENCODE and job.duration]
+        if not candidates:
+            return
+        search = QualitySearch(settings.quality_metric, settings.quality_target, self.quality_cache,
+                               threads=scheduler.threads_per_job, run=self._run_quality_command,
+                               capabilities=self.capabilities or get_capabilities())
+        if search.fallback:
+            self.log(f"未检测到 libvmaf，改用 SSIM（目标 {search.target}）")
+
+        def tune(job):
+            for i, (profile, _) in enumerate(self.job_renditions(job)):
+                start = time.perf_counter()
+                try:
+                    decision = search.search(job.input_path, job.duration, profile, lambda: self.cancel_task)
+                except (FFmpegError, RuntimeError, OSError) as e:
+                    if not self.cancel_task:
+                        self.log(f"码率搜索失败，使用默认码率: {job.input_path}（{e}）")
+                    return
+                if decision is None:
+                    return
+                job.tuned_profiles[i] = search.tuned_profile(profile, decision)
+                if self.metrics is not None:
+                    self.metrics.record("quality_search", time.perf_counter() - start, job=job.input_path,
+                                        crf=decision["crf"], bitrate=decision["bitrate"],
+                                        score=decision["score"], reached=decision["reached"])
+
+        self.log(f"目标质量：为 {len(candidates)} 个视频搜索码率（{search.metric.upper()} ≥ {search.target}）")
+        with ThreadPoolExecutor(max_workers=max(1, scheduler.cpu_slots)) as executor:
+            list(executor.map(tune, candidates))
+        self.quality_cache.save()
+        tuned = [job.tuned_profiles[0] for job in candidates if 0 in job.tuned_profiles]
+        if tuned:
+            average = sum(parse_bitrate(profile.bitrate) for profile in tuned) / len(tuned)
+            self.log(f"目标质量：{len(tuned)} 个视频按片源调整码率，平均 {average / 1000:.0f} kbps")
+
+    def estimate_output_bytes(self, job):
+        """按各规格的码率上限 × 时长估算输出大小；直接封装或时长未知时按源文件大小估算"""
+        source_size = file_size(job.input_path) or 0
+        if job.strategy == STRATEGY_COPY or not job.duration:
+            return source_size * len(job.renditions)
+        total = 0
+        for profile, _ in self.job_renditions(job):
+            if job.strategy == STRATEGY_AUDIO:
+                video_rate = ((job.media or {}).get("video") or {}).get("bit_rate") or 0
+            elif profile.maxrate or profile.crf is None:
+                video_rate = parse_bitrate(profile.maxrate or profile.bitrate)
+            else:
+                # 不限码率的 CRF 规格：以源文件的平均码率为上限估计
+                video_rate = source_size * 8 / job.duration
+            total += estimate_output_size(video_rate + parse_bitrate(profile.audio_bitrate), job.duration)
+        return total
+
+    def _admit(self, job, factor=1):
+        """开始任务前预留输出空间；磁盘空间无法满足时任务失败，已取消时返回 False"""
+        try:
+            job.reservation = self.stager.admit(job.output_paths, self.estimate_output_bytes(job) * factor,
+                                                lambda: self.cancel_task)
+        except OSError as e:
+            self.log(f"{e.strerror}: {job.input_path}")
+            self._job_failed(job, e, [])
+            return True
+        return job.reservation is not None
+
+    def create_scheduler(self):
+        """按设置创建资源调度器；没有可用的 NVENC 时改为 CPU 编码"""
+        settings = self.settings
+        gpu_available = True
+        if settings.render_mode != "cpu":
+            capabilities = self.capabilities or get_capabilities()
+            gpu_available = capabilities.nvenc_available({profile.video_codec for profile in self.profiles})
+            if not gpu_available:
+                self.log(f"未检测到可用的 NVENC（{capabilities.describe()}），改用 CPU 编码")
+        return ResourceScheduler(settings.render_mode, settings.thread_count, settings.ffmpeg_threads,
+                                 settings.nvenc_sessions, gpu_available=gpu_available)
+
+    def _dispatch(self, jobs, scheduler, executor, segmented, estimate_eta=False):
+        """探测并规划一批任务，按资源调度器发放的槽位提交到线程池，长任务优先
+
+        已取消时返回 False。segmented 收集各批次的分段任务；estimate_eta 为真时按这批任务的总时长估计剩余时间。
+        """
+        if not jobs:
+            return True
+        self.prepare(jobs)
+        self.select_quality(jobs, scheduler)
+        self.plan_hardware(jobs, scheduler)
+        jobs = order_longest_first(jobs)
+        if estimate_eta:
+            known = [job.duration for job in jobs if job.duration]
+            # 只有全部时长都已知时才能估计剩余时间
+            self.tracker = ThroughputTracker(sum(known) if len(known) == len(jobs) else None)
+        batch_segmented = self._plan_segmented(jobs, scheduler)
+        segmented.update(batch_segmented)
+        units = []
+        for job in jobs:
+            units.extend(batch_segmented[job].tasks if job in batch_segmented else [job])
+
+        def run_unit(unit, slot):
+            # 进度在输出到位或失败时由 _job_done / _job_failed 推进
+            try:
+                if isinstance(unit, SegmentTask):
+                    self.encode_segment(unit)
+                else:
+                    self.encode(unit)
+            except Exception:
+                pass
+            finally:
+                scheduler.release(slot)
+
+        dispatch_start = time.perf_counter()
+        for unit in units:
+            # 同一视频的各段必须用同一种编码器，才能无损拼接
+            segment = isinstance(unit, SegmentTask)
+            job = unit.parent.job if segment else unit
+            # 单独取消的分段任务仍交给 encode_segment，由最后一段负责清理
+            if job.status == EncodeJob.FAILED or (not segment and job in self._cancelled_jobs):
+                continue
+            if job.reservation is None:
+                # 分段编码时各分段与拼接结果同时存在
+                if not self._admit(job, 2 if segment else 1):
+                    return False
+                if job.status == EncodeJob.FAILED:
+                    continue
+            slot = scheduler.acquire(lambda: self.cancel_task,
+                                     scheduler.pinned_kind() if segment else None)
+            if slot is None:
+                return False
+            if self.metrics is not None:
+                self.metrics.record("queue_wait", time.perf_counter() - dispatch_start,
+                                    job=job.input_path, device=slot)
+            job.device = slot
+            job.threads = scheduler.threads_per_job if slot == "cpu" else None
+            executor.submit(run_unit, unit, slot)
+        return True
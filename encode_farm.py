@@ -0,0 +1,511 @@
+"""多机编码：协调端把任务发布到共享的 SQLite 队列，各节点上的工作端租用任务并编码
+
+用法:
+    python encode_farm.py publish 队列.sqlite3 job.json        # 扫描源目录并发布任务
+    python encode_farm.py worker 队列.sqlite3 [--render-mode gpu] [--map-path /mnt/nas=Z:/nas]
+    python encode_farm.py status 队列.sqlite3
+
+任务描述与 encode_cli.py 相同。源文件和输出文件夹需要位于各节点都能访问的共享存储上，
+路径不同时用 --map-path 把协调端的路径前缀映射为本机路径；输出直接写入共享的输出目录。
+工作端定期发送心跳延长租约，节点掉线后租约过期，任务会被其他节点重新租用；
+失败或租约过期超过 max_attempts 次的任务标记为失败。
+"""
+import argparse
+import datetime
+import json
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from encode_cli import build_spec, make_event_printer, parse_args as parse_cli_args
+from encode_engine import BatchEncoder, EncodeJob, EncodeSettings, build_jobs, scan_video_files
+from encode_profiles import resolve_profiles
+from output_staging import DEFAULT_COPY_WORKERS, OutputStager
+
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5.0
+
+
+class FarmTask:
+    """从队列租到的一个任务"""
+
+    def __init__(self, task_id, batch_id, input_path, outputs, attempts):
+        self.task_id = task_id
+        self.batch_id = batch_id
+        self.input_path = input_path
+        self.outputs = outputs
+        self.attempts = attempts
+
+
+class FarmQueue:
+    """基于 SQLite 的任务队列（放在共享存储上即可供多台机器使用）
+
+    任务状态为 queued / leased / done / failed。租用在一个 IMMEDIATE 事务中完成，
+    同一任务不会同时租给两个工作端；租约到期未续约的任务视为丢失，重新回到可租用状态。
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # 网络文件系统上的 WAL 依赖共享内存，不可靠，因此使用默认的回滚日志
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            " id INTEGER PRIMARY KEY,"
+            " settings TEXT NOT NULL,"
+            " renditions TEXT,"
+            " profiles TEXT,"
+            " options TEXT,"
+            " created REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY,"
+            " batch_id INTEGER NOT NULL,"
+            " input_path TEXT NOT NULL UNIQUE,"
+            " outputs TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " worker TEXT,"
+            " lease_expires REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " progress REAL,"
+            " error TEXT,"
+            " params TEXT,"
+            " updated REAL NOT NULL)"
+        )
+        if "options" not in [row[1] for row in self._conn.execute("PRAGMA table_info(batches)")]:
+            # 引擎选项（快速路径、硬件解码等，JSON 对象）
+            self._conn.execute("ALTER TABLE batches ADD COLUMN options TEXT")
+        if "params" not in [row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")]:
+            # 发布时的编码参数指纹，参数改变后重新发布的已完成任务需要重新编码
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN params TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_expires)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def publish(self, jobs, settings, renditions=None, profiles=None, options=None, params=None):
+        """发布一批任务，返回新排队的任务数；已完成且输出路径和编码参数都相同的任务保持原状态
+
+        options 为 BatchEncoder 的引擎选项（如 fast_path、hw_decode），随批次保存；
+        params(job) 返回任务的编码参数指纹（不含路径）。
+        """
+        now = time.time()
+
+        def insert(conn):
+            batch_id = conn.execute(
+                "INSERT INTO batches (settings, renditions, profiles, options, created) VALUES (?, ?, ?, ?, ?)",
+                (json.dumps(settings.to_dict()), json.dumps(renditions), json.dumps(profiles),
+                 json.dumps(options or {}), now)
+            ).lastrowid
+            queued = 0
+            for job in jobs:
+                outputs = json.dumps(job.output_paths, ensure_ascii=False)
+                fingerprint = params(job) if params is not None else None
+                row = conn.execute("SELECT state, outputs, params FROM tasks WHERE input_path = ?",
+                                   (job.input_path,)).fetchone()
+                if row and row[0] in ("done", "leased") and row[1] == outputs and row[2] == fingerprint:
+                    continue
+                conn.execute(
+                    "INSERT INTO tasks (batch_id, input_path, outputs, state, attempts, params, updated)"
+                    " VALUES (?, ?, ?, 'queued', 0, ?, ?)"
+                    " ON CONFLICT(input_path) DO UPDATE SET batch_id = excluded.batch_id,"
+                    " outputs = excluded.outputs, state = 'queued', worker = NULL,"
+                    " lease_expires = NULL, attempts = 0, progress = NULL, error = NULL,"
+                    " params = excluded.params, updated = excluded.updated",
+                    (batch_id, job.input_path, outputs, fingerprint, now)
+                )
+                queued += 1
+            return queued
+
+        return self._transaction(insert)
+
+    def lease(self, worker, count=1, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """租用至多 count 个同一批次的任务；租约过期的任务优先重新分配"""
+        now = time.time()
+
+        def take(conn):
+            conn.execute(
+                "UPDATE tasks SET state = 'failed', error = '租约多次过期', worker = NULL, updated = ?"
+                " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            candidates = "(state = 'queued' OR (state = 'leased' AND lease_expires < ?))"
+            first = conn.execute(
+                f"SELECT batch_id FROM tasks WHERE {candidates}"
+                " ORDER BY state = 'queued', id LIMIT 1", (now,)
+            ).fetchone()
+            if first is None:
+                return None, []
+            rows = conn.execute(
+                f"SELECT id, input_path, outputs, attempts FROM tasks WHERE {candidates} AND batch_id = ?"
+                " ORDER BY state = 'queued', id LIMIT ?", (now, first[0], count)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?,"
+                " attempts = attempts + 1, progress = 0, updated = ? WHERE id = ?",
+                [(worker, now + lease_seconds, now, row[0]) for row in rows]
+            )
+            batch = conn.execute("SELECT settings, renditions, profiles, options FROM batches WHERE id = ?",
+                                 (first[0],)).fetchone()
+            tasks = [FarmTask(row[0], first[0], row[1], json.loads(row[2]), row[3] + 1) for row in rows]
+            return batch, tasks
+
+        return self._transaction(take)
+
+    def heartbeat(self, task_id, worker, progress=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """续约并报告进度；返回 False 表示租约已丢失（已被其他节点租用或已结束）"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET lease_expires = ?, progress = COALESCE(?, progress), updated = ?"
+                " WHERE id = ? AND worker = ? AND state = 'leased'",
+                (now + lease_seconds, progress, now, task_id, worker)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, worker):
+        """标记完成；返回 False 表示租约已丢失，任务由当前持有租约的节点负责"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET state = 'done', worker = NULL, lease_expires = NULL, progress = 100,"
+                " error = NULL, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time(), task_id, worker)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, task_id, worker, error):
+        """编码失败：未超过重试次数时重新排队，交给其他节点重试"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+                " worker = NULL, lease_expires = NULL, error = ?, updated = ?"
+                " WHERE id = ? AND worker = ? AND state = 'leased'",
+                (self.max_attempts, error, time.time(), task_id, worker)
+            )
+
+    def release(self, task_id, worker):
+        """归还未完成的任务（如工作端被取消），不计入重试次数"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET state = 'queued', worker = NULL, lease_expires = NULL,"
+                " attempts = MAX(0, attempts - 1), updated = ?"
+                " WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time(), task_id, worker)
+            )
+
+    def counts(self):
+        """各状态的任务数"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        return dict(rows)
+
+    def workers(self):
+        """正在工作的节点及其租用的任务数"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT worker, COUNT(*) FROM tasks WHERE state = 'leased' AND lease_expires >= ?"
+                " GROUP BY worker", (time.time(),)
+            ).fetchall()
+        return dict(rows)
+
+
+def parse_path_map(values):
+    """把 ["/mnt/nas=Z:/nas", ...] 解析为 [(协调端前缀, 本机前缀), ...]"""
+    mapping = []
+    for value in values or []:
+        remote, sep, local = value.partition("=")
+        if not sep or not remote:
+            raise ValueError(f"路径映射格式应为 源前缀=本机前缀：{value}")
+        mapping.append((remote, local))
+    return mapping
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def map_path(path, mapping):
+    for remote, local in mapping:
+        if path.startswith(remote):
+            return os.path.normpath(local + path[len(remote):])
+    return path
+
+
+class FarmWorker:
+    """工作端：循环租用任务，用本机的 BatchEncoder 编码，并定期心跳续约
+
+    每轮租用的任务数等于本机调度器的槽位数，一轮全部结束后再租下一轮。
+    settings_override 中的字段（如 render_mode、thread_count）覆盖批次设置，用于适配本机硬件。
+    批次保存的引擎选项（fast_path、hw_decode）与 encode_cli.py 的含义相同。
+    stager（OutputStager）为本机的输出暂存，各轮共用；其 tag 应为 worker_id，避免与其他节点写同一个临时文件。
+    租约丢失（心跳失败）的任务立即结束编码；输出移动到位前再确认一次租约，已丢失时放弃结果。
+    """
+
+    def __init__(self, queue, worker_id=None, settings_override=None, path_map=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, on_event=None, exit_when_idle=False, stager=None):
+        self.queue = queue
+        self.worker_id = worker_id or default_worker_id()
+        self.settings_override = settings_override or {}
+        self.path_map = path_map or []
+        self.lease_seconds = lease_seconds
+        self.on_event = on_event
+        self.exit_when_idle = exit_when_idle
+        self.stager = stager if stager is not None else OutputStager(tag=self.worker_id)
+        self.engine = None
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        engine = self.engine
+        if engine is not None:
+            engine.cancel()
+
+    def log(self, message):
+        if self.on_event is not None:
+            self.on_event({"type": "log", "message": message, "time": datetime.datetime.now()})
+
+    def _settings(self, data):
+        merged = dict(data)
+        merged.update(self.settings_override)
+        return EncodeSettings.from_dict(merged)
+
+    def _jobs(self, tasks, profiles):
+        jobs = {}
+        for task in tasks:
+            input_path = map_path(task.input_path, self.path_map)
+            outputs = [map_path(path, self.path_map) for path in task.outputs]
+            renditions = list(zip(profiles, outputs)) if profiles and len(profiles) > 1 \
+                else [(profiles[0] if profiles else None, outputs[0])]
+            jobs[task.task_id] = EncodeJob(input_path, outputs[0], renditions)
+        return jobs
+
+    def _heartbeat_loop(self, engine, tasks, jobs, progress, done):
+        interval = max(1.0, self.lease_seconds / 3)
+        lost = set()
+        # 各任务最近一次成功续约的时间（租用时即已续约）
+        renewed = {task.task_id: time.monotonic() for task in tasks}
+        while not done.wait(interval):
+            for task in tasks:
+                if task.task_id in lost:
+                    continue
+                try:
+                    held = self.queue.heartbeat(task.task_id, self.worker_id, progress.get(task.task_id),
+                                                self.lease_seconds)
+                except sqlite3.Error as e:
+                    # 共享存储暂时不可用：下一轮重试，租约确实过期后才放弃
+                    if time.monotonic() - renewed[task.task_id] < self.lease_seconds:
+                        self.log(f"续约失败，稍后重试: {e}")
+                        continue
+                    held = False
+                if held:
+                    renewed[task.task_id] = time.monotonic()
+                    continue
+                # 任务已转给其他节点：结束本机的编码，避免两个节点同时处理
+                lost.add(task.task_id)
+                progress.pop(task.task_id, None)
+                self.log(f"租约已丢失，停止编码: {task.input_path}")
+                engine.cancel_job(jobs[task.task_id])
+
+    def _holds_lease(self, task_id):
+        """续约一次，确认任务仍由本节点持有"""
+        try:
+            return self.queue.heartbeat(task_id, self.worker_id, None, self.lease_seconds)
+        except sqlite3.Error as e:
+            self.log(f"无法确认租约: {e}")
+            return False
+
+    def run_round(self, scheduler_slots):
+        """租用并执行一轮任务；没有可租用的任务时返回 False"""
+        batch, tasks = self.queue.lease(self.worker_id, scheduler_slots, self.lease_seconds)
+        if not tasks:
+            return False
+        settings_data, renditions, custom, options = (json.loads(value) if value else None for value in batch)
+        settings = self._settings(settings_data)
+        options = options or {}
+        profiles = resolve_profiles(renditions, custom) if renditions else None
+        jobs = self._jobs(tasks, profiles)
+        task_of = {id(job): task_id for task_id, job in jobs.items()}
+        progress = {}
+
+        def on_event(event):
+            if event["type"] == "job_progress" and event.get("percent") is not None:
+                task_id = task_of.get(id(event["job"]))
+                if task_id is not None:
+                    progress[task_id] = event["percent"]
+            if self.on_event is not None:
+                self.on_event(event)
+
+        self.engine = BatchEncoder(settings, on_event=on_event, profiles=profiles, stager=self.stager,
+                                   fast_path=options.get("fast_path", True),
+                                   hw_decode=options.get("hw_decode", True),
+                                   publish_check=lambda job: self._holds_lease(task_of[id(job)]))
+        # stop() 可能在创建引擎之前到达
+        if self.stopped.is_set():
+            self.engine.cancel()
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat_loop,
+                                     args=(self.engine, tasks, jobs, progress, done), daemon=True)
+        heartbeat.start()
+        try:
+            self.engine.run(list(jobs.values()))
+        finally:
+            done.set()
+            heartbeat.join()
+            for task_id, job in jobs.items():
+                if job.status in (EncodeJob.DONE, EncodeJob.SKIPPED):
+                    if not self.queue.complete(task_id, self.worker_id):
+                        self.log(f"完成时租约已被其他节点接手，结果以该节点为准: {job.input_path}")
+                elif job.status == EncodeJob.FAILED:
+                    self.queue.fail(task_id, self.worker_id, job.error)
+                else:
+                    self.queue.release(task_id, self.worker_id)
+            self.engine = None
+        return True
+
+    def run(self):
+        settings = self._settings({})
+        slots = BatchEncoder(settings, on_event=self.on_event).create_scheduler().max_workers
+        while not self.stopped.is_set():
+            if self.run_round(slots):
+                continue
+            if self.exit_when_idle and not self.queue.counts().get("leased"):
+                break
+            self.stopped.wait(POLL_INTERVAL)
+
+
+def publish_command(args):
+    spec = build_spec(args)
+    source_folder = spec.get("source_folder")
+    output_folder = spec.get("output_folder")
+    if not source_folder or not output_folder:
+        print("错误: 必须指定源文件夹和输出文件夹", file=sys.stderr)
+        return 2
+    settings = EncodeSettings.from_dict(spec["settings"])
+    renditions = spec.get("renditions")
+    custom = spec.get("profiles")
+    try:
+        profiles = resolve_profiles(renditions, custom) if renditions else None
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+    options = {"fast_path": spec.get("fast_path", True), "hw_decode": spec.get("hw_decode", True)}
+    video_files = spec.get("files") or scan_video_files(source_folder)
+    jobs = build_jobs(video_files, source_folder, output_folder, profiles)
+    # 指纹与编码缓存使用相同的命令参数，再加上引擎选项
+    engine = BatchEncoder(settings, profiles=profiles, **options)
+
+    def params(job):
+        return json.dumps([engine.command_params(job), options], ensure_ascii=False, sort_keys=True)
+
+    queue = FarmQueue(args.queue)
+    try:
+        queued = queue.publish(jobs, settings, renditions, custom, options, params)
+    finally:
+        queue.close()
+    print(f"找到 {len(jobs)} 个视频文件，发布 {queued} 个任务", flush=True)
+    return 0
+
+
+def worker_command(args):
+    override = {key: getattr(args, key) for key in ("render_mode", "thread_count", "ffmpeg_threads",
+                                                    "nvenc_sessions") if getattr(args, key) is not None}
+    try:
+        path_map = parse_path_map(args.map_path)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+    queue = FarmQueue(args.queue, max_attempts=args.max_attempts)
+    worker_id = args.worker_id or default_worker_id()
+    stager = OutputStager(args.scratch, args.copy_workers, tag=worker_id)
+    if stager.reclaimed:
+        print(f"清理 {stager.reclaimed} 个上次中断遗留的暂存目录", flush=True)
+    worker = FarmWorker(queue, worker_id, override, path_map, args.lease_seconds,
+                        on_event=make_event_printer(), exit_when_idle=args.exit_when_idle, stager=stager)
+    print(f"工作端 {worker.worker_id} 已启动", flush=True)
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    try:
+        worker.run()
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+        stager.close()
+        queue.close()
+    return 130 if worker.stopped.is_set() else 0
+
+
+def status_command(args):
+    queue = FarmQueue(args.queue)
+    try:
+        counts = queue.counts()
+        workers = queue.workers()
+    finally:
+        queue.close()
+    print("，".join(f"{state} {counts.get(state, 0)}" for state in ("queued", "leased", "done", "failed")))
+    for worker, count in sorted(workers.items()):
+        print(f"  {worker}: {count} 个任务")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="多机视频编码")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    publish = commands.add_parser("publish", help="扫描源目录并发布任务")
+    publish.add_argument("queue", help="任务队列数据库路径")
+    publish.add_argument("rest", nargs=argparse.REMAINDER, help="与 encode_cli.py 相同的参数")
+
+    worker = commands.add_parser("worker", help="租用并执行任务")
+    worker.add_argument("queue", help="任务队列数据库路径")
+    worker.add_argument("--worker-id", help="工作端名称，默认为 主机名:进程号")
+    worker.add_argument("--render-mode", dest="render_mode", choices=["cpu", "gpu", "mixed"])
+    worker.add_argument("--threads", dest="thread_count", type=int)
+    worker.add_argument("--ffmpeg-threads", dest="ffmpeg_threads", type=int)
+    worker.add_argument("--nvenc-sessions", dest="nvenc_sessions", type=int)
+    worker.add_argument("--map-path", action="append", help="路径映射 协调端前缀=本机前缀，可重复")
+    worker.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    worker.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    worker.add_argument("--exit-when-idle", action="store_true", help="队列为空时退出")
+    worker.add_argument("--scratch", help="本地暂存目录，编码完成后再复制到输出文件夹")
+    worker.add_argument("--copy-workers", type=int, default=DEFAULT_COPY_WORKERS, help="后台复制线程数")
+
+    status = commands.add_parser("status", help="查看队列状态")
+    status.add_argument("queue", help="任务队列数据库路径")
+
+    args = parser.parse_args(argv)
+    if args.command == "publish":
+        cli_args = parse_cli_args(args.rest)
+        cli_args.queue = args.queue
+        return cli_args, publish_command
+    return args, {"worker": worker_command, "status": status_command}[args.command]
+
+
+def main(argv=None):
+    args, command = parse_args(argv)
+    try:
+        return command(args)
+    except (OSError, ValueError, RuntimeError, sqlite3.Error) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import threading
+
+from segment_encode import segment_dir
+
+# 任务日志默认保存在输出文件夹中
+JOURNAL_FILE_NAME = ".encode_journal.sqlite3"
+
+
+def partial_path(output_path, tag=None):
+    """编码中使用的临时输出路径，成功后再改名为正式文件；tag 用于区分共用输出文件夹的多个工作端"""
+    folder, name = os.path.split(output_path)
+    if tag:
+        return os.path.join(folder, f".{name}.{tag}.partial.mp4")
+    return os.path.join(folder, f".{name}.partial.mp4")
+
+
+class EncodeJournal:
+    """基于 SQLite 的任务日志
+
+    记录每个源文件的状态（queued/running/done/failed），每次状态变化立即提交，
+    进程意外退出后可以据此只调度未完成的任务。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " input_path TEXT PRIMARY KEY,"
+            " output_path TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " error TEXT,"
+            " updated REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "extra_outputs" not in columns:
+            # 多规格输出时除第一个以外的输出路径（JSON 列表）
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN extra_outputs TEXT")
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def recover(self):
+        """把上次中断时仍在运行的任务恢复为排队状态，并删除残留的临时文件和分段目录"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT output_path, extra_outputs FROM jobs WHERE state = 'running'"
+            ).fetchall()
+            self._conn.execute(
+                "UPDATE jobs SET state = 'queued', updated = ? WHERE state = 'running'",
+                (time.time(),)
+            )
+            self._conn.commit()
+        for output_path, extra_outputs in rows:
+            for path in [output_path, *json.loads(extra_outputs or "[]")]:
+                try:
+                    os.remove(partial_path(path))
+                except OSError:
+                    pass
+            shutil.rmtree(segment_dir(output_path), ignore_errors=True)
+        return len(rows)
+
+    def enqueue(self, jobs):
+        """登记一批任务；已完成的任务保持原状态"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO jobs (input_path, output_path, extra_outputs, state, updated)"
+                " VALUES (?, ?, ?, 'queued', ?)"
+                " ON CONFLICT(input_path) DO UPDATE SET"
+                " state = CASE WHEN jobs.state = 'done' AND jobs.output_path = excluded.output_path"
+                "         AND IFNULL(jobs.extra_outputs, '[]') = excluded.extra_outputs"
+                "         THEN 'done' ELSE 'queued' END,"
+                " output_path = excluded.output_path,"
+                " extra_outputs = excluded.extra_outputs,"
+                " updated = excluded.updated",
+                [(job.input_path, job.output_path, json.dumps(job.output_paths[1:], ensure_ascii=False), now)
+                 for job in jobs]
+            )
+            self._conn.commit()
+
+    def mark(self, job, state, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE input_path = ?",
+                (state, error, time.time(), job.input_path)
+            )
+            self._conn.commit()
+
+    def finished(self, jobs):
+        """返回日志中已完成且输出文件仍存在的任务输入路径集合"""
+        with self._lock:
+            done = {
+                input_path: [output_path, *json.loads(extra_outputs or "[]")]
+                for input_path, output_path, extra_outputs in self._conn.execute(
+                    "SELECT input_path, output_path, extra_outputs FROM jobs WHERE state = 'done'"
+                )
+            }
+        return {
+            job.input_path for job in jobs
+            if done.get(job.input_path) == job.output_paths
+            and all(os.path.exists(path) for path in job.output_paths)
+        }
+
+    def counts(self):
+        """各状态的任务数"""
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall())
@@ -0,0 +1,152 @@
+from media_probe import TargetProfile, parse_bitrate
+
+# 不同设备上对应的编码器
+VIDEO_ENCODERS = {
+    "h264": {"cpu": "libx264", "gpu": "h264_nvenc"},
+    "hevc": {"cpu": "libx265", "gpu": "hevc_nvenc"},
+}
+
+
+class EncodingProfile:
+    """命名的编码规格：编码器、预设、CRF 或码率、分辨率、帧率和音频参数
+
+    crf 不为空时使用质量模式（NVENC 下对应 -cq），否则使用 bitrate/maxrate/bufsize。
+    """
+
+    FIELDS = ("name", "width", "height", "fps", "video_codec", "preset", "nvenc_preset", "crf",
+              "bitrate", "maxrate", "bufsize", "audio_codec", "audio_bitrate")
+
+    def __init__(self, name, width=1080, height=1920, fps=25, video_codec="h264", preset="medium",
+                 nvenc_preset="p5", crf=None, bitrate="3M", maxrate="5M", bufsize="5M",
+                 audio_codec="aac", audio_bitrate="128k"):
+        if video_codec not in VIDEO_ENCODERS:
+            raise ValueError(f"不支持的视频编码：{video_codec}")
+        self.name = name
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = fps
+        self.video_codec = video_codec
+        self.preset = preset
+        self.nvenc_preset = nvenc_preset
+        self.crf = crf
+        self.bitrate = bitrate
+        self.maxrate = maxrate
+        self.bufsize = bufsize
+        self.audio_codec = audio_codec
+        self.audio_bitrate = audio_bitrate
+
+    @classmethod
+    def from_dict(cls, name, data):
+        """从任务描述字典创建，忽略未知字段"""
+        fields = {key: data[key] for key in cls.FIELDS if key in data and key != "name"}
+        return cls(name, **fields)
+
+    @classmethod
+    def from_settings(cls, settings, name="default"):
+        """由界面/命令行的比特率设置得到默认规格（1080x1920 @25fps）"""
+        return cls(name, bitrate=settings.bitrate, maxrate=settings.maxrate,
+                   bufsize=settings.bufsize, audio_bitrate=settings.audio_bitrate)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def encoder(self, device):
+        """device 为 "cpu" 或 "gpu" 时使用的编码器名"""
+        return VIDEO_ENCODERS[self.video_codec][device]
+
+    def scale_filter(self):
+        return f"scale={self.width}:{self.height}"
+
+    def video_args(self, device, threads=None):
+        """-r 之后的视频编码参数"""
+        gpu = device == "gpu"
+        args = ["-c:v", self.encoder(device), "-preset", self.nvenc_preset if gpu else self.preset]
+        if threads:
+            args += ["-threads", str(threads)]
+        if self.crf is not None:
+            args += ["-rc", "vbr", "-cq", str(self.crf), "-b:v", "0"] if gpu else ["-crf", str(self.crf)]
+            if self.maxrate:
+                args += ["-maxrate", self.maxrate, "-bufsize", self.bufsize or self.maxrate]
+        else:
+            args += ["-b:v", self.bitrate, "-maxrate", self.maxrate, "-bufsize", self.bufsize]
+        return args
+
+    def audio_args(self):
+        return ["-c:a", self.audio_codec, "-b:a", self.audio_bitrate]
+
+    def target(self):
+        """快速路径判断用的目标规格；没有码率上限的 CRF 规格不限制源码率"""
+        max_rate = self.maxrate or (self.bitrate if self.crf is None else None)
+        return TargetProfile(
+            width=self.width, height=self.height, fps=float(self.fps),
+            video_codec=self.video_codec,
+            max_video_bitrate=parse_bitrate(max_rate) if max_rate else None,
+            audio_codec=self.audio_codec,
+            max_audio_bitrate=parse_bitrate(self.audio_bitrate)
+        )
+
+
+# NVDEC 能解码的源视频编码
+NVDEC_CODECS = {"h264", "hevc", "vp8", "vp9", "av1", "mpeg1video", "mpeg2video", "mpeg4", "vc1"}
+# 解码后留在显存中可以直接缩放并交给 NVENC 的像素格式（8 位 4:2:0）
+HW_PIXEL_FORMATS = {"yuv420p", "yuvj420p", "nv12"}
+# 显存内缩放滤镜，按优先顺序
+GPU_SCALE_FILTERS = ("scale_cuda", "scale_npp")
+
+
+class HardwarePipeline:
+    """CUDA 解码 → 显存内缩放 → NVENC，帧不回到内存"""
+
+    def __init__(self, scale="scale_cuda"):
+        self.scale = scale
+
+    def input_args(self):
+        """放在 -i 之前的输入参数"""
+        return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+
+    def scale_filter(self, profile):
+        return f"{self.scale}={profile.width}:{profile.height}"
+
+
+def hardware_pipeline(capabilities, media, profiles):
+    """判断一个源文件能否走全 GPU 流水线，返回 (HardwarePipeline 或 None, 不能使用的原因)
+
+    capabilities 为 ffmpeg 能力检测结果，media 为 probe_media 的结果；
+    任一条件不满足时该文件改用软件解码和缩放，仍由 NVENC 编码。
+    """
+    if not capabilities.has_hwaccel("cuda"):
+        return None, "ffmpeg 不支持 CUDA 解码"
+    scale = next((name for name in GPU_SCALE_FILTERS if capabilities.has_filter(name)), None)
+    if scale is None:
+        return None, "ffmpeg 没有显存内缩放滤镜"
+    if not all(capabilities.has_encoder(profile.encoder("gpu")) for profile in profiles):
+        return None, "缺少 NVENC 编码器"
+    video = (media or {}).get("video")
+    if not video:
+        return None, "无法读取视频流信息"
+    if video.get("codec") not in NVDEC_CODECS:
+        return None, f"NVDEC 不支持 {video.get('codec')}"
+    if video.get("pix_fmt") not in HW_PIXEL_FORMATS:
+        return None, f"像素格式 {video.get('pix_fmt')} 需要软件转换"
+    return HardwarePipeline(scale), None
+
+
+# 内置规格，可在任务描述的 "profiles" 中覆盖或新增
+BUILTIN_PROFILES = {
+    "vertical_1080p": EncodingProfile("vertical_1080p"),
+    "vertical_720p": EncodingProfile("vertical_720p", width=720, height=1280,
+                                     bitrate="1.8M", maxrate="3M", bufsize="3M", audio_bitrate="128k"),
+    "vertical_540p": EncodingProfile("vertical_540p", width=540, height=960,
+                                     bitrate="1M", maxrate="1.5M", bufsize="1.5M", audio_bitrate="96k"),
+}
+
+
+def resolve_profiles(names, custom=None):
+    """按名称取得规格列表，custom 为 {名称: 字段字典} 的自定义规格"""
+    available = dict(BUILTIN_PROFILES)
+    for name, data in (custom or {}).items():
+        available[name] = EncodingProfile.from_dict(name, data)
+    missing = [name for name in names if name not in available]
+    if missing:
+        raise ValueError(f"未知的编码规格：{', '.join(missing)}")
+    return [available[name] for name in names]
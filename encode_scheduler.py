@@ -0,0 +1,145 @@
+import os
+import threading
+
+# 自动模式下每个 libx264 进程使用的线程数；再多收益很小，不如多开几个进程
+DEFAULT_THREADS_PER_JOB = 4
+# 单个 1080x1920 编码进程的大致内存占用
+MEMORY_PER_JOB = 512 * 1024 * 1024
+# 可用内存低于该值时暂停接纳新任务
+MIN_FREE_MEMORY = 1024 * 1024 * 1024
+# 1 分钟负载超过 CPU 数的该倍数时暂停接纳新任务
+MAX_LOAD_FACTOR = 1.25
+# 消费级显卡同时可用的 NVENC 会话数
+DEFAULT_NVENC_SESSIONS = 3
+ADMISSION_POLL_INTERVAL = 0.5
+
+
+def cpu_count():
+    """当前进程可用的 CPU 数（考虑 CPU 亲和性限制）"""
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def load_average():
+    """1 分钟平均负载，不支持的平台返回 None"""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory():
+    """可用内存字节数，无法获取时返回 None"""
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def order_longest_first(jobs):
+    """按时长从长到短排序以缩短整批完成时间
+
+    时长未知的任务按文件大小排在已知时长的任务之后。
+    """
+    def key(job):
+        try:
+            size = os.path.getsize(job.input_path)
+        except OSError:
+            size = 0
+        return job.duration is not None, job.duration or 0, size
+
+    return sorted(jobs, key=key, reverse=True)
+
+
+class ResourceScheduler:
+    """按机器资源分配编码槽位
+
+    CPU 槽位数由 CPU 数和每个 ffmpeg 进程的 -threads 决定，并受内存上限约束；
+    每次发放槽位前还会检查当前负载和可用内存，资源紧张时等待。
+    NVENC 会话与 CPU 槽位分开计数，混合模式下两者同时使用；gpu_available 为 False 时按 CPU 模式调度。
+    """
+
+    def __init__(self, render_mode="cpu", thread_count=0, ffmpeg_threads=0,
+                 nvenc_sessions=DEFAULT_NVENC_SESSIONS, gpu_available=True):
+        self.requested_mode = render_mode
+        if not gpu_available:
+            render_mode = "cpu"
+        self.render_mode = render_mode
+        self.cpus = cpu_count()
+        if thread_count > 0:
+            # 手动指定并发数时平分 CPU，避免每个进程都按全部核心开线程
+            self.cpu_slots = thread_count
+            self.threads_per_job = ffmpeg_threads or max(1, self.cpus // thread_count)
+        else:
+            self.threads_per_job = ffmpeg_threads or min(DEFAULT_THREADS_PER_JOB, self.cpus)
+            self.cpu_slots = max(1, self.cpus // self.threads_per_job)
+            memory = available_memory()
+            if memory is not None:
+                self.cpu_slots = max(1, min(self.cpu_slots, memory // MEMORY_PER_JOB))
+
+        if render_mode == "gpu":
+            self.cpu_slots = 0
+        self.gpu_slots = max(1, nvenc_sessions) if render_mode in ("gpu", "mixed") else 0
+        if render_mode == "gpu" and thread_count > 0:
+            self.gpu_slots = min(self.gpu_slots, thread_count)
+
+        self._cond = threading.Condition()
+        self._running = {"cpu": 0, "gpu": 0}
+
+    @property
+    def max_workers(self):
+        return self.cpu_slots + self.gpu_slots
+
+    def pinned_kind(self):
+        """需要固定设备的任务（如分段编码）使用的槽位类型：有 CPU 槽位时用 CPU"""
+        return "cpu" if self.cpu_slots else "gpu"
+
+    def describe(self):
+        parts = []
+        if self.cpu_slots:
+            parts.append(f"CPU 并发 {self.cpu_slots}（每任务 {self.threads_per_job} 线程）")
+        if self.gpu_slots:
+            parts.append(f"NVENC 并发 {self.gpu_slots}")
+        return "，".join(parts)
+
+    def _system_busy(self):
+        """负载过高或内存不足时返回 True；没有运行中的任务时总是放行"""
+        if self._running["cpu"] == 0:
+            return False
+        load = load_average()
+        if load is not None and load > self.cpus * MAX_LOAD_FACTOR:
+            return True
+        memory = available_memory()
+        return memory is not None and memory < MIN_FREE_MEMORY
+
+    def _try_acquire(self, kind=None):
+        if kind in (None, "gpu") and self._running["gpu"] < self.gpu_slots:
+            self._running["gpu"] += 1
+            return "gpu"
+        if kind in (None, "cpu") and self._running["cpu"] < self.cpu_slots and not self._system_busy():
+            self._running["cpu"] += 1
+            return "cpu"
+        return None
+
+    def acquire(self, should_stop=lambda: False, kind=None):
+        """阻塞直到有空闲槽位，返回 "cpu" 或 "gpu"；should_stop 为真时返回 None
+
+        kind 指定只接受某一类槽位。
+        """
+        with self._cond:
+            while not should_stop():
+                slot = self._try_acquire(kind)
+                if slot is not None:
+                    return slot
+                self._cond.wait(ADMISSION_POLL_INTERVAL)
+        return None
+
+    def release(self, slot):
+        with self._cond:
+            self._running[slot] -= 1
+            self._cond.notify_all()
@@ -1,31 +1,48 @@
 import os
-import subprocess
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, scrolledtext
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
 import datetime
+import time
 import re
 import json
+import logging
+from logging.handlers import RotatingFileHandler
+
+from event_bus import EventBus, TkEventPump
+from encode_cache import CACHE_FILE_NAME, EncodeCache
+from encode_journal import JOURNAL_FILE_NAME, EncodeJournal
+from media_probe import MEDIA_INDEX_FILE_NAME, MediaIndex
+from encode_engine import BatchEncoder, EncodeSettings, build_jobs, is_video_file, scan_video_files
+from file_index import FileIndex, FolderWatcher
+from pipeline_metrics import PipelineMetrics
+from ffmpeg_capabilities import default_probe
 
 # File to store saved paths
 SETTINGS_FILE = "encoder_settings.json"
-
-def check_nvidia_gpu():
-    try:
-        result = subprocess.run(["nvidia-smi"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                              text=True, check=False)
-        return result.returncode == 0
-    except FileNotFoundError:
-        return False
-
-def check_ffmpeg_nvenc_support():
-    try:
-        result = subprocess.run(["ffmpeg", "-encoders"], stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE, text=True, check=False)
-        return result.returncode == 0 and "h264_nvenc" in result.stdout
-    except FileNotFoundError:
-        return False
+# 完整日志写入滚动文件，界面只保留最近的若干行
+LOG_FILE = "encoder.log"
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+MAX_LOG_LINES = 1000
+# 各阶段耗时逐条追加到 JSON Lines 文件
+METRICS_FILE = "encoder_metrics.jsonl"
+
+
+def create_file_logger():
+    """创建写入滚动日志文件的 logger"""
+    logger = logging.getLogger("encoder")
+    if not logger.handlers:
+        try:
+            handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES,
+                                          backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+        except OSError:
+            handler = logging.NullHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
 
 class VideoEncoderApp:
     def __init__(self, root):
@@ -38,24 +55,34 @@ class VideoEncoderApp:
         self.output_folder = ""
         self.is_running = False
         self.cancel_task = False
-        self.thread_count = 1
+        self.thread_count = 0
         self.video_files = []
+        self.known_files = set()
+        self.scan_seconds = None
+        self.engine = None
+        self.watcher = None
+        self.file_logger = create_file_logger()
 
         # 必须先创建界面组件
         self.create_widgets()
 
+        # 工作线程只向事件队列发布消息，由主循环定时批量处理
+        self.bus = EventBus()
+        self.event_pump = TkEventPump(self.root, self.bus, self._handle_engine_event)
+
         # 然后才能调用可能使用log_area的方法
-        # 检测硬件支持
-        self.has_nvidia_gpu = check_nvidia_gpu()
-        self.has_ffmpeg_nvenc = check_ffmpeg_nvenc_support()
-        
+        # 在后台检测 ffmpeg 和显卡支持，完成后再更新渲染方式选项
+        self.capabilities = None
+        default_probe().start(lambda capabilities: self.bus.publish(
+            {"type": "capabilities", "capabilities": capabilities}))
+
         # 加载设置（现在可以安全地使用log_area）
         self._load_settings()
 
         # 如果源文件夹已加载，开始扫描
         if self.source_folder:
             self.parent_folder_label.config(text=self.source_folder, fg="black")
-            self.root.after(100, self._scan_subfolders_threaded)
+            self.root.after(100, self._start_scan)
 
     def _load_settings(self):
         """从文件加载保存的设置"""
@@ -120,10 +147,10 @@ class VideoEncoderApp:
         self.audio_bitrate_entry.insert(0, "128k")
 
         # 线程数输入
-        tk.Label(self.root, text="线程数：", font=("Arial", 10)).grid(row=8, column=0, padx=10, pady=10, sticky="w")
+        tk.Label(self.root, text="线程数（0=自动）：", font=("Arial", 10)).grid(row=8, column=0, padx=10, pady=10, sticky="w")
         self.thread_entry = tk.Entry(self.root, width=10, font=("Arial", 10))
         self.thread_entry.grid(row=8, column=1, padx=10, pady=5, sticky="w")
-        self.thread_entry.insert(0, "1")
+        self.thread_entry.insert(0, "0")
 
         # 渲染方式选择
         self.render_mode = tk.StringVar(value="cpu")
@@ -133,14 +160,19 @@ class VideoEncoderApp:
         self.gpu_button = tk.Radiobutton(self.root, text="显卡渲染", variable=self.render_mode, 
                                        value="gpu", font=("Arial", 10))
         self.gpu_button.grid(row=10, column=1, padx=10, pady=5, sticky="w")
+        self.mixed_button = tk.Radiobutton(self.root, text="混合渲染（显卡+CPU）", variable=self.render_mode,
+                                         value="mixed", font=("Arial", 10))
+        self.mixed_button.grid(row=11, column=1, padx=10, pady=5, sticky="w")
 
         # 进度条
         self.progress = ttk.Progressbar(self.root, orient="horizontal", length=500, mode="determinate")
-        self.progress.grid(row=11, column=0, padx=10, pady=20, columnspan=2)
+        self.progress.grid(row=12, column=0, padx=10, pady=(20, 5), columnspan=2)
+        self.status_label = tk.Label(self.root, text="", fg="gray", font=("Arial", 10))
+        self.status_label.grid(row=13, column=0, padx=10, pady=5, columnspan=2)
 
         # 日志输出
         self.log_area = scrolledtext.ScrolledText(self.root, width=70, height=10, font=("Arial", 10))
-        self.log_area.grid(row=12, column=0, padx=10, pady=10, columnspan=2)
+        self.log_area.grid(row=14, column=0, padx=10, pady=10, columnspan=2)
         self.log_area.config(state=tk.DISABLED)
 
         # 按钮
@@ -148,20 +180,33 @@ class VideoEncoderApp:
             self.root, text="开始编码", command=self.start_encode, 
             bg="green", fg="white", font=("Arial", 10)
         )
-        self.encode_button.grid(row=13, column=0, padx=10, pady=20, columnspan=1)
+        self.encode_button.grid(row=15, column=0, padx=10, pady=20, columnspan=1)
 
         self.cancel_button = tk.Button(
             self.root, text="取消", command=self.cancel_encode, 
             bg="red", fg="white", font=("Arial", 10)
         )
-        self.cancel_button.grid(row=13, column=1, padx=10, pady=20, columnspan=1)
+        self.cancel_button.grid(row=15, column=1, padx=10, pady=20, columnspan=1)
         self.cancel_button.config(state=tk.DISABLED)
 
     def log(self, message):
-        """在日志区域显示消息"""
-        timestamp = datetime.datetime.now().strftime("[%H:%M:%S]")
+        """在日志区域显示消息（只能在主线程调用，工作线程请用 post_log）"""
+        self.file_logger.info(message)
+        self._append_log_lines([(datetime.datetime.now(), message)])
+
+    def post_log(self, message):
+        """从任意线程发布一条日志"""
+        self.file_logger.info(message)
+        self.bus.publish({"type": "log", "message": message, "time": datetime.datetime.now()})
+
+    def _append_log_lines(self, entries):
+        """一次性追加多行日志，并只保留最后 MAX_LOG_LINES 行"""
+        text = "".join(f"{stamp.strftime('[%H:%M:%S]')} {message}\n" for stamp, message in entries)
         self.log_area.config(state=tk.NORMAL)
-        self.log_area.insert(tk.END, f"{timestamp} {message}\n")
+        self.log_area.insert(tk.END, text)
+        line_count = int(self.log_area.index("end-1c").split(".")[0])
+        if line_count > MAX_LOG_LINES + 1:
+            self.log_area.delete("1.0", f"{line_count - MAX_LOG_LINES}.0")
         self.log_area.config(state=tk.DISABLED)
         self.log_area.yview(tk.END)
 
@@ -174,16 +219,33 @@ class VideoEncoderApp:
             self.parent_folder_label.config(text=folder, fg="black")
             self.log(f"已选择父文件夹：{folder}")
             self._save_settings()
-            threading.Thread(target=self._scan_subfolders_threaded, daemon=True).start()
+            self._start_scan()
+
+    def _start_scan(self):
+        """在后台线程中扫描源文件夹，并改为监视新出现的文件"""
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.watcher = FolderWatcher(
+            self.source_folder,
+            lambda path: self.bus.publish({"type": "file_discovered", "path": path}),
+            match=lambda path: is_video_file(os.path.basename(path))
+        )
+        threading.Thread(target=self._scan_subfolders_threaded, daemon=True).start()
 
     def _scan_subfolders_threaded(self):
-        """扫描子文件夹"""
-        self.video_files = []
-        for root, _, files in os.walk(self.source_folder):
-            for file in files:
-                if file.lower().endswith(('.mp4', '.avi', '.mkv', '.mov', '.webm')):
-                    self.video_files.append(os.path.join(root, file))
-        self.root.after(0, lambda: self.log(f"找到 {len(self.video_files)} 个视频文件"))
+        """扫描子文件夹；文件索引只重新列出有变化的目录"""
+        file_index = FileIndex()
+        start = time.perf_counter()
+        try:
+            video_files = scan_video_files(self.source_folder, file_index)
+            self.scan_seconds = time.perf_counter() - start
+            self.known_files = set(video_files)
+            self.video_files = video_files
+        finally:
+            file_index.close()
+        self.post_log(f"找到 {len(self.video_files)} 个视频文件")
+        if self.watcher.start():
+            self.post_log("正在监视源文件夹中的新文件")
 
     def choose_output_folder(self):
         """选择输出文件夹"""
@@ -199,48 +261,16 @@ class VideoEncoderApp:
         """验证比特率格式"""
         return re.fullmatch(r"^\d+(\.\d+)?[kKmMgG]?$", value) is not None
 
-    def run_ffmpeg(self, command):
-        """运行FFmpeg命令"""
-        creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
-        try:
-            process = subprocess.run(
-                command,
-                check=True,
-                capture_output=True,
-                text=True,
-                creationflags=creationflags
-            )
-            self.log(f"FFmpeg 命令执行成功")
-        except subprocess.CalledProcessError as e:
-            self.log(f"FFmpeg 错误：{e.stderr}")
-            raise
-
-    def encode_video(self, input_path, output_path):
-        """编码单个视频"""
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        encoder = "h264_nvenc" if self.render_mode.get() == "gpu" else "libx264"
-        preset = "p5" if encoder == "h264_nvenc" else "medium"
-        
-        command = [
-            "ffmpeg", "-i", input_path,
-            "-vf", "scale=1080:1920", "-r", "25",
-            "-c:v", encoder, "-preset", preset,
-            "-b:v", self.bitrate_entry.get(),
-            "-maxrate", self.maxrate_entry.get(),
-            "-bufsize", self.bufsize_entry.get(),
-            "-c:a", "aac", "-b:a", self.audio_bitrate_entry.get(),
-            "-movflags", "faststart",
-            "-loglevel", "error",
-            output_path
-        ]
-        
-        try:
-            self.run_ffmpeg(command)
-            self.root.after(0, lambda: self.log(f"成功编码: {input_path}"))
-        except Exception as e:
-            self.root.after(0, lambda: self.log(f"编码失败: {input_path}"))
-            raise
+    def _current_settings(self):
+        """从界面输入框读取编码参数"""
+        return EncodeSettings(
+            bitrate=self.bitrate_entry.get(),
+            maxrate=self.maxrate_entry.get(),
+            bufsize=self.bufsize_entry.get(),
+            audio_bitrate=self.audio_bitrate_entry.get(),
+            render_mode=self.render_mode.get(),
+            thread_count=self.thread_count
+        )
 
     def start_encode(self):
         """开始编码任务"""
@@ -256,7 +286,15 @@ class VideoEncoderApp:
         self.cancel_task = False
         self.encode_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.NORMAL)
-        
+
+        cache = EncodeCache(os.path.join(self.output_folder, CACHE_FILE_NAME))
+        journal = EncodeJournal(os.path.join(self.output_folder, JOURNAL_FILE_NAME))
+        media_index = MediaIndex(os.path.join(self.output_folder, MEDIA_INDEX_FILE_NAME))
+        metrics = PipelineMetrics(METRICS_FILE)
+        if self.scan_seconds is not None:
+            metrics.record("scan", self.scan_seconds, job=self.source_folder, files=len(self.video_files))
+        self.engine = BatchEncoder(self._current_settings(), on_event=self._on_engine_event,
+                                   cache=cache, journal=journal, media_index=media_index, metrics=metrics)
         threading.Thread(target=self._encode_videos_threaded, daemon=True).start()
 
     def _validate_inputs(self):
@@ -269,7 +307,7 @@ class VideoEncoderApp:
             return False
         
         try:
-            self.thread_count = max(1, int(self.thread_entry.get()))
+            self.thread_count = max(0, int(self.thread_entry.get()))
         except ValueError:
             messagebox.showerror("错误", "请输入有效的线程数")
             return False
@@ -278,33 +316,67 @@ class VideoEncoderApp:
 
     def _encode_videos_threaded(self):
         """在后台线程中编码视频"""
-        self.root.after(0, lambda: self.progress.config(maximum=len(self.video_files), value=0))
-        
-        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-            futures = []
-            for video_file in self.video_files:
-                if self.cancel_task:
-                    break
-                
-                relative_path = os.path.relpath(video_file, self.source_folder)
-                output_path = os.path.join(self.output_folder, os.path.splitext(relative_path)[0] + ".mp4")
-                futures.append(executor.submit(self.encode_video, video_file, output_path))
-
-            for i, future in enumerate(as_completed(futures), 1):
-                if self.cancel_task:
-                    break
-                try:
-                    future.result()
-                except Exception:
-                    pass
-                self.root.after(0, lambda: self.progress.config(value=i))
-                self.root.after(0, lambda: self.log(f"进度: {i}/{len(self.video_files)}"))
-
-        self._finish_encoding()
+        jobs = build_jobs(self.video_files, self.source_folder, self.output_folder)
+        try:
+            self.engine.run(jobs)
+        finally:
+            self.engine.journal.close()
+            self.engine.metrics.close()
+            self.bus.publish({"type": "encode_finished"})
+
+    def _on_engine_event(self, event):
+        """引擎事件在工作线程中触发：日志直接写入文件，其余交给事件队列"""
+        if event["type"] == "log":
+            self.file_logger.info(event["message"])
+        elif event["type"] == "progress":
+            self.file_logger.info(f"进度: {event['done']}/{event['total']}")
+        self.bus.publish(event)
+
+    def _handle_engine_event(self, event):
+        """在主线程中根据（已合并的）事件更新界面"""
+        if event["type"] == "log_batch":
+            self._append_log_lines([(e["time"], e["message"]) for e in event["events"]])
+        elif event["type"] == "encode_finished":
+            self._finish_encoding()
+        elif event["type"] == "capabilities":
+            self._apply_capabilities(event["capabilities"])
+        elif event["type"] == "file_discovered":
+            path = event["path"]
+            if path.startswith(self.source_folder) and path not in self.known_files:
+                self.known_files.add(path)
+                self.video_files.append(path)
+                self.log(f"发现新文件：{os.path.relpath(path, self.source_folder)}")
+        elif event["type"] == "batch_started":
+            self.progress.config(maximum=event["total"], value=0)
+        elif event["type"] == "progress":
+            self.progress.config(value=event["done"])
+            self._append_log_lines([(event["time"], f"进度: {event['done']}/{event['total']}")])
+        elif event["type"] == "job_progress":
+            batch = event["batch"]
+            status = f"{batch['fps']:.1f} fps"
+            if batch["speed"]:
+                status += f"，{batch['speed']:.2f}x"
+            if batch["eta"] is not None:
+                eta = int(batch["eta"])
+                status += f"，预计剩余 {eta // 3600:d}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+            self.status_label.config(text=status)
+
+    def _apply_capabilities(self, capabilities):
+        """根据检测结果启用或禁用显卡渲染选项"""
+        self.capabilities = capabilities
+        self.log(f"检测到：{capabilities.describe()}")
+        if capabilities.nvenc_available():
+            return
+        self.gpu_button.config(state=tk.DISABLED)
+        self.mixed_button.config(state=tk.DISABLED)
+        if self.render_mode.get() != "cpu":
+            self.render_mode.set("cpu")
+        self.log("未检测到可用的 NVENC，只能使用 CPU 渲染")
 
     def _finish_encoding(self):
         """完成编码后的清理工作"""
         self.is_running = False
+        self.status_label.config(text="")
         self.encode_button.config(state=tk.NORMAL)
         self.cancel_button.config(state=tk.DISABLED)
         
@@ -318,6 +390,8 @@ class VideoEncoderApp:
     def cancel_encode(self):
         """取消编码任务"""
         self.cancel_task = True
+        if self.engine is not None:
+            self.engine.cancel()
         self.log("正在取消任务...")
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+import queue
+
+# 界面每秒刷新约 20 次，每次最多处理的事件数
+DRAIN_INTERVAL_MS = 50
+MAX_EVENTS_PER_DRAIN = 2000
+# 只保留最后一条即可的高频事件
+COALESCED_EVENTS = ("progress", "job_progress")
+
+
+class EventBus:
+    """线程安全的事件队列：工作线程发布，界面线程批量取出"""
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+
+    def publish(self, event):
+        self._queue.put(event)
+
+    def drain(self, max_events=MAX_EVENTS_PER_DRAIN):
+        """取出至多 max_events 个事件，不阻塞"""
+        events = []
+        try:
+            while len(events) < max_events:
+                events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+
+def coalesce(events):
+    """合并一批事件：日志合并为一条 log_batch，高频进度事件只保留最后一条，其余保持原顺序"""
+    result = []
+    messages = []
+    latest = {}
+    for event in events:
+        if event["type"] == "log":
+            messages.append(event)
+        elif event["type"] in COALESCED_EVENTS:
+            latest[event["type"]] = event
+        else:
+            result.append(event)
+    if messages:
+        result.insert(0, {"type": "log_batch", "events": messages})
+    result.extend(latest.values())
+    return result
+
+
+class TkEventPump:
+    """在 Tk 主循环中以固定频率取出事件并交给 handler 处理
+
+    只依赖 root.after，工作线程永远不直接接触界面组件。
+    """
+
+    def __init__(self, root, bus, handler, interval_ms=DRAIN_INTERVAL_MS):
+        self.root = root
+        self.bus = bus
+        self.handler = handler
+        self.interval_ms = interval_ms
+        self.root.after(self.interval_ms, self._pump)
+
+    def _pump(self):
+        try:
+            for event in coalesce(self.bus.drain()):
+                self.handler(event)
+        finally:
+            self.root.after(self.interval_ms, self._pump)
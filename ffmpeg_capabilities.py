@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from encode_profiles import VIDEO_ENCODERS
+
+# 检测结果缓存在当前目录，ffmpeg / nvidia-smi 可执行文件未变化时直接使用
+CAPABILITY_CACHE_FILE = "ffmpeg_capabilities.json"
+CAPABILITY_CACHE_VERSION = 1
+# 显卡和驱动可能在可执行文件不变时变化，缓存超过该时间后重新检测
+CAPABILITY_MAX_AGE = 7 * 24 * 3600
+PROBE_TIMEOUT = 30
+
+
+def _run(command):
+    """运行检测命令并返回标准输出，命令不存在、失败或超时时返回 None"""
+    creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=False,
+                                timeout=PROBE_TIMEOUT, creationflags=creationflags)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+
+def _parse_names(output):
+    """解析 ffmpeg -encoders / -filters 的列表：每行第二列为名称"""
+    names = set()
+    for line in (output or "").splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] != "=":
+            names.add(parts[1])
+    return names
+
+
+def binary_fingerprint(name):
+    """[路径, 大小, 修改时间]，找不到可执行文件时返回 None"""
+    path = shutil.which(name)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+class Capabilities:
+    """ffmpeg 提供的编码器、硬件加速和滤镜，以及检测到的 NVIDIA 显卡"""
+
+    def __init__(self, version=None, encoders=(), hwaccels=(), filters=(), gpus=()):
+        self.version = version
+        self.encoders = set(encoders)
+        self.hwaccels = set(hwaccels)
+        self.filters = set(filters)
+        self.gpus = list(gpus)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("version"), data.get("encoders", ()), data.get("hwaccels", ()),
+                   data.get("filters", ()), data.get("gpus", ()))
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "encoders": sorted(self.encoders),
+            "hwaccels": sorted(self.hwaccels),
+            "filters": sorted(self.filters),
+            "gpus": self.gpus,
+        }
+
+    @property
+    def has_ffmpeg(self):
+        return self.version is not None
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_hwaccel(self, name):
+        return name in self.hwaccels
+
+    def has_filter(self, name):
+        return name in self.filters
+
+    def nvenc_available(self, codecs=("h264",)):
+        """有 NVIDIA 显卡且 ffmpeg 提供这些视频编码的 NVENC 编码器"""
+        return bool(self.gpus) and all(self.has_encoder(VIDEO_ENCODERS[codec]["gpu"]) for codec in codecs)
+
+    def describe(self):
+        if not self.has_ffmpeg:
+            return "未找到 FFmpeg"
+        parts = [self.version]
+        if self.gpus:
+            parts.append(f"显卡 {len(self.gpus)} 块")
+        nvenc = sorted(name for name in self.encoders if name.endswith("_nvenc"))
+        parts.append(f"NVENC: {', '.join(nvenc)}" if nvenc else "无 NVENC 编码器")
+        if self.hwaccels:
+            parts.append(f"硬件加速: {', '.join(sorted(self.hwaccels))}")
+        return "；".join(parts)
+
+
+def probe_capabilities(ffmpeg="ffmpeg"):
+    """并行运行 ffmpeg -version / -encoders / -hwaccels / -filters 和 nvidia-smi -L"""
+    commands = {
+        "version": [ffmpeg, "-hide_banner", "-version"],
+        "encoders": [ffmpeg, "-hide_banner", "-encoders"],
+        "hwaccels": [ffmpeg, "-hide_banner", "-hwaccels"],
+        "filters": [ffmpeg, "-hide_banner", "-filters"],
+        "gpus": ["nvidia-smi", "-L"],
+    }
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        outputs = dict(zip(commands, executor.map(_run, commands.values())))
+    version_lines = (outputs["version"] or "").splitlines()
+    # -hwaccels 第一行为标题
+    hwaccel_lines = (outputs["hwaccels"] or "").splitlines()[1:]
+    return Capabilities(
+        version=version_lines[0].split(" Copyright")[0].strip() if version_lines else None,
+        encoders=_parse_names(outputs["encoders"]),
+        hwaccels=[line.strip() for line in hwaccel_lines if line.strip()],
+        filters=_parse_names(outputs["filters"]),
+        gpus=[line.strip() for line in (outputs["gpus"] or "").splitlines() if line.startswith("GPU")],
+    )
+
+
+class CapabilityProbe:
+    """在后台线程中检测一次 ffmpeg 能力，结果按可执行文件的路径、大小和修改时间缓存
+
+    start() 立即返回；get() 等待检测完成。同一进程内只检测一次，refresh() 强制重新检测。
+    """
+
+    def __init__(self, cache_path=CAPABILITY_CACHE_FILE, ffmpeg="ffmpeg"):
+        self.cache_path = cache_path
+        self.ffmpeg = ffmpeg
+        self.capabilities = None
+        self.from_cache = False
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._callbacks = []
+
+    def start(self, on_ready=None):
+        """开始后台检测；on_ready(capabilities) 在检测完成后（于检测线程中）调用"""
+        with self._lock:
+            if on_ready is not None and not self._ready.is_set():
+                self._callbacks.append(on_ready)
+                on_ready = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._probe, daemon=True)
+                self._thread.start()
+        if on_ready is not None:
+            on_ready(self.capabilities)
+
+    def get(self, timeout=None):
+        """返回检测结果，必要时等待检测完成；超时返回 None"""
+        self.start()
+        self._ready.wait(timeout)
+        return self.capabilities
+
+    def refresh(self):
+        """忽略缓存重新检测"""
+        self.get()
+        with self._lock:
+            self._ready.clear()
+            self._thread = None
+        self._write_cache(None)
+        return self.get()
+
+    def _fingerprint(self):
+        return {"ffmpeg": binary_fingerprint(self.ffmpeg), "nvidia-smi": binary_fingerprint("nvidia-smi")}
+
+    def _read_cache(self, fingerprint):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if (data.get("version") != CAPABILITY_CACHE_VERSION or data.get("fingerprint") != fingerprint
+                or time.time() - data.get("checked", 0) > CAPABILITY_MAX_AGE):
+            return None
+        return Capabilities.from_dict(data["capabilities"])
+
+    def _write_cache(self, entry):
+        """先写临时文件再替换；entry 为 None 时删除缓存"""
+        if not self.cache_path:
+            return
+        if entry is None:
+            try:
+                os.remove(self.cache_path)
+            except OSError:
+                pass
+            return
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def _probe(self):
+        fingerprint = self._fingerprint()
+        capabilities = self._read_cache(fingerprint)
+        self.from_cache = capabilities is not None
+        if capabilities is None:
+            capabilities = probe_capabilities(self.ffmpeg)
+            # 找不到 ffmpeg 时不缓存，安装后下次启动即可检测到
+            if capabilities.has_ffmpeg:
+                self._write_cache({
+                    "version": CAPABILITY_CACHE_VERSION,
+                    "fingerprint": fingerprint,
+                    "checked": time.time(),
+                    "capabilities": capabilities.to_dict(),
+                })
+        with self._lock:
+            self.capabilities = capabilities
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(capabilities)
+
+
+_default_probe = None
+_default_lock = threading.Lock()
+
+
+def default_probe():
+    """进程内共享的检测器"""
+    global _default_probe
+    with _default_lock:
+        if _default_probe is None:
+            _default_probe = CapabilityProbe()
+        return _default_probe
+
+
+def get_capabilities(timeout=None):
+    """共享检测器的结果，必要时等待检测完成"""
+    return default_probe().get(timeout)
@@ -0,0 +1,199 @@
+import os
+import time
+import signal
+import subprocess
+import threading
+from collections import deque
+
+# 失败时保留的 stderr 行数，避免巨大的错误输出全部留在内存里
+STDERR_TAIL_LINES = 200
+# 取消时先请求 FFmpeg 退出，超过该秒数仍未退出则强制结束
+TERMINATE_GRACE_PERIOD = 5
+
+
+class FFmpegError(subprocess.CalledProcessError):
+    """FFmpeg 以非零状态退出，stderr 只包含最后若干行"""
+
+    def __str__(self):
+        return f"FFmpeg 退出码 {self.returncode}：{self.stderr.strip()[-500:]}"
+
+
+def write_concat_list(paths, list_path, outpoints=None):
+    """写入 concat demuxer 使用的文件列表（转义路径中的单引号）
+
+    outpoints 与 paths 一一对应，不为 None 的片段只使用到该时间点。
+    """
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path, outpoint in zip(paths, outpoints or [None] * len(paths)):
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if outpoint is not None:
+                f.write(f"outpoint {outpoint:.6f}\n")
+
+
+def _parse_time(value):
+    """把 out_time（HH:MM:SS.micro）转换为秒"""
+    try:
+        hours, minutes, seconds = value.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def _parse_progress_block(fields, duration):
+    """把一组 -progress 键值转换为进度事件字典"""
+    out_time = None
+    if fields.get("out_time_us", "N/A") != "N/A":
+        try:
+            out_time = int(fields["out_time_us"]) / 1_000_000
+        except ValueError:
+            pass
+    if out_time is None and "out_time" in fields:
+        out_time = _parse_time(fields["out_time"])
+
+    def number(key, cast=float):
+        try:
+            return cast(fields.get(key, "").rstrip("x"))
+        except ValueError:
+            return None
+
+    progress = {
+        "frame": number("frame", int),
+        "fps": number("fps"),
+        "speed": number("speed"),
+        "out_time": out_time,
+        "total_size": number("total_size", int),
+        "finished": fields.get("progress") == "end",
+    }
+    if duration and out_time is not None:
+        progress["percent"] = max(0.0, min(100.0, out_time * 100 / duration))
+    else:
+        progress["percent"] = None
+    return progress
+
+
+def run_ffmpeg_streaming(command, on_progress=None, duration=None,
+                         stderr_lines=STDERR_TAIL_LINES, on_start=None):
+    """以流式方式运行 FFmpeg
+
+    自动加上 -progress pipe:1，逐块解析进度并回调 on_progress；
+    stderr 在独立线程中读取，只保留最后 stderr_lines 行。
+    on_start 在子进程启动后以 Popen 对象调用。失败时抛出 FFmpegError。
+    子进程放在独立的进程组中，便于 terminate_process 连同其子进程一起结束。
+    """
+    command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    if os.name == 'nt':
+        creationflags = subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        creationflags = 0
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        creationflags=creationflags,
+        start_new_session=os.name != 'nt'
+    )
+    if on_start is not None:
+        on_start(process)
+
+    stderr_tail = deque(maxlen=stderr_lines)
+
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line)
+
+    stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_thread.start()
+
+    fields = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        fields[key] = value
+        if key == "progress":
+            if on_progress is not None:
+                on_progress(_parse_progress_block(fields, duration))
+            fields = {}
+
+    returncode = process.wait()
+    stderr_thread.join()
+    stderr = "".join(stderr_tail)
+    if returncode != 0:
+        raise FFmpegError(returncode, command, stderr=stderr)
+    return stderr
+
+
+def _signal_process(process, sig):
+    """向进程所在进程组发送信号（Windows 上退化为结束单个进程）"""
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            if sig == signal.SIGTERM:
+                process.terminate()
+            else:
+                process.kill()
+        else:
+            os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+def terminate_processes(processes, grace_period=TERMINATE_GRACE_PERIOD):
+    """先发送 SIGTERM，等待至多 grace_period 秒后对仍在运行的进程发送 SIGKILL"""
+    for process in processes:
+        _signal_process(process, signal.SIGTERM)
+    deadline = time.monotonic() + grace_period
+    for process in processes:
+        try:
+            process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            _signal_process(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+
+class ThroughputTracker:
+    """汇总线程池中所有任务的进度，计算总帧率和剩余时间
+
+    total_duration 为全部待编码任务的时长之和（秒）；未知时只统计帧率。
+    """
+
+    def __init__(self, total_duration=None):
+        self.total_duration = total_duration
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._running = {}
+        self._finished_media = 0.0
+
+    def update(self, key, progress):
+        with self._lock:
+            self._running[key] = progress
+
+    def finish(self, key, duration=None):
+        """任务结束，把其处理量计入已完成部分"""
+        with self._lock:
+            progress = self._running.pop(key, None) or {}
+            self._finished_media += duration or progress.get("out_time") or 0
+
+    def snapshot(self):
+        """返回 {"fps", "speed", "eta", "elapsed"}，无法估计的值为 None"""
+        with self._lock:
+            running = list(self._running.values())
+            finished_media = self._finished_media
+        elapsed = time.monotonic() - self.start_time
+        fps = sum(p.get("fps") or 0 for p in running)
+        speed = sum(p.get("speed") or 0 for p in running)
+        processed = finished_media + sum(p.get("out_time") or 0 for p in running)
+
+        eta = None
+        if self.total_duration:
+            remaining = max(0.0, self.total_duration - processed)
+            # 优先用当前瞬时速度，刚开始或没有运行任务时退回整体平均速度
+            rate = speed or (processed / elapsed if elapsed > 0 else 0)
+            if rate > 0:
+                eta = remaining / rate
+        return {"fps": fps, "speed": speed or None, "eta": eta, "elapsed": elapsed}
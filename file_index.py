@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import queue
+import sqlite3
+import threading
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# 两个工具共用的文件索引，与设置文件一样保存在当前目录
+FILE_INDEX_FILE = "file_index.sqlite3"
+# 目录修改时间距上次扫描不足该秒数时不信任缓存（网络盘时间戳精度较粗）
+RACY_SECONDS = 2
+
+
+class FileIndex:
+    """基于 SQLite 的增量文件索引
+
+    用 os.scandir 列目录，记录每个目录的修改时间和其中的条目（文件附带大小和修改时间）。
+    再次扫描时目录修改时间未变就直接使用缓存的条目，只需对每个目录做一次 stat，
+    不必重新列目录、也不必 stat 其中的每个文件。
+    注意：只修改文件内容不会改变目录的修改时间，缓存中的文件大小可能已过期。
+    """
+
+    def __init__(self, path=FILE_INDEX_FILE):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs ("
+            " path TEXT PRIMARY KEY,"
+            " mtime INTEGER NOT NULL,"
+            " checked REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " dir TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " is_dir INTEGER NOT NULL,"
+            " size INTEGER,"
+            " mtime INTEGER,"
+            " PRIMARY KEY (dir, name)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _cached(self, key, mtime):
+        row = self._conn.execute("SELECT mtime, checked FROM dirs WHERE path = ?", (key,)).fetchone()
+        if row is None or row[0] != mtime or row[1] - mtime / 1e9 < RACY_SECONDS:
+            return None
+        return self._conn.execute(
+            "SELECT name, is_dir FROM entries WHERE dir = ? ORDER BY name", (key,)
+        ).fetchall()
+
+    def _forget_tree(self, key):
+        """删除已不存在的目录及其下全部记录"""
+        prefix = key.rstrip(os.sep) + os.sep
+        self._conn.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                           (key, len(prefix), prefix))
+        self._conn.execute("DELETE FROM entries WHERE dir = ? OR substr(dir, 1, ?) = ?",
+                           (key, len(prefix), prefix))
+
+    def listdir(self, path):
+        """返回 (子目录名列表, 文件名列表)，目录不存在或无法读取时抛出 OSError"""
+        key = os.path.abspath(path)
+        mtime = os.stat(key).st_mtime_ns
+        with self._lock:
+            rows = self._cached(key, mtime)
+        if rows is not None:
+            return [name for name, is_dir in rows if is_dir], [name for name, is_dir in rows if not is_dir]
+
+        entries = []
+        with os.scandir(key) as it:
+            for entry in it:
+                try:
+                    # 与 os.walk 一样不跟随指向目录的符号链接，避免链接成环时无限递归
+                    if entry.is_dir(follow_symlinks=False):
+                        entries.append((key, entry.name, 1, None, None))
+                    elif entry.is_dir():
+                        continue
+                    else:
+                        st = entry.stat()
+                        entries.append((key, entry.name, 0, st.st_size, st.st_mtime_ns))
+                except OSError:
+                    continue
+        entries.sort(key=lambda e: e[1])
+        names = {e[1] for e in entries if e[2]}
+        with self._lock:
+            old_dirs = [row[0] for row in self._conn.execute(
+                "SELECT name FROM entries WHERE dir = ? AND is_dir = 1", (key,))]
+            for name in old_dirs:
+                if name not in names:
+                    self._forget_tree(os.path.join(key, name))
+            self._conn.execute("DELETE FROM entries WHERE dir = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO entries (dir, name, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?)", entries
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, mtime, checked) VALUES (?, ?, ?)",
+                (key, mtime, time.time())
+            )
+            self._conn.commit()
+        return [e[1] for e in entries if e[2]], [e[1] for e in entries if not e[2]]
+
+    def walk(self, top):
+        """与 os.walk(top) 相同的自上而下遍历，无法读取的目录被忽略"""
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                dirnames, filenames = self.listdir(dirpath)
+            except OSError:
+                continue
+            yield dirpath, dirnames, filenames
+            # 旧索引中可能把符号链接记为子目录
+            stack.extend(path for path in (os.path.join(dirpath, name) for name in reversed(dirnames))
+                         if not os.path.islink(path))
+
+    def stat(self, path):
+        """返回索引中记录的 (大小, 修改时间)，没有记录时返回 None"""
+        folder, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM entries WHERE dir = ? AND name = ? AND is_dir = 0", (folder, name)
+            ).fetchone()
+        return row
+
+
+def iter_batches(iterable, batch_size=200, max_wait=2.0, should_stop=None, poll_interval=0.2):
+    """在后台线程中消费 iterable，凑满 batch_size 个或等待超过 max_wait 秒就产出一批
+
+    用于边扫描边处理：第一批文件不必等整个目录树遍历完。should_stop 返回真时不再产出，
+    并让后台线程尽快停止遍历；等待新文件时每隔 poll_interval 秒检查一次。
+    """
+    items = queue.Queue()
+    done = object()
+    errors = []
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    break
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    batch = []
+    deadline = None
+    try:
+        while True:
+            if should_stop is not None and should_stop():
+                return
+            timeout = poll_interval if not batch else min(poll_interval, max(0.0, deadline - time.monotonic()))
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                if batch and time.monotonic() >= deadline:
+                    yield batch
+                    batch = []
+                continue
+            if item is done:
+                break
+            if not batch:
+                deadline = time.monotonic() + max_wait
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    finally:
+        # 取消或调用方提前关闭生成器时让后台线程停止遍历
+        stopped.set()
+    if batch:
+        yield batch
+    if errors:
+        raise errors[0]
+
+
+class _WatchHandler:
+    """把 watchdog 事件转换为新文件回调"""
+
+    # Linux 下等文件写完关闭后再通知，其他平台没有关闭事件，只能在创建时通知
+    READY_EVENTS = ("closed", "moved") if sys.platform.startswith("linux") else ("created", "moved")
+
+    def __init__(self, on_file, match):
+        self.on_file = on_file
+        self.match = match
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in self.READY_EVENTS:
+            return
+        path = event.dest_path if event.event_type == "moved" else event.src_path
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if self.match(path):
+            self.on_file(path)
+
+
+class FolderWatcher:
+    """监视文件夹（Linux 下为 inotify），有新文件时调用 on_file(path)
+
+    依赖可选的 watchdog 包，未安装时 available 为 False，start() 不做任何事。
+    回调在 watchdog 的线程中执行。
+    """
+
+    available = Observer is not None
+
+    def __init__(self, folder, on_file, match=lambda path: True):
+        self.folder = folder
+        self.handler = _WatchHandler(on_file, match)
+        self.observer = None
+
+    def start(self):
+        if not self.available or self.observer is not None:
+            return False
+        self.observer = Observer()
+        self.observer.schedule(self.handler, self.folder, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+        return True
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
@@ -0,0 +1,75 @@
+import os
+import json
+import threading
+
+
+def stat_identity(st):
+    """由 os.stat 结果得到文件身份：大小和修改时间"""
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def is_current(entry, st):
+    """条目记录的大小和修改时间是否与 os.stat 结果一致"""
+    return bool(entry) and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns
+
+
+class JsonManifest:
+    """带版本号的 JSON 清单，文件内容为 {"version": VERSION, "entries": {...}}
+
+    文件损坏或版本不符时从空清单开始。子类在 _lock 下修改 entries 并置 dirty，
+    save() 先写临时文件再替换，避免中途退出时清单损坏。path 为 None 时只在内存中保存。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        # 可能有多个线程同时保存，临时文件只能由一个线程写
+        self._save_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        if data.get("version") == self.VERSION:
+            self.entries = data.get("entries", {})
+
+    def save(self):
+        """先写临时文件再替换"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self.dirty:
+                    return
+                # 在锁内序列化，写文件时其他线程可以继续修改条目
+                text = json.dumps({"version": self.VERSION, "entries": self.entries}, ensure_ascii=False)
+                self.dirty = False
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+
+    def current(self, key, st):
+        """返回与文件当前大小和修改时间一致的条目，否则返回 None"""
+        with self._lock:
+            entry = self.entries.get(key)
+        return entry if is_current(entry, st) else None
+
+    def store(self, key, st, **fields):
+        """以文件当前身份记录条目"""
+        entry = stat_identity(st)
+        entry.update(fields)
+        with self._lock:
+            self.entries[key] = entry
+            self.dirty = True
+        return entry
@@ -0,0 +1,177 @@
+import os
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from json_manifest import JsonManifest
+
+# 媒体索引默认保存在输出文件夹中
+MEDIA_INDEX_FILE_NAME = ".media_index.json"
+MEDIA_INDEX_VERSION = 2
+
+# 编码策略
+STRATEGY_COPY = "copy"      # 音视频都符合目标，只做封装
+STRATEGY_AUDIO = "audio"    # 视频符合目标，只重编码音频
+STRATEGY_ENCODE = "encode"  # 完整重编码
+
+
+def parse_bitrate(value):
+    """把 3M / 128k 这样的比特率字符串转换为 bit/s"""
+    value = str(value).strip()
+    units = {"k": 1e3, "m": 1e6, "g": 1e9}
+    multiplier = units.get(value[-1:].lower(), 1)
+    number = value[:-1] if value[-1:].lower() in units else value
+    return int(float(number) * multiplier)
+
+
+def _parse_rate(value):
+    """把 ffprobe 的 25/1 形式帧率转换为浮点数"""
+    try:
+        num, _, den = str(value).partition("/")
+        return float(num) / float(den or 1) if float(den or 1) else None
+    except ValueError:
+        return None
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_media(path):
+    """用 ffprobe 读取媒体信息，失败返回 None"""
+    creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-print_format", "json",
+             "-show_format", "-show_streams", path],
+            capture_output=True, text=True, encoding="utf-8", errors="replace",
+            check=False, creationflags=creationflags
+        )
+        data = json.loads(result.stdout or "{}")
+    except (OSError, ValueError):
+        return None
+    if result.returncode != 0 or "format" not in data:
+        return None
+
+    fmt = data["format"]
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), None)
+
+    try:
+        duration = float(fmt.get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    info = {
+        "format": fmt.get("format_name"),
+        "duration": duration,
+        "bit_rate": _int_or_none(fmt.get("bit_rate")),
+        "video": None,
+        "audio": None,
+    }
+    if video:
+        fps = _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate"))
+        info["video"] = {
+            "codec": video.get("codec_name"),
+            "width": _int_or_none(video.get("width")),
+            "height": _int_or_none(video.get("height")),
+            "fps": fps,
+            "frame_rate": video.get("avg_frame_rate") or video.get("r_frame_rate"),
+            "time_base": video.get("time_base"),
+            "pix_fmt": video.get("pix_fmt"),
+            "bit_rate": _int_or_none(video.get("bit_rate")),
+        }
+    if audio:
+        info["audio"] = {
+            "codec": audio.get("codec_name"),
+            "sample_rate": _int_or_none(audio.get("sample_rate")),
+            "channels": _int_or_none(audio.get("channels")),
+            "bit_rate": _int_or_none(audio.get("bit_rate")),
+        }
+    return info
+
+
+class MediaIndex(JsonManifest):
+    """媒体信息索引
+
+    以源文件路径为键，文件大小和修改时间未变时直接复用上次的探测结果。
+    path 为 None 时只在内存中缓存。
+    """
+
+    VERSION = MEDIA_INDEX_VERSION
+
+    def get(self, path):
+        """返回媒体信息，必要时调用 ffprobe；探测失败返回 None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self.current(path, st)
+        if entry:
+            return entry["info"]
+        info = probe_media(path)
+        if info is not None:
+            self.store(path, st, info=info)
+        return info
+
+    def probe_all(self, paths, max_workers=8):
+        """并行探测一批文件，返回 {路径: 信息}"""
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(paths, executor.map(self.get, paths)))
+
+
+class TargetProfile:
+    """编码目标规格，用来判断源文件能否走快速路径"""
+
+    def __init__(self, width=1080, height=1920, fps=25, video_codec="h264", pix_fmt="yuv420p",
+                 max_video_bitrate=None, audio_codec="aac", max_audio_bitrate=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.video_codec = video_codec
+        self.pix_fmt = pix_fmt
+        self.max_video_bitrate = max_video_bitrate
+        self.audio_codec = audio_codec
+        self.max_audio_bitrate = max_audio_bitrate
+
+    def video_matches(self, info):
+        video = info.get("video") if info else None
+        if not video:
+            return False
+        bit_rate = video.get("bit_rate")
+        if bit_rate is None and info.get("bit_rate") is not None:
+            # 部分容器（如 mkv）不给出单流码率，用总码率减去音频码率估计
+            audio_rate = (info.get("audio") or {}).get("bit_rate") or 0
+            bit_rate = info["bit_rate"] - audio_rate
+        return (
+            video.get("codec") == self.video_codec
+            and video.get("width") == self.width
+            and video.get("height") == self.height
+            and video.get("fps") is not None and abs(video["fps"] - self.fps) < 0.01
+            and video.get("pix_fmt") == self.pix_fmt
+            and bit_rate is not None
+            and (self.max_video_bitrate is None or bit_rate <= self.max_video_bitrate)
+        )
+
+    def audio_matches(self, info):
+        audio = info.get("audio")
+        if audio is None:
+            return True
+        bit_rate = audio.get("bit_rate")
+        return (
+            audio.get("codec") == self.audio_codec
+            and (self.max_audio_bitrate is None
+                 or (bit_rate is not None and bit_rate <= self.max_audio_bitrate * 1.1))
+        )
+
+    def choose_strategy(self, info):
+        """根据媒体信息选择 copy / audio / encode"""
+        if not self.video_matches(info):
+            return STRATEGY_ENCODE
+        if self.audio_matches(info):
+            return STRATEGY_COPY
+        return STRATEGY_AUDIO
@@ -0,0 +1,236 @@
+import os
+import time
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from encode_journal import partial_path
+from ffmpeg_runner import FFmpegError, run_ffmpeg_streaming, terminate_processes, write_concat_list
+from pipeline_metrics import file_size
+from output_staging import SIZE_MARGIN, OutputStager
+
+
+def merge_videos(video_files, output_path, on_start=None, outpoints=None):
+    """用 concat demuxer 无损拼接视频
+
+    每次调用使用独立的临时列表文件，可以安全地并行执行；
+    先写入临时输出，成功后再改名为正式文件。outpoints 见 write_concat_list。
+    """
+    fd, list_path = tempfile.mkstemp(prefix="concat_", suffix=".txt")
+    os.close(fd)
+    tmp_path = partial_path(output_path)
+    try:
+        write_concat_list(video_files, list_path, outpoints)
+        command = [
+            "ffmpeg",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", list_path,
+            "-c", "copy",
+            "-loglevel", "error",
+            "-y", tmp_path,
+        ]
+        run_ffmpeg_streaming(command, on_start=on_start)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        os.remove(list_path)
+
+
+class MergeJob:
+    """一次合成：把选中的片段拼接为一个输出文件
+
+    outpoints 与 video_files 一一对应，不为 None 的片段只使用到该时间点；duration 为规划的总时长。
+    """
+
+    def __init__(self, index, video_files, output_path, outpoints=None):
+        self.index = index
+        self.video_files = video_files
+        self.output_path = output_path
+        self.outpoints = outpoints or [None] * len(video_files)
+        self.duration = None
+        self.error = None
+
+
+class MergeEngine:
+    """并发合成引擎
+
+    jobs 可以是生成器：片段选择在调用 run() 的线程上按顺序进行，保证结果可复现；
+    拼接在线程池中执行，同时在途的任务数不超过 max_in_flight，选择不会远远领先于拼接。
+    给出 normalizer（ClipNormalizer）时，规格不一致的片段先转换为统一规格再拼接。
+    给出 metrics（PipelineMetrics）时记录转换和拼接的耗时。
+    stager（OutputStager）在拼接前检查磁盘空间，配置了暂存目录时先在本地拼接再后台复制到目标文件夹。
+    进度通过 on_event 回调以字典形式发布（在工作线程中调用）。
+    """
+
+    def __init__(self, thread_count=1, on_event=None, max_in_flight=None, normalizer=None, metrics=None,
+                 stager=None):
+        self.thread_count = max(1, int(thread_count))
+        self.max_in_flight = max_in_flight or self.thread_count * 2
+        self.on_event = on_event
+        self.normalizer = normalizer
+        self.metrics = metrics
+        self.stager = stager if stager is not None else OutputStager(metrics=metrics)
+        self.cancel_task = False
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    def emit(self, event_type, **data):
+        if self.on_event is None:
+            return
+        data["type"] = event_type
+        data.setdefault("time", datetime.datetime.now())
+        self.on_event(data)
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    def cancel(self):
+        """不再开始新的合成，并结束正在运行的 FFmpeg 进程"""
+        self.cancel_task = True
+        with self._lock:
+            processes = list(self._processes)
+        if processes:
+            threading.Thread(target=terminate_processes, args=(processes,), daemon=True).start()
+
+    def merge(self, job, on_published=None):
+        """执行一次合成，没有可用片段或已取消时返回 False
+
+        返回 True 后，输出文件到位时调用 on_published(error)（暂存时在复制线程中）。
+        """
+        processes = []
+
+        def on_start(process):
+            processes.append(process)
+            with self._lock:
+                self._processes.add(process)
+            if self.cancel_task:
+                threading.Thread(target=terminate_processes, args=([process],), daemon=True).start()
+
+        try:
+            video_files = job.video_files
+            outpoints = job.outpoints
+            if self.normalizer is not None:
+                video_files = []
+                outpoints = []
+                for path, outpoint in zip(job.video_files, job.outpoints):
+                    start = time.perf_counter()
+                    resolved = self.normalizer.resolve(path, on_start=on_start)
+                    if self.metrics is not None and resolved not in (None, path):
+                        self.metrics.record("normalize", time.perf_counter() - start, job=path,
+                                            bytes_in=file_size(path), bytes_out=file_size(resolved))
+                    if resolved is None:
+                        self.log(f"无法读取媒体信息，已跳过：{path}")
+                    else:
+                        video_files.append(resolved)
+                        # 截短点按源文件的关键帧规划，不适用于转换后的文件
+                        if outpoint is not None and resolved != path:
+                            self.log(f"片段已转换，不再截短：{path}")
+                            outpoint = None
+                        outpoints.append(outpoint)
+                if self.cancel_task or not video_files:
+                    return False
+            # 无损拼接的输出大小约等于各片段之和
+            bytes_in = sum(file_size(path) or 0 for path in video_files)
+            reservation = self.stager.admit([job.output_path], int(bytes_in * SIZE_MARGIN),
+                                            lambda: self.cancel_task)
+            if reservation is None:
+                return False
+            target = self.stager.staged_path(job.output_path) if self.stager.staging else job.output_path
+            try:
+                if self.metrics is None:
+                    merge_videos(video_files, target, on_start=on_start, outpoints=outpoints)
+                else:
+                    with self.metrics.timer("concat", job=job.output_path, bytes_in=bytes_in,
+                                            clips=len(video_files)) as fields:
+                        merge_videos(video_files, target, on_start=on_start, outpoints=outpoints)
+                        fields["bytes_out"] = file_size(target)
+            except BaseException:
+                self.stager.release(reservation)
+                raise
+            if self.stager.staging:
+                self.stager.commit(reservation, [(target, job.output_path)], on_published)
+            else:
+                self.stager.release(reservation)
+                if on_published is not None:
+                    on_published(None)
+            return True
+        finally:
+            with self._lock:
+                self._processes.difference_update(processes)
+
+    def run(self, jobs, total):
+        """执行全部合成任务，返回 {"done", "failed", "cancelled"}；run() 之前的取消同样有效"""
+        self.emit("batch_started", total=total)
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        counts = {"done": 0, "failed": 0, "finished": 0}
+        counts_lock = threading.Lock()
+
+        def finish(job, result):
+            with counts_lock:
+                if result:
+                    counts[result] += 1
+                counts["finished"] += 1
+                finished = counts["finished"]
+            self.emit("progress", done=finished, total=total, job=job)
+
+        def on_published(job, error):
+            if error is not None:
+                job.error = error
+                self.log(f"移动合成结果失败：{error}")
+                try:
+                    os.remove(self.stager.staged_path(job.output_path))
+                except OSError:
+                    pass
+            finish(job, "failed" if error is not None else "done")
+
+        def run_job(job):
+            result = None
+            try:
+                if job.video_files and not self.cancel_task and \
+                        self.merge(job, lambda error: on_published(job, error)):
+                    # 结果在输出文件到位后记录
+                    return
+            except FFmpegError as e:
+                job.error = e
+                result = "failed"
+                if not self.cancel_task:
+                    self.log(f"合并视频失败：{e.stderr.strip()}")
+            except OSError as e:
+                job.error = e
+                result = "failed"
+                self.log(f"合并视频失败：{e}")
+            except Exception as e:
+                # 转换、探测或列表文件中的意外错误同样记为失败，保证进度能走完
+                job.error = e
+                result = "failed"
+                self.log(f"合并视频时发生意外错误：{type(e).__name__}: {e}")
+            finally:
+                slots.release()
+            finish(job, result)
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            for job in jobs:
+                # 等待在途任务数降到上限以下，期间可以响应取消
+                while not slots.acquire(timeout=0.2):
+                    if self.cancel_task:
+                        break
+                if self.cancel_task:
+                    break
+                executor.submit(run_job, job)
+        self.stager.drain()
+
+        summary = {"done": counts["done"], "failed": counts["failed"], "cancelled": self.cancel_task}
+        if self.metrics is not None:
+            self.metrics.flush()
+            if self.metrics.stages:
+                self.log(f"阶段耗时：{self.metrics.describe()}")
+            summary["metrics"] = self.metrics.summary()
+        self.emit("batch_finished", **summary)
+        return summary
@@ -0,0 +1,369 @@
+import os
+import re
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from encode_journal import partial_path
+from segment_encode import segment_dir
+
+# 估算输出大小时的余量（容器开销和码率波动）
+SIZE_MARGIN = 1.2
+# 配置了暂存目录时每个磁盘默认至少保留的可用空间
+MIN_FREE_BYTES = 2 * 1024 ** 3
+# 待复制的数据按当前写入速度需要超过该秒数时暂停接纳新任务
+MAX_BACKLOG_SECONDS = 120
+DEFAULT_COPY_WORKERS = 2
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+ADMISSION_POLL_INTERVAL = 0.5
+# 写入速度取指数滑动平均
+BANDWIDTH_SMOOTHING = 0.3
+# 暂存目录中每个进程的子目录名前缀；同名的 .lock 文件在进程存活期间一直被锁定
+STAGING_PREFIX = "staging_"
+LOCK_SUFFIX = ".lock"
+
+
+def _existing_parent(path):
+    """path 本身或最近的已存在上级目录"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def free_space(path):
+    """path 所在磁盘的可用字节数，无法获取时返回 None"""
+    try:
+        return shutil.disk_usage(_existing_parent(path)).free
+    except OSError:
+        return None
+
+
+def device_of(path):
+    """path 所在磁盘的标识，用于把同一磁盘上的预留合并计算"""
+    try:
+        return os.stat(_existing_parent(path)).st_dev
+    except OSError:
+        return None
+
+
+def _try_lock(f):
+    """非阻塞地对文件加排他锁；进程退出时操作系统自动释放"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _discard_lock(f, lock_path):
+    """删除并关闭锁文件：POSIX 上在持有锁时删除，Windows 上打开的文件无法删除，只能先关闭"""
+    if fcntl is not None:
+        try:
+            os.remove(lock_path)
+        finally:
+            f.close()
+        return True
+    f.close()
+    try:
+        os.remove(lock_path)
+    except OSError:
+        # 其他进程刚刚打开了它
+        return False
+    return True
+
+
+def reclaim_stale_staging(scratch_dir):
+    """删除已退出（包括崩溃或被强制结束）的进程留下的暂存子目录，返回删除的数量
+
+    子目录对应的锁文件能被锁定说明其所有者已不在运行；没有锁文件的子目录同样视为遗留。
+    """
+    try:
+        names = os.listdir(scratch_dir)
+    except OSError:
+        return 0
+    stems = {name[:-len(LOCK_SUFFIX)] if name.endswith(LOCK_SUFFIX) else name
+             for name in names if name.startswith(STAGING_PREFIX)}
+    reclaimed = 0
+    for stem in sorted(stems):
+        folder = os.path.join(scratch_dir, stem)
+        lock_path = folder + LOCK_SUFFIX
+        if os.path.exists(lock_path):
+            try:
+                f = open(lock_path, 'a+')
+            except OSError:
+                continue
+            if not _try_lock(f):
+                f.close()
+                continue
+            if not _discard_lock(f, lock_path):
+                continue
+        if os.path.isdir(folder):
+            shutil.rmtree(folder, ignore_errors=True)
+            reclaimed += 1
+    return reclaimed
+
+
+def estimate_output_size(bits_per_second, duration):
+    """按码率 × 时长估算输出字节数（含余量）"""
+    return int(bits_per_second * duration / 8 * SIZE_MARGIN)
+
+
+class Reservation:
+    """一个任务在各磁盘上预留的空间，{磁盘: (路径, 字节数)}"""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.released = False
+
+
+class OutputStager:
+    """输出暂存：先写到本地暂存目录，再由后台复制线程移动到目标文件夹
+
+    admit() 在开始任务前按估算的输出大小预留暂存盘和目标盘的空间，
+    空间不足或待复制的数据超过写入速度能在 max_backlog_seconds 内消化的量时等待；
+    commit() 把完成的文件交给最多 copy_workers 个复制线程。
+    scratch_dir 为 None 时直接写入目标文件夹，只做空间检查。
+    min_free_bytes 为 None 时，有暂存目录则保留 MIN_FREE_BYTES，否则不保留；
+    不保留空间时估算只用于排队，等待也无法满足的任务照常开始，由实际写入决定成败。
+    给出 metrics（PipelineMetrics）时把每次移动记录为 io 阶段。
+    tag（如多机编码的工作端名称）加入临时文件名，共用输出文件夹的多个进程不会写同一个临时文件。
+    每个进程在暂存目录下使用独立的子目录，并在存活期间锁定同名的 .lock 文件；
+    创建时先清理已退出进程遗留的子目录（数量记在 reclaimed 中）。
+    """
+
+    def __init__(self, scratch_dir=None, copy_workers=DEFAULT_COPY_WORKERS, min_free_bytes=None,
+                 max_backlog_seconds=MAX_BACKLOG_SECONDS, metrics=None, tag=None):
+        self.tag = re.sub(r"[^\w.-]", "_", tag) if tag else None
+        self.scratch_dir = None
+        self.reclaimed = 0
+        self._lock_file = None
+        self._lock_path = None
+        if scratch_dir:
+            os.makedirs(scratch_dir, exist_ok=True)
+            self.reclaimed = reclaim_stale_staging(scratch_dir)
+            self.scratch_dir = self._create_scratch(scratch_dir)
+        if min_free_bytes is None:
+            min_free_bytes = MIN_FREE_BYTES if scratch_dir else 0
+        self.min_free_bytes = min_free_bytes
+        self.max_backlog_seconds = max_backlog_seconds
+        self.metrics = metrics
+        self.bandwidth = None
+        self._backlog = 0
+        self._reserved = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, copy_workers)) if self.scratch_dir else None
+
+    @property
+    def staging(self):
+        return self.scratch_dir is not None
+
+    def _create_scratch(self, scratch_dir):
+        """先创建并锁定 .lock 文件，再创建同名子目录，结束时整体删除"""
+        while True:
+            fd, lock_path = tempfile.mkstemp(prefix=STAGING_PREFIX, suffix=LOCK_SUFFIX, dir=scratch_dir)
+            f = os.fdopen(fd, 'a+')
+            # 锁定前可能被其他进程的清理当作遗留删除，此时换一个名字重试
+            if _try_lock(f) and os.path.exists(lock_path):
+                break
+            f.close()
+        self._lock_file = f
+        self._lock_path = lock_path
+        folder = lock_path[:-len(LOCK_SUFFIX)]
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def _scratch_name(self, output_path):
+        digest = hashlib.sha1(os.path.abspath(output_path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.scratch_dir, f"{digest}_{os.path.basename(output_path)}")
+
+    def staged_path(self, output_path):
+        """编码过程中写入的临时路径：暂存目录中的文件，或目标文件夹中的 .partial 文件"""
+        if self.staging:
+            return self._scratch_name(output_path)
+        return partial_path(output_path, self.tag)
+
+    def segment_folder(self, output_path):
+        """分段编码的中间目录"""
+        if self.staging:
+            return self._scratch_name(output_path) + ".segments"
+        return segment_dir(output_path, self.tag)
+
+    def _backlogged(self):
+        if not self._backlog or not self.bandwidth:
+            return False
+        return self._backlog / self.bandwidth > self.max_backlog_seconds
+
+    def _short_of_space(self, sizes):
+        """返回空间不足的磁盘上已有的预留字节数，空间足够时返回 None"""
+        for device, (path, size) in sizes.items():
+            free = free_space(path)
+            reserved = self._reserved.get(device, 0)
+            if free is not None and free - reserved - size < self.min_free_bytes:
+                return reserved
+        return None
+
+    def admit(self, output_paths, estimated_bytes, should_stop=lambda: False):
+        """为一个任务预留空间，返回 Reservation；should_stop 为真时返回 None
+
+        没有其他在途任务时空间仍然不够，说明等待也无法满足：配置了保留空间时抛出 OSError(ENOSPC)，
+        否则照常预留（估算按码率上限计算，实际输出通常更小）。
+        """
+        sizes = {}
+        per_output = estimated_bytes // max(1, len(output_paths))
+        for path in output_paths:
+            device = device_of(os.path.dirname(path))
+            folder, size = sizes.get(device, (os.path.dirname(path), 0))
+            sizes[device] = (folder, size + per_output)
+        if self.staging:
+            device = device_of(self.scratch_dir)
+            folder, size = sizes.get(device, (self.scratch_dir, 0))
+            sizes[device] = (folder, size + estimated_bytes)
+
+        with self._cond:
+            while not should_stop():
+                reserved = self._short_of_space(sizes)
+                # 不保留空间时等待也无法满足的任务照常开始
+                if (reserved is None and not self._backlogged()) or \
+                        (reserved == 0 and not self._backlog and not self.min_free_bytes):
+                    for device, (_, size) in sizes.items():
+                        self._reserved[device] = self._reserved.get(device, 0) + size
+                    return Reservation(sizes)
+                if reserved == 0 and not self._backlog:
+                    raise OSError(errno.ENOSPC, f"磁盘空间不足，预计需要 {estimated_bytes / 1024 ** 3:.1f} GB",
+                                  output_paths[0])
+                self._cond.wait(ADMISSION_POLL_INTERVAL)
+        return None
+
+    def release(self, reservation):
+        """归还预留的空间，可以重复调用"""
+        if reservation is None:
+            return
+        with self._cond:
+            if reservation.released:
+                return
+            reservation.released = True
+            for device, (_, size) in reservation.sizes.items():
+                self._reserved[device] -= size
+            self._cond.notify_all()
+
+    def commit(self, reservation, pairs, on_done=None, check=None):
+        """把 [(临时路径, 正式路径)] 移动到位，完成后归还预留并调用 on_done(error)
+
+        error 为 None 表示成功。暂存时在复制线程中执行，drain() 会等到 on_done 返回。
+        check 不为 None 时在移动前调用，返回假时放弃输出（临时文件留给 on_done 的调用方清理）。
+        """
+        with self._cond:
+            self._pending += 1
+        if not self.staging:
+            self._publish(reservation, pairs, 0, on_done, check)
+            return
+        size = sum(os.path.getsize(staged) for staged, _ in pairs)
+        with self._cond:
+            self._backlog += size
+        self._executor.submit(self._publish, reservation, pairs, size, on_done, check)
+
+    def _publish(self, reservation, pairs, size, on_done, check=None):
+        error = None
+        try:
+            if check is not None and not check():
+                error = RuntimeError("输出已放弃")
+            else:
+                for staged, output_path in pairs:
+                    self._move(staged, output_path)
+        except Exception as e:
+            # 任何错误都要交给 on_done，否则 drain() 会一直等待
+            error = e
+        finally:
+            with self._cond:
+                self._backlog -= size
+            self.release(reservation)
+        try:
+            if on_done is not None:
+                on_done(error)
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def _move(self, staged, output_path):
+        """同一磁盘上直接改名；跨磁盘时分块复制到 .partial 文件再改名，并更新写入速度"""
+        start = time.perf_counter()
+        copied = device_of(staged) != device_of(os.path.dirname(output_path))
+        if not copied:
+            size = os.path.getsize(staged)
+            os.replace(staged, output_path)
+        else:
+            tmp_path = partial_path(output_path, self.tag)
+            size = 0
+            try:
+                with open(staged, 'rb') as src, open(tmp_path, 'wb') as dst:
+                    while True:
+                        chunk = src.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        size += len(chunk)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.replace(tmp_path, output_path)
+            except OSError:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            os.remove(staged)
+        seconds = time.perf_counter() - start
+        if copied and size and seconds > 0:
+            with self._cond:
+                rate = size / seconds
+                self.bandwidth = rate if self.bandwidth is None else (
+                    BANDWIDTH_SMOOTHING * rate + (1 - BANDWIDTH_SMOOTHING) * self.bandwidth)
+        if self.metrics is not None:
+            self.metrics.record("io", seconds, job=output_path, bytes_out=size,
+                                staged=self.staging)
+
+    def drain(self):
+        """等待已提交的复制全部完成"""
+        with self._cond:
+            while self._pending:
+                self._cond.wait(ADMISSION_POLL_INTERVAL)
+
+    def describe(self):
+        if not self.staging:
+            return "直接写入目标文件夹"
+        parts = [f"暂存目录 {self.scratch_dir}"]
+        if self.bandwidth:
+            parts.append(f"写入 {self.bandwidth / 1024 ** 2:.1f} MB/s")
+        return "，".join(parts)
+
+    def close(self):
+        self.drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        if self._lock_file is not None:
+            try:
+                _discard_lock(self._lock_file, self._lock_path)
+            except OSError:
+                pass
+            self._lock_file = None
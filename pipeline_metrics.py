@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import bisect
+import datetime
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 直方图分桶上界（秒）
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+METRIC_PREFIX = "video_encoder"
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class StageStats:
+    """单个阶段的累计统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.durations = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses = {}
+
+    def add(self, seconds, bytes_in, bytes_out, status):
+        self.count += 1
+        self.total += seconds
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        bisect.insort(self.durations, seconds)
+        self.bytes_in += bytes_in or 0
+        self.bytes_out += bytes_out or 0
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 3),
+            "mean_seconds": round(self.total / self.count, 3) if self.count else None,
+            "p50_seconds": _percentile(self.durations, 0.5),
+            "p90_seconds": _percentile(self.durations, 0.9),
+            "p99_seconds": _percentile(self.durations, 0.99),
+            "max_seconds": self.durations[-1] if self.durations else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "statuses": dict(self.statuses),
+        }
+
+
+class PipelineMetrics:
+    """流水线各阶段（scan / probe / queue_wait / encode / concat / io 等）的结构化计时
+
+    每条记录立即追加到 jsonl_path（JSON Lines），同时累计为各阶段的直方图；
+    flush() 把累计结果以 Prometheus 文本格式原子地写入 prometheus_path，
+    可交给 node_exporter 的 textfile 采集，也可以用 serve() 直接提供 /metrics。
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._server = None
+        if jsonl_path:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+            self._file = open(jsonl_path, 'a', encoding='utf-8')
+
+    def record(self, stage, seconds, job=None, bytes_in=None, bytes_out=None, status="ok", **fields):
+        """记录一次阶段耗时；job 为输入文件路径，fields 为附加字段（如 speed、exit_code）"""
+        entry = {
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "status": status,
+        }
+        if job is not None:
+            entry["job"] = job
+        if bytes_in is not None:
+            entry["bytes_in"] = bytes_in
+        if bytes_out is not None:
+            entry["bytes_out"] = bytes_out
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self.stages.setdefault(stage, StageStats()).add(seconds, bytes_in, bytes_out, status)
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    @contextmanager
+    def timer(self, stage, job=None, **fields):
+        """计时一段代码；抛出异常时状态记为 error"""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield fields
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, job=job, status=status, **fields)
+
+    def summary(self):
+        """各阶段的汇总：次数、总耗时、平均和分位数耗时、字节数及状态计数"""
+        with self._lock:
+            return {stage: stats.summary() for stage, stats in self.stages.items()}
+
+    def describe(self):
+        """一行可读的汇总，用于批次结束时的日志"""
+        parts = []
+        for stage, data in sorted(self.summary().items(), key=lambda item: -item[1]["total_seconds"]):
+            parts.append(f"{stage} {data['count']} 次 共 {data['total_seconds']:.1f}s "
+                         f"p50 {data['p50_seconds']:.2f}s p90 {data['p90_seconds']:.2f}s")
+        return "；".join(parts)
+
+    def prometheus_text(self):
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} 流水线各阶段耗时", f"# TYPE {name} histogram"]
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for stage, stats in stages:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), stats.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{_label(stage)}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{_label(stage)}"}} {stats.total:.6f}')
+                lines.append(f'{name}_count{{stage="{_label(stage)}"}} {stats.count}')
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_bytes_total counter")
+            for stage, stats in stages:
+                lines.append(f'{METRIC_PREFIX}_stage_bytes_total{{stage="{_label(stage)}",direction="in"}} '
+                             f'{stats.bytes_in}')
+                lines.append(f'{METRIC_PREFIX}_stage_bytes_total{{stage="{_label(stage)}",direction="out"}} '
+                             f'{stats.bytes_out}')
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_runs_total counter")
+            for stage, stats in stages:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'{METRIC_PREFIX}_stage_runs_total{{stage="{_label(stage)}",'
+                                 f'status="{_label(status)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """写出 Prometheus 文本文件（先写临时文件再替换）"""
+        if not self.prometheus_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.prometheus_path)), exist_ok=True)
+        tmp_path = self.prometheus_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, self.prometheus_path)
+
+    def serve(self, port, host="0.0.0.0"):
+        """在后台线程中提供 http://host:port/metrics"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.flush()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+
+from encode_profiles import EncodingProfile
+from ffmpeg_capabilities import get_capabilities
+from ffmpeg_runner import run_ffmpeg_streaming
+from json_manifest import JsonManifest, is_current, stat_identity
+from media_probe import parse_bitrate
+
+# 码率决策默认保存在输出文件夹中
+QUALITY_CACHE_FILE_NAME = ".quality_cache.json"
+QUALITY_CACHE_VERSION = 1
+
+# 各质量指标的默认目标
+DEFAULT_TARGETS = {"vmaf": 93.0, "ssim": 0.985, "psnr": 40.0}
+# 在片源中均匀取若干段采样
+SAMPLE_COUNT = 3
+SAMPLE_SECONDS = 4.0
+# CRF 搜索范围，数值越大码率越低
+CRF_RANGE = (18, 38)
+# 采样得到的码率加上余量作为整片的平均码率
+BITRATE_HEADROOM = 1.1
+MIN_BITRATE = 200_000
+
+SCORE_PATTERNS = {
+    "vmaf": re.compile(r"VMAF score[:=]\s*([\d.]+)"),
+    "ssim": re.compile(r"SSIM .*All:([\d.]+)"),
+    "psnr": re.compile(r"PSNR .*average:([\d.]+|inf)"),
+}
+
+
+def parse_score(metric, stderr):
+    """从 ffmpeg 输出中读取质量分数，找不到时返回 None"""
+    matches = SCORE_PATTERNS[metric].findall(stderr)
+    if not matches:
+        return None
+    return float("inf") if matches[-1] == "inf" else float(matches[-1])
+
+
+def sample_windows(duration, count=SAMPLE_COUNT, length=SAMPLE_SECONDS):
+    """返回 [(起点, 长度), ...]；片源较短时直接使用整片"""
+    if duration <= count * length:
+        return [(0.0, duration)]
+    return [(max(0.0, (i + 0.5) * duration / count - length / 2), length) for i in range(count)]
+
+
+class QualityCache(JsonManifest):
+    """每个源文件的码率决策缓存
+
+    以源文件路径为键，文件大小和修改时间未变时复用上次的搜索结果；
+    同一源文件按编码规格和质量目标分别记录。path 为 None 时只在内存中缓存。
+    """
+
+    VERSION = QUALITY_CACHE_VERSION
+
+    def get(self, source, key):
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        entry = self.current(source, st)
+        if entry is None:
+            return None
+        with self._lock:
+            return entry["decisions"].get(key)
+
+    def put(self, source, key, decision):
+        try:
+            st = os.stat(source)
+        except OSError:
+            return
+        with self._lock:
+            entry = self.entries.get(source)
+            if not is_current(entry, st):
+                entry = dict(stat_identity(st), decisions={})
+                self.entries[source] = entry
+            entry["decisions"][key] = decision
+            self.dirty = True
+
+
+class QualitySearch:
+    """按片源搜索满足质量目标的最低码率
+
+    在片源中取若干段，用 CPU 编码器以不同 CRF 编码并与源画面比较（VMAF，没有 libvmaf 时用 SSIM，
+    或 PSNR），二分查找最差采样段仍达标的最大 CRF，把该 CRF 下采样的平均码率作为整片码率。
+    以码率而不是 CRF 作为结果，NVENC 与 CPU 编码都可以使用。
+    run 为执行 ffmpeg 命令并返回 stderr 的函数，默认直接调用 run_ffmpeg_streaming；
+    capabilities 用于判断是否有 libvmaf，默认使用共享的检测结果。
+    """
+
+    def __init__(self, metric="vmaf", target=None, cache=None, threads=None, run=None, capabilities=None):
+        if metric not in SCORE_PATTERNS:
+            raise ValueError(f"不支持的质量指标：{metric}")
+        capabilities = capabilities or get_capabilities()
+        self.fallback = metric == "vmaf" and not capabilities.has_filter("libvmaf")
+        if self.fallback:
+            metric, target = "ssim", None
+        self.metric = metric
+        self.target = float(target) if target else DEFAULT_TARGETS[metric]
+        self.cache = cache if cache is not None else QualityCache()
+        self.threads = threads
+        self.run = run or run_ffmpeg_streaming
+
+    def decision_key(self, profile):
+        data = [profile.to_dict(), self.metric, self.target, SAMPLE_COUNT, SAMPLE_SECONDS]
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _filters(self, profile):
+        return f"{profile.scale_filter()},fps={profile.fps},format=yuv420p"
+
+    def sample_command(self, source, start, length, profile, crf, output_path):
+        """以指定 CRF 编码一段采样（只编码视频）"""
+        data = profile.to_dict()
+        data.update(crf=crf, maxrate=None, bufsize=None)
+        sample_profile = EncodingProfile.from_dict(profile.name, data)
+        return [
+            "ffmpeg", "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source,
+            "-vf", self._filters(profile), *sample_profile.video_args("cpu", self.threads),
+            "-an", "-sn", "-dn", "-loglevel", "error", "-y", output_path
+        ]
+
+    def measure_command(self, sample_path, source, start, length, profile):
+        """以同样的缩放和帧率处理源画面作为参照，计算采样的质量分数"""
+        metric_filter = {"vmaf": "libvmaf", "ssim": "ssim", "psnr": "psnr"}[self.metric]
+        graph = (f"[1:v]{self._filters(profile)}[ref];[0:v]format=yuv420p[dist];"
+                 f"[dist][ref]{metric_filter}")
+        return ["ffmpeg", "-i", sample_path, "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source,
+                "-lavfi", graph, "-f", "null", "-loglevel", "info", "-"]
+
+    def measure(self, source, windows, profile, crf, work_dir):
+        """返回 (最差采样段的分数, 采样的平均码率)"""
+        scores = []
+        total_bytes = 0
+        total_seconds = 0.0
+        for i, (start, length) in enumerate(windows):
+            sample_path = os.path.join(work_dir, f"crf{crf}_{i}.mp4")
+            self.run(self.sample_command(source, start, length, profile, crf, sample_path))
+            stderr = self.run(self.measure_command(sample_path, source, start, length, profile))
+            score = parse_score(self.metric, stderr)
+            if score is None:
+                raise RuntimeError(f"无法读取 {self.metric.upper()} 分数")
+            scores.append(score)
+            total_bytes += os.path.getsize(sample_path)
+            total_seconds += length
+        return min(scores), total_bytes * 8 / total_seconds
+
+    def search(self, source, duration, profile, should_stop=lambda: False):
+        """返回码率决策 {"crf", "bitrate", "score", "reached", ...}；已取消时返回 None"""
+        key = self.decision_key(profile)
+        decision = self.cache.get(source, key)
+        if decision is not None:
+            return decision
+
+        windows = sample_windows(duration)
+        work_dir = tempfile.mkdtemp(prefix="quality_")
+        results = {}
+        try:
+            low, high = CRF_RANGE
+            best = None
+            while low <= high:
+                if should_stop():
+                    return None
+                crf = (low + high) // 2
+                results[crf] = self.measure(source, windows, profile, crf, work_dir)
+                if results[crf][0] >= self.target:
+                    best = crf
+                    low = crf + 1
+                else:
+                    high = crf - 1
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        crf = best if best is not None else min(results)
+        score, bitrate = results[crf]
+        decision = {
+            "crf": crf, "bitrate": int(bitrate), "score": score, "reached": best is not None,
+            "metric": self.metric, "target": self.target, "probes": len(results),
+        }
+        self.cache.put(source, key, decision)
+        return decision
+
+    def tuned_profile(self, profile, decision):
+        """按决策得到该片源使用的编码规格：平均码率取采样码率加余量，不超过原规格的最大码率
+
+        达不到目标时使用最大码率。
+        """
+        cap = parse_bitrate(profile.maxrate) if profile.maxrate else None
+        bitrate = max(MIN_BITRATE, decision["bitrate"] * BITRATE_HEADROOM)
+        if cap:
+            bitrate = cap if not decision["reached"] else min(bitrate, cap)
+        maxrate = profile.maxrate or f"{int(bitrate * 1.5 / 1000)}k"
+        data = profile.to_dict()
+        data.update(crf=None, bitrate=f"{int(bitrate / 1000)}k", maxrate=maxrate,
+                    bufsize=profile.bufsize or maxrate)
+        return EncodingProfile.from_dict(profile.name, data)
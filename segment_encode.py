@@ -0,0 +1,148 @@
+import os
+import shutil
+import subprocess
+import threading
+
+from ffmpeg_runner import write_concat_list
+
+# 长视频分段的目标长度范围（秒）
+MIN_SEGMENT_DURATION = 30
+MAX_SEGMENT_DURATION = 300
+
+
+def segment_dir(output_path, tag=None):
+    """分段编码时存放中间文件的目录；tag 与 partial_path 相同"""
+    folder, name = os.path.split(output_path)
+    if tag:
+        return os.path.join(folder, f".{name}.{tag}.segments")
+    return os.path.join(folder, f".{name}.segments")
+
+
+def probe_keyframes(path):
+    """只解封装不解码，列出视频流关键帧的时间点（秒）"""
+    creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path],
+            capture_output=True, text=True, check=False, creationflags=creationflags
+        )
+    except OSError:
+        return []
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                continue
+    return sorted(keyframes)
+
+
+def plan_segments(duration, keyframes, workers, fps):
+    """按关键帧把 [0, duration) 切成若干段，返回 [(起点, 长度), ...]
+
+    目标段长使每个工作槽位大约分到两段，并限制在 MIN/MAX_SEGMENT_DURATION 之间；
+    分段点取目标位置之后的第一个关键帧，再对齐到输出帧率的帧边界，避免拼接处丢帧或重复帧。
+    """
+    target = min(MAX_SEGMENT_DURATION, max(MIN_SEGMENT_DURATION, duration / max(1, workers * 2)))
+    frame = 1.0 / fps
+    boundaries = [0.0]
+    next_cut = target
+    for keyframe in keyframes:
+        if keyframe >= next_cut and duration - keyframe >= MIN_SEGMENT_DURATION / 2:
+            boundaries.append(round(keyframe / frame) * frame)
+            next_cut = keyframe + target
+    if len(boundaries) == 1:
+        return [(0.0, duration)]
+    segments = [(start, end - start) for start, end in zip(boundaries, boundaries[1:])]
+    segments.append((boundaries[-1], None))
+    return segments
+
+
+class SegmentTask:
+    """长视频的一个分段，作为独立的调度单元"""
+
+    def __init__(self, parent, index, start, length, path):
+        self.parent = parent
+        self.index = index
+        self.start = start
+        self.length = length
+        self.path = path
+        self.duration = length if length is not None else (parent.job.duration or 0) - start
+
+    def build_command(self, profile, device, threads, output_path=None, hardware=None):
+        """只编码视频，音频在拼接时整体处理；hardware 为全 GPU 流水线时在显存内解码和缩放"""
+        command = ["ffmpeg", *(hardware.input_args() if hardware else ()),
+                   "-ss", f"{self.start:.6f}", "-i", self.parent.job.input_path]
+        if self.length is not None:
+            command += ["-t", f"{self.length:.6f}"]
+        return command + [
+            "-vf", hardware.scale_filter(profile) if hardware else profile.scale_filter(),
+            "-r", str(profile.fps),
+            *profile.video_args(device, threads),
+            "-an", "-sn", "-dn",
+            "-loglevel", "error",
+            "-y", output_path or self.path
+        ]
+
+
+class SegmentedJob:
+    """把一个编码任务拆成多个分段，全部完成后再拼接；folder 为中间文件目录，默认在输出文件旁"""
+
+    def __init__(self, job, segments, folder=None):
+        self.job = job
+        self.folder = folder or segment_dir(job.output_path)
+        self.tasks = [
+            SegmentTask(self, i, start, length, os.path.join(self.folder, f"{i:05d}.mp4"))
+            for i, (start, length) in enumerate(segments)
+        ]
+        self.failed = False
+        self.error = None
+        self.started = False
+        self.closed = False
+        self.tmp_paths = []
+        self._remaining = len(self.tasks)
+        self._lock = threading.Lock()
+
+    def start(self, begin):
+        """第一个分段开始时准备中间目录，并调用 begin() 取得最终输出的临时路径；
+
+        其余分段会等待准备完成。
+        """
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+            shutil.rmtree(self.folder, ignore_errors=True)
+            os.makedirs(self.folder, exist_ok=True)
+            self.tmp_paths = begin()
+
+    def task_finished(self, ok):
+        """记录一个分段结束；返回 True 表示这是最后一个分段"""
+        with self._lock:
+            if not ok:
+                self.failed = True
+            self._remaining -= 1
+            return self._remaining == 0
+
+    def build_concat_command(self, profile, output_path):
+        """无损拼接视频分段，并从源文件一次性编码完整音轨"""
+        list_path = os.path.join(self.folder, "segments.txt")
+        write_concat_list([task.path for task in self.tasks], list_path)
+        return [
+            "ffmpeg",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-i", self.job.input_path,
+            "-map", "0:v", "-map", "1:a?",
+            "-c:v", "copy",
+            *profile.audio_args(),
+            "-movflags", "faststart",
+            "-loglevel", "error",
+            "-y", output_path
+        ]
+
+    def cleanup(self):
+        self.closed = True
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,171 @@
+"""全 GPU 流水线的命令生成测试：用构造的 Capabilities 代替真实的 ffmpeg 和显卡
+
+    python -m pytest -q test_hardware_pipeline.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from encode_engine import BatchEncoder, EncodeJob, EncodeSettings
+from encode_profiles import BUILTIN_PROFILES, hardware_pipeline
+from encode_scheduler import ResourceScheduler
+from ffmpeg_capabilities import Capabilities
+from ffmpeg_runner import FFmpegError
+from segment_encode import SegmentedJob
+
+H264_MEDIA = {"duration": 60.0, "video": {"codec": "h264", "pix_fmt": "yuv420p", "width": 1920, "height": 1080}}
+
+
+def make_capabilities(filters=("scale_cuda",), hwaccels=("cuda",), encoders=("libx264", "h264_nvenc")):
+    return Capabilities(version="ffmpeg version 6.0", encoders=encoders, hwaccels=hwaccels,
+                        filters=filters, gpus=["GPU 0: NVIDIA Test"])
+
+
+def argument_after(command, flag):
+    return command[command.index(flag) + 1]
+
+
+class HardwarePipelineTest(unittest.TestCase):
+    def test_cuda_decode_and_scale(self):
+        pipeline, reason = hardware_pipeline(make_capabilities(), H264_MEDIA, [BUILTIN_PROFILES["vertical_1080p"]])
+        self.assertIsNone(reason)
+        self.assertEqual(pipeline.input_args(), ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"])
+        self.assertEqual(pipeline.scale_filter(BUILTIN_PROFILES["vertical_720p"]), "scale_cuda=720:1280")
+
+    def test_npp_scale_when_scale_cuda_missing(self):
+        pipeline, _ = hardware_pipeline(make_capabilities(filters=("scale_npp",)), H264_MEDIA,
+                                        [BUILTIN_PROFILES["vertical_1080p"]])
+        self.assertEqual(pipeline.scale, "scale_npp")
+
+    def test_software_path_reasons(self):
+        profiles = [BUILTIN_PROFILES["vertical_1080p"]]
+        ten_bit = {"video": {"codec": "hevc", "pix_fmt": "yuv420p10le"}}
+        cases = [
+            (make_capabilities(hwaccels=()), H264_MEDIA),
+            (make_capabilities(filters=()), H264_MEDIA),
+            (make_capabilities(encoders=("libx264",)), H264_MEDIA),
+            (make_capabilities(), {"video": {"codec": "prores", "pix_fmt": "yuv420p"}}),
+            (make_capabilities(), ten_bit),
+            (make_capabilities(), None),
+        ]
+        for capabilities, media in cases:
+            pipeline, reason = hardware_pipeline(capabilities, media, profiles)
+            self.assertIsNone(pipeline)
+            self.assertTrue(reason)
+
+
+class HardwareCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="hw_test_")
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+
+    def make_engine(self, capabilities, profiles=None, render_mode="gpu"):
+        settings = EncodeSettings(render_mode=render_mode, thread_count=1)
+        return BatchEncoder(settings, capabilities=capabilities, profiles=profiles)
+
+    def make_job(self, engine):
+        output_path = os.path.join(self.folder, "out", "a.mp4")
+        if len(engine.profiles) > 1:
+            renditions = [(profile, os.path.join(self.folder, "out", profile.name, "a.mp4"))
+                          for profile in engine.profiles]
+        else:
+            renditions = None
+        job = EncodeJob(os.path.join(self.folder, "a.mp4"), output_path, renditions)
+        job.media = H264_MEDIA
+        job.duration = H264_MEDIA["duration"]
+        return job
+
+    def plan(self, engine, job, device="gpu"):
+        scheduler = ResourceScheduler(engine.settings.render_mode, 1, 1, gpu_available=True)
+        engine.plan_hardware([job], scheduler)
+        job.device = device
+        return engine.build_command(job)
+
+    def test_nvenc_slot_uses_full_gpu_pipeline(self):
+        engine = self.make_engine(make_capabilities())
+        job = self.make_job(engine)
+        command = self.plan(engine, job)
+        self.assertIsNotNone(job.hardware)
+        self.assertEqual(command[:6], ["ffmpeg", "-hwaccel", "cuda", "-hwaccel_output_format", "cuda", "-i"])
+        self.assertEqual(argument_after(command, "-vf"), "scale_cuda=1080:1920")
+        self.assertEqual(argument_after(command, "-c:v"), "h264_nvenc")
+
+    def test_multiple_renditions_split_on_gpu(self):
+        profiles = [BUILTIN_PROFILES["vertical_1080p"], BUILTIN_PROFILES["vertical_720p"]]
+        engine = self.make_engine(make_capabilities(), profiles)
+        command = self.plan(engine, self.make_job(engine))
+        self.assertIn("-hwaccel", command)
+        self.assertEqual(argument_after(command, "-filter_complex"),
+                         "[0:v]split=2[s0][s1];[s0]scale_cuda=1080:1920[v0];[s1]scale_cuda=720:1280[v1]")
+        self.assertEqual(command.count("h264_nvenc"), 2)
+
+    def test_cpu_slot_ignores_hardware_pipeline(self):
+        engine = self.make_engine(make_capabilities(), render_mode="mixed")
+        job = self.make_job(engine)
+        command = self.plan(engine, job, device="cpu")
+        self.assertIsNotNone(job.hardware)
+        self.assertNotIn("-hwaccel", command)
+        self.assertEqual(argument_after(command, "-vf"), "scale=1080:1920")
+        self.assertEqual(argument_after(command, "-c:v"), "libx264")
+
+    def test_no_cuda_filter_falls_back_to_software_scale(self):
+        engine = self.make_engine(make_capabilities(filters=("ssim",)))
+        job = self.make_job(engine)
+        command = self.plan(engine, job)
+        self.assertIsNone(job.hardware)
+        self.assertNotIn("-hwaccel", command)
+        self.assertEqual(argument_after(command, "-vf"), "scale=1080:1920")
+        self.assertEqual(argument_after(command, "-c:v"), "h264_nvenc")
+
+    def test_hw_decode_disabled(self):
+        engine = self.make_engine(make_capabilities())
+        engine.hw_decode = False
+        job = self.make_job(engine)
+        self.assertNotIn("-hwaccel", self.plan(engine, job))
+
+    def test_segment_command_uses_gpu_pipeline(self):
+        engine = self.make_engine(make_capabilities())
+        job = self.make_job(engine)
+        self.plan(engine, job)
+        parent = SegmentedJob(job, [(0.0, 30.0), (30.0, None)], os.path.join(self.folder, "segments"))
+        command = parent.tasks[1].build_command(engine.profiles[0], "gpu", None, hardware=job.hardware)
+        self.assertLess(command.index("-hwaccel"), command.index("-ss"))
+        self.assertEqual(argument_after(command, "-vf"), "scale_cuda=1080:1920")
+
+    def test_runtime_failure_retries_with_software_decode(self):
+        engine = self.make_engine(make_capabilities())
+        job = self.make_job(engine)
+        self.plan(engine, job)
+        commands = []
+
+        def run_ffmpeg(command, job=None, outputs=(), **kwargs):
+            commands.append(command)
+            if "-hwaccel" in command:
+                raise FFmpegError(1, command, stderr="Impossible to convert between the formats")
+            for path in outputs:
+                with open(path, "wb") as f:
+                    f.write(b"x")
+
+        engine.run_ffmpeg = run_ffmpeg
+        engine.encode(job)
+        engine.stager.drain()
+        self.assertEqual(len(commands), 2)
+        self.assertIn("-hwaccel", commands[0])
+        self.assertNotIn("-hwaccel", commands[1])
+        self.assertEqual(argument_after(commands[1], "-vf"), "scale=1080:1920")
+        self.assertEqual(argument_after(commands[1], "-c:v"), "h264_nvenc")
+        self.assertIsNone(job.hardware)
+        self.assertEqual(job.status, EncodeJob.DONE)
+        self.assertTrue(os.path.exists(job.output_path))
+
+    def test_fallback_only_once(self):
+        engine = self.make_engine(make_capabilities())
+        job = self.make_job(engine)
+        self.plan(engine, job)
+        self.assertTrue(engine._hardware_fallback(job))
+        self.assertFalse(engine._hardware_fallback(job))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,19 @@
 import os
-import random
-import subprocess
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, scrolledtext
 import threading
-from collections import defaultdict, deque
+
+from clip_sampler import WeightedClipSampler
+from compilation_planner import CLIP_METADATA_FILE_NAME, ClipMetadataStore, CompilationPlanner, parse_duration_window
+from concat_normalize import NORMALIZED_DIR_NAME, ClipNormalizer
+from event_bus import EventBus, TkEventPump
+from file_index import FileIndex
+from media_probe import MEDIA_INDEX_FILE_NAME, MediaIndex
+from merge_engine import MergeEngine
+from pipeline_metrics import PipelineMetrics
+
+# 各阶段耗时逐条追加到 JSON Lines 文件
+METRICS_FILE = "merge_metrics.jsonl"
 
 class FileExtractorApp:
     def __init__(self, root):
@@ -18,16 +27,23 @@ class FileExtractorApp:
         self.n = 1
         self.is_running = False
         self.cancel_task = False
+        self.failed_count = 0
         self.output_name_prefix = "output"
         self.thread_count = 1
-        self.file_usage = defaultdict(int)  # 跟踪文件使用次数
         self.available_files = {}  # 每个子文件夹的可用文件列表
         self.max_usage_per_file = 3  # 每个文件最大使用次数，可调整
-        self.recently_used = deque(maxlen=10)  # 最近使用缓存，避免短期重复
+        self.recent_window = 10  # 最近使用缓存大小，避免短期重复
+        self.sampler = None  # 跟踪文件使用次数并加权选择
+        self.duration_window = None  # 每个合成的目标时长区间（秒），None 为不限制
+        self.merge_engine = None
 
         # 创建界面组件
         self.create_widgets()
 
+        # 工作线程只向事件队列发布消息，由主循环定时批量处理
+        self.bus = EventBus()
+        self.event_pump = TkEventPump(self.root, self.bus, self._handle_event)
+
     def create_widgets(self):
         tk.Label(self.root, text="选择父文件夹（包含子文件夹）：", font=("Arial", 10)).grid(row=0, column=0, padx=10, pady=10, sticky="w")
         self.parent_folder_label = tk.Label(self.root, text="未选择", fg="gray", font=("Arial", 10))
@@ -54,22 +70,30 @@ class FileExtractorApp:
         self.thread_entry.grid(row=6, column=1, padx=10, pady=5, sticky="w")
         self.thread_entry.insert(0, "1")
 
+        tk.Label(self.root, text="随机种子（可选）：", font=("Arial", 10)).grid(row=7, column=0, padx=10, pady=10, sticky="w")
+        self.seed_entry = tk.Entry(self.root, width=20, font=("Arial", 10))
+        self.seed_entry.grid(row=7, column=1, padx=10, pady=5, sticky="w")
+
+        tk.Label(self.root, text="目标时长（秒，如 60-90，可选）：", font=("Arial", 10)).grid(row=8, column=0, padx=10, pady=10, sticky="w")
+        self.duration_entry = tk.Entry(self.root, width=20, font=("Arial", 10))
+        self.duration_entry.grid(row=8, column=1, padx=10, pady=5, sticky="w")
+
         self.progress = ttk.Progressbar(self.root, orient="horizontal", length=500, mode="determinate")
-        self.progress.grid(row=7, column=0, padx=10, pady=20, columnspan=2)
+        self.progress.grid(row=9, column=0, padx=10, pady=20, columnspan=2)
 
         self.log_area = scrolledtext.ScrolledText(self.root, width=70, height=10, font=("Arial", 10))
-        self.log_area.grid(row=8, column=0, padx=10, pady=10, columnspan=2)
+        self.log_area.grid(row=10, column=0, padx=10, pady=10, columnspan=2)
         self.log_area.config(state=tk.DISABLED)
 
         self.generate_button = tk.Button(
             self.root, text="生成", command=self.start_generate_files, bg="green", fg="white", font=("Arial", 10)
         )
-        self.generate_button.grid(row=9, column=0, padx=10, pady=20, columnspan=1)
+        self.generate_button.grid(row=11, column=0, padx=10, pady=20, columnspan=1)
 
         self.cancel_button = tk.Button(
             self.root, text="取消", command=self.cancel_generate_files, bg="red", fg="white", font=("Arial", 10)
         )
-        self.cancel_button.grid(row=9, column=1, padx=10, pady=20, columnspan=1)
+        self.cancel_button.grid(row=11, column=1, padx=10, pady=20, columnspan=1)
         self.cancel_button.config(state=tk.DISABLED)
 
     def log(self, message):
@@ -82,17 +106,30 @@ class FileExtractorApp:
         parent_folder = filedialog.askdirectory(title="选择父文件夹")
         if parent_folder:
             self.parent_folder_label.config(text=parent_folder, fg="black")
-            self.source_folders = [
-                os.path.join(parent_folder, f) for f in os.listdir(parent_folder) if os.path.isdir(os.path.join(parent_folder, f))
-            ]
-            self.available_files = {}
-            for folder in self.source_folders:
-                self.available_files[folder] = [
-                    os.path.join(folder, f) for f in os.listdir(folder)
-                    if os.path.isfile(os.path.join(folder, f)) and f.endswith((".mp4", ".avi", ".mkv"))
-                ]
             self.log(f"已选择父文件夹：{parent_folder}")
-            self.log(f"找到 {len(self.source_folders)} 个子文件夹，总计 {sum(len(files) for files in self.available_files.values())} 个视频文件")
+            threading.Thread(target=self.scan_parent_folder, args=(parent_folder,), daemon=True).start()
+
+    def scan_parent_folder(self, parent_folder):
+        """在后台线程中列出子文件夹及其中的视频文件；文件索引只重新列出有变化的目录"""
+        file_index = FileIndex()
+        try:
+            subfolders, _ = file_index.listdir(parent_folder)
+            available_files = {}
+            for name in subfolders:
+                folder = os.path.join(parent_folder, name)
+                try:
+                    _, files = file_index.listdir(folder)
+                except OSError:
+                    files = []
+                available_files[folder] = [
+                    os.path.join(folder, f) for f in files if f.endswith((".mp4", ".avi", ".mkv"))
+                ]
+        except OSError as e:
+            self.bus.publish({"type": "log", "message": f"读取文件夹失败：{e}"})
+            return
+        finally:
+            file_index.close()
+        self.bus.publish({"type": "folder_scanned", "available_files": available_files})
 
     def choose_destination_folder(self):
         folder = filedialog.askdirectory()
@@ -101,51 +138,13 @@ class FileExtractorApp:
             self.destination_folder_label.config(text=folder, fg="black")
             self.log(f"已选择目标文件夹：{folder}")
 
-    def merge_videos(self, video_files, output_path):
-        list_file_path = os.path.join(self.destination_folder, "file_list.txt")
-        with open(list_file_path, "w", encoding="utf-8") as f:
-            f.writelines(f"file '{file}'\n" for file in video_files)
-
-        command = [
-            "ffmpeg",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", list_file_path,
-            "-c", "copy",
-            "-loglevel", "quiet",
-            output_path,
-        ]
-        try:
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as e:
-            self.log(f"合并视频失败：{e.stderr.decode('utf-8', errors='ignore')}")
-            raise
-        finally:
-            os.remove(list_file_path)
+    def create_sampler(self, seed=None):
+        return WeightedClipSampler(
+            self.available_files, self.max_usage_per_file, recent_window=self.recent_window, seed=seed
+        )
 
     def select_file(self, folder):
-        files = self.available_files[folder]
-        if not files:
-            return None
-
-        available = [f for f in files if self.file_usage[f] < self.max_usage_per_file]
-        if not available:
-            for f in files:
-                self.file_usage[f] = 0
-            available = files
-
-        # 过滤最近使用过的文件
-        filtered = [f for f in available if f not in self.recently_used]
-        if filtered:
-            available = filtered
-
-        # 按使用次数生成权重：次数越少，权重越大
-        weights = [1 / (1 + self.file_usage[f]) for f in available]
-        selected = random.choices(available, weights=weights, k=1)[0]
-
-        self.file_usage[selected] += 1
-        self.recently_used.append(selected)
-        return selected
+        return self.sampler.select(folder)
 
     def start_generate_files(self):
         if self.is_running:
@@ -179,8 +178,25 @@ class FileExtractorApp:
             messagebox.showerror("错误", "请输入有效的输出文件名前缀！")
             return
 
+        try:
+            self.duration_window = parse_duration_window(self.duration_entry.get())
+        except ValueError:
+            messagebox.showerror("错误", "目标时长应为秒数（如 75）或区间（如 60-90）！")
+            return
+
+        # 指定随机种子时从头开始计数，相同输入和种子得到相同的选择结果
+        seed_text = self.seed_entry.get().strip()
+        if seed_text:
+            try:
+                seed = int(seed_text)
+            except ValueError:
+                messagebox.showerror("错误", "随机种子必须是整数！")
+                return
+            self.sampler = self.create_sampler(seed)
+
         self.is_running = True
         self.cancel_task = False
+        self.failed_count = 0
         self.generate_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.NORMAL)
         self.log("任务开始...")
@@ -189,37 +205,114 @@ class FileExtractorApp:
 
     def cancel_generate_files(self):
         self.cancel_task = True
+        if self.merge_engine is not None:
+            self.merge_engine.cancel()
         self.log("任务取消中...")
 
-    def generate_files(self, n):
-        self.progress["maximum"] = n
-        self.progress["value"] = 0
+    def plan_merges(self, n, metadata, normalizer):
+        """拼接前按顺序规划全部 n 次合成并检查结果；相同的种子得到相同的选择"""
+        planner = CompilationPlanner(self.source_folders, self.sampler, metadata, self.duration_window, normalizer)
+        jobs = planner.plan(
+            n, lambda i: os.path.join(self.destination_folder, f"{self.output_name_prefix}_{i + 1}.mp4"),
+            lambda: self.cancel_task
+        )
+        for message in planner.validate(jobs):
+            self.bus.publish({"type": "log", "message": message})
+        return jobs
+
+    def prepare_metadata(self, metrics, media_index):
+        """并行读取全部片段的时长（有目标时长时还有关键帧），结果缓存在目标文件夹中"""
+        metadata = ClipMetadataStore(os.path.join(self.destination_folder, CLIP_METADATA_FILE_NAME), media_index)
+        all_files = [f for files in self.available_files.values() for f in files]
+        with metrics.timer("metadata", files=len(all_files)):
+            metadata.build(all_files, keyframes=self.duration_window is not None)
+        return metadata
+
+    def prepare_normalizer(self, metrics, media_index):
+        """探测全部片段，确定拼接的统一规格；探测结果和转换结果缓存在目标文件夹中"""
+        normalizer = ClipNormalizer(os.path.join(self.destination_folder, NORMALIZED_DIR_NAME), media_index)
+        all_files = [f for files in self.available_files.values() for f in files]
+        self.bus.publish({"type": "log", "message": f"正在检查 {len(all_files)} 个片段的编码参数..."})
+        with metrics.timer("probe", files=len(all_files)):
+            groups, mismatched, unreadable = normalizer.prepare(all_files)
+        if normalizer.canonical is None and groups > 1:
+            message = f"片段共有 {groups} 种规格，且无法统一转换，拼接结果可能异常"
+        elif mismatched:
+            message = f"片段共有 {groups} 种规格，{mismatched} 个片段将在首次使用时转换为统一规格"
+        else:
+            message = "全部片段规格一致，直接无损拼接"
+        self.bus.publish({"type": "log", "message": message})
+        if unreadable:
+            self.bus.publish({"type": "log", "message": f"{unreadable} 个片段无法读取媒体信息，将被跳过"})
+        return normalizer
 
-        for i in range(n):
+    def generate_files(self, n):
+        normalizer = None
+        metadata = None
+        error = None
+        metrics = PipelineMetrics(METRICS_FILE)
+        try:
+            media_index = MediaIndex(os.path.join(self.destination_folder, MEDIA_INDEX_FILE_NAME))
+            normalizer = self.prepare_normalizer(metrics, media_index)
+            metadata = self.prepare_metadata(metrics, media_index)
+            jobs = self.plan_merges(n, metadata, normalizer)
             if self.cancel_task:
-                self.log("任务已取消")
-                break
-
-            selected_files = []
-            for folder in self.source_folders:
-                if self.available_files[folder]:
-                    file = self.select_file(folder)
-                    if file:
-                        selected_files.append(file)
-
-            if selected_files:
-                output_name = f"{self.output_name_prefix}_{i + 1}.mp4"
-                output_path = os.path.join(self.destination_folder, output_name)
-                self.merge_videos(selected_files, output_path)
-
-            self.progress["value"] += 1
-            self.log(f"已完成 {i + 1}/{n} 次循环")
-            self.root.update_idletasks()
+                return
+            self.merge_engine = MergeEngine(self.thread_count, on_event=self.bus.publish,
+                                            normalizer=normalizer, metrics=metrics)
+            # 创建引擎之前到达的取消请求
+            if self.cancel_task:
+                self.merge_engine.cancel()
+            self.merge_engine.run(iter(jobs), total=len(jobs))
+        except Exception as e:
+            # 探测、读取时长或规划中的错误不能当作成功结束
+            error = f"{type(e).__name__}: {e}"
+            self.bus.publish({"type": "log", "message": f"任务出错：{error}"})
+        finally:
+            try:
+                if normalizer is not None:
+                    normalizer.save()
+                if metadata is not None:
+                    metadata.save()
+            except OSError as e:
+                self.bus.publish({"type": "log", "message": f"保存片段缓存失败：{e}"})
+            metrics.close()
+            self.bus.publish({"type": "generate_finished", "error": error})
+
+    def _handle_event(self, event):
+        """在主线程中根据事件更新界面"""
+        if event["type"] == "log_batch":
+            for e in event["events"]:
+                self.log(e["message"])
+        elif event["type"] == "batch_started":
+            self.progress["maximum"] = event["total"]
+            self.progress["value"] = 0
+        elif event["type"] == "progress":
+            self.progress["value"] = event["done"]
+            self.log(f"已完成 {event['done']}/{event['total']} 次循环")
+        elif event["type"] == "batch_finished":
+            self.failed_count = event["failed"]
+        elif event["type"] == "generate_finished":
+            self._finish_generate_files(event["error"])
+        elif event["type"] == "folder_scanned":
+            self.available_files = event["available_files"]
+            self.source_folders = list(self.available_files)
+            self.sampler = self.create_sampler()
+            self.log(f"找到 {len(self.source_folders)} 个子文件夹，总计 {sum(len(files) for files in self.available_files.values())} 个视频文件")
 
+    def _finish_generate_files(self, error=None):
         self.is_running = False
         self.generate_button.config(state=tk.NORMAL)
         self.cancel_button.config(state=tk.DISABLED)
-        if not self.cancel_task:
+        if self.cancel_task:
+            self.log("任务已取消")
+        elif error is not None:
+            self.log("任务失败！")
+            messagebox.showwarning("失败", f"任务出错：{error}")
+        elif self.failed_count:
+            self.log(f"任务完成，{self.failed_count} 次合成失败")
+            messagebox.showwarning("部分失败", f"{self.failed_count} 次合成失败，详见日志")
+        else:
             self.log("任务完成！")
             messagebox.showinfo("完成", f"文件已成功复制到 {self.destination_folder}！")
             os.startfile(self.destination_folder)